@@ -8,4 +8,9 @@ import scrapy
 
 class DeadmanrealtySpiderItem(scrapy.Item):
     address = scrapy.Field()
-    details = scrapy.Field()
\ No newline at end of file
+    details = scrapy.Field()
+    url = scrapy.Field()
+    # 'new', 'changed' or 'removed' since the last run, see IncrementalPipeline
+    change = scrapy.Field()
+    # Set by the spider for IncrementalPipeline, which takes it out of the item
+    listing_fingerprint = scrapy.Field()
@@ -7,15 +7,33 @@
 #     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+import sys
+
+# The Splash middlewares and the incremental pipeline are shared with toyota_collector, in
+# splash_scripts at the top of the repo
+repo_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+if repo_dir not in sys.path:
+    sys.path.append(repo_dir)
+
 BOT_NAME = 'deadmanrealty_spider'
 
 SPIDER_MODULES = ['deadmanrealty_spider.spiders']
 NEWSPIDER_MODULE = 'deadmanrealty_spider.spiders'
 
 SPLASH_URL = 'http://localhost:8050/'
+# Every Splash server renders are spread over (see SplashPoolMiddleware), ex. one container per port.
+# SPLASH_URL alone by default
+#SPLASH_URLS = ['http://localhost:8050/', 'http://localhost:8051/']
 
 DUPEFILTER_CLASS = 'scrapy_splash.SplashAwareDupeFilter'
 
+# Renders sent to Splash at once (see SplashRenderBudgetMiddleware): starts at SPLASH_START_RENDERS and
+# adapts to what Splash keeps up with, halving on 503/504s. The limit is for all of SPLASH_URLS together
+SPLASH_START_RENDERS = 4
+SPLASH_MAX_RENDERS = 16
+SPLASH_RENDER_RETRIES = 3
+
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.114 Safari/537.36'
@@ -55,6 +73,8 @@ SPIDER_MIDDLEWARES = {
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
+    'splash_scripts.middlewares.SplashPoolMiddleware': 715,
+    'splash_scripts.middlewares.SplashRenderBudgetMiddleware': 720,
     'scrapy_splash.SplashCookiesMiddleware': 723,
     'scrapy_splash.SplashMiddleware': 725,
     'scrapy.downloadermiddlewares.httpcompression.HttpCompressionMiddleware': 810
@@ -68,9 +88,15 @@ DOWNLOADER_MIDDLEWARES = {
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    'deadmanrealty_spider.pipelines.DeadmanrealtySpiderPipeline': 300,
-#}
+ITEM_PIPELINES = {
+    'splash_scripts.incremental.IncrementalPipeline': 300,
+}
+# Only new, changed and removed items are output, compared with the last run kept here. Delete the
+# file (or run with -s FINGERPRINT_DB=<new file>) to get every item again
+FINGERPRINT_DB = 'deadmanrealty_fingerprints.db'
+FINGERPRINT_KEY_FIELDS = ['address']
+# Pages are rendered again after this many days even if their listing entry is the same
+FINGERPRINT_RECHECK_DAYS = 7
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -1,12 +1,80 @@
+import os
+
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy_splash import SplashRequest, SplashFormRequest
+from splash_scripts.incremental import fingerprint
 from ..items import DeadmanrealtySpiderItem
 
 
+# Nodes a render of each page is missing if it came back before the page's scripts had finished,
+# see SplashRenderBudgetMiddleware
+LISTING_XPATH = '//div[@id="ia_contents"]/div[@class="viewgrid"]'
+ADDRESS_XPATH = '//*[@id="ia_address"]/h1'
+
+# Renders a page without its images, fonts and trackers, waits for a selector and returns only the
+# elements that are parsed. Shared with toyota_collector
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'splash_scripts',
+                       'render_fragment.lua')) as script_file:
+    RENDER_SCRIPT = script_file.read()
+
+
+def render_request(url, callback, selector, fragment, render_xpath, wait=0.5, meta=None):
+    """SplashRequest through RENDER_SCRIPT, returning the elements matching fragment once selector is on the page"""
+    return SplashRequest(url=url, callback=callback, endpoint='execute',
+                         args={'lua_source': RENDER_SCRIPT, 'selector': selector, 'fragment': fragment, 'wait': wait},
+                         meta=dict(meta or {}, render_xpath=render_xpath))
+
+
+def render_listing(url, callback):
+    return render_request(url, callback, '#ia_contents div.viewgrid', '#ia_contents, #ia_btn_next', LISTING_XPATH)
+
+
 class DeadmanrealtySpider(scrapy.Spider):
     name = 'deadmanrealty'
     allowed_domains = ['deadmanrealtyofutah.com']
     start_urls = ['https://deadmanrealtyofutah.com/fine/real/estate/saved']  # login page
+    removed_reported = False
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
+    def unchanged(self, url, listing_fingerprint):
+        # With IncrementalPipeline: the property's box in the listing is the same as when its page was
+        # last scraped, so the page isn't rendered again
+        store = getattr(self, 'fingerprints', None)
+        if store is None or not store.unchanged(url, listing_fingerprint):
+            return False
+        self.crawler.stats.inc_value('fingerprints/unchanged')
+        return True
+
+    def listing_incomplete(self, message):
+        # Part of the listing couldn't be read, so properties that weren't seen may still be listed
+        self.crawler.stats.inc_value('listing/incomplete')
+        self.logger.warning(message)
+
+    def spider_idle(self):
+        # Once everything is scraped, the properties that are no longer listed are output with change 'removed'
+        store = getattr(self, 'fingerprints', None)
+        if store is None or self.removed_reported:
+            return
+        self.removed_reported = True
+        stats = self.crawler.stats
+        if stats.get_value('log_count/ERROR') or stats.get_value('listing/incomplete'):
+            self.logger.warning('Not reporting removed properties, this run had errors or missed part of the listing')
+            return
+        self.crawler.engine.crawl(scrapy.Request('data:,', callback=self.report_removed, dont_filter=True))
+        raise DontCloseSpider
+
+    def report_removed(self, response):
+        for values in self.fingerprints.removed():
+            property_details = DeadmanrealtySpiderItem({k: v for k, v in values.items() if k in DeadmanrealtySpiderItem.fields})
+            property_details['change'] = 'removed'
+            yield property_details
 
     def start_requests(self):
         for url in self.start_urls:
@@ -17,20 +85,24 @@ class DeadmanrealtySpider(scrapy.Spider):
 
     def go_to_listings(self, response):
         listings_url = response.xpath('//*[@id="menu2"]/ul/li[4]/a/@href').extract_first()
-        yield SplashRequest(url=response.urljoin(listings_url), callback=self.parse, args={'wait': 0.5, 'timeout': 60})
+        yield render_listing(response.urljoin(listings_url), self.parse)
 
     def parse(self, response):
-        page_locations = response.xpath('//div[@id="ia_contents"]/div[@class="viewgrid"]')
+        page_locations = response.xpath(LISTING_XPATH)
         for box in page_locations:
-            page_url = box.xpath('.//a/@href').extract_first()
-            # 3 second wait below is to help make sure the address loads. It doesn't always work,
-            # but I've noticed that a higher wait returns more results.
-            # resource_timeout in 'args' below is to help prevent 504 Gateway errors.
-            yield SplashRequest(url=response.urljoin(page_url), callback=self.parse_page, args={'wait': 3})
+            page_url = response.urljoin(box.xpath('.//a/@href').extract_first())
+            listing_fingerprint = fingerprint(box)
+            if self.unchanged(page_url, listing_fingerprint):
+                continue
+            # The address often loads late, so the render waits until it is there
+            yield render_request(page_url, self.parse_page, '#ia_address h1', '#ia_address, #PropDetailItem',
+                                 ADDRESS_XPATH, meta={'listing_url': page_url, 'listing_fingerprint': listing_fingerprint})
 
         next_page = response.xpath('//*[@id="ia_btn_next"]/@href').extract_first()
-        # resource_timeout in 'args' below is to help prevent 504 Gateway errors.
-        yield SplashRequest(url=response.urljoin(next_page), callback=self.parse, args={'wait': 0.5})
+        if next_page:
+            if not page_locations:
+                self.listing_incomplete('No properties on the listing page ' + response.url)
+            yield render_listing(response.urljoin(next_page), self.parse)
 
     def parse_page(self, response):
         if 'marketeval' in response.url:
@@ -38,9 +110,11 @@ class DeadmanrealtySpider(scrapy.Spider):
         else:
             property_details = DeadmanrealtySpiderItem()
 
-            property_details['address'] = response.xpath('//*[@id="ia_address"]/h1/text()').extract_first().replace('\n', '').replace('\t', '')
+            property_details['address'] = response.xpath(ADDRESS_XPATH + '/text()').extract_first().replace('\n', '').replace('\t', '')
             raw_detail_keys = [category.replace(':', '') for category in response.xpath('//*[@id="PropDetailItem"]/div[1]/text()').extract()]
             raw_detail_values = response.xpath('//*[@id="PropDetailItem"]/div[2]/text()').extract()
             property_details['details'] = dict(zip(raw_detail_keys, raw_detail_values))
+            property_details['url'] = response.meta.get('listing_url', response.url)
+            property_details['listing_fingerprint'] = response.meta.get('listing_fingerprint')
 
             yield property_details
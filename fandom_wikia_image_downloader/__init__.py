@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Fandom wikia image downloader.
+
+Importing the package doesn't start a crawl or import any of its modules. The names below are only
+imported when they are first used, so ex. `from fandom_wikia_image_downloader import CachedSession`
+doesn't pay for BeautifulSoup or the crawler.
+
+Run a crawl from the command line with: python -m fandom_wikia_image_downloader --help
+"""
+import importlib
+
+
+# Public name -> the module it lives in
+_EXPORTS = {
+    'main': 'fandom_wikia_image_downloader_03',
+    'run': 'fandom_wikia_image_downloader_03',
+    'configure': 'fandom_wikia_image_downloader_03',
+    'retrieve_domain_names': 'fandom_wikia_image_downloader_03',
+    'crawl_one_domain': 'fandom_wikia_image_downloader_03',
+    'AsyncDomainCrawler': 'async_crawler',
+    'crawl_domains': 'async_crawler',
+    'discover_domains': 'async_crawler',
+    'CrawlFrontier': 'crawl_state',
+    'DomainRegistry': 'domain_registry',
+    'MemoryFrontier': 'crawl_state',
+    'run_domain_pool': 'domain_pool',
+    'CachedSession': 'http_cache',
+    'ContentStore': 'image_store',
+    'NearDuplicateIndex': 'near_duplicates',
+    'filter_near_duplicates': 'near_duplicates',
+    'validate_folder': 'image_validation',
+    'HostThrottle': 'throttle',
+    'METRICS': 'telemetry',
+    'MetricsExporter': 'telemetry',
+    'set_parser_backend': 'wikia_parsing',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+    value = getattr(importlib.import_module('.' + _EXPORTS[name], __name__), name)
+    # Later lookups find it straight away
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from .fandom_wikia_image_downloader_03 import main
+
+
+main()
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio crawl mode for the fandom wikia image downloader.
+
+Does the same work as get_one_domain in fandom_wikia_image_downloader_03.py, using the same
+parsing functions from wikia_parsing.py, but fetches category pages, character pages and images
+concurrently. A global limit caps the number of requests in flight and a per-host limit keeps any
+one wiki (or the image cdn) from being hammered. On top of that, a throttle.HostThrottle paces the
+requests to each host at the rate the server is keeping up with, and backs off when it isn't.
+"""
+import asyncio
+import os
+import tempfile
+import time
+from typing import BinaryIO, Callable, Container, Dict, Iterable, List, Optional, Set, Union
+from urllib.error import ContentTooShortError
+from urllib.parse import urlsplit
+
+import httpx
+
+from .crawl_state import CrawlFrontier, MemoryFrontier
+from .telemetry import METRICS
+from .http_cache import CHUNK_SIZE, HTTP2, CacheMiss, CachedSession, check_complete, check_size, content_length
+from .throttle import HostThrottle
+from .web_scraping_tools import UNKNOWN_EXTENSION, check_filetype, classify_image, get_download_path
+from .wikia_parsing import (CATEGORY_PATTERN, CATEGORY_TOPICS, categories_search_url, community_search_url,
+                           get_domain_name, parse_category_members, parse_domain_categories, parse_image_urls,
+                           parse_search_results, sort_category_from_character)
+
+
+class AsyncDomainCrawler:
+    """
+    Crawls fandom domains with a shared httpx.AsyncClient.
+
+    Parameters
+    ----------
+    download_dir : str
+        Folder the images are downloaded to. Each domain gets its own folder inside it, the same as
+        with download_image.
+    concurrency : int, optional
+        Maximum number of requests in flight across all hosts. The default is 32.
+    per_host_limit : int, optional
+        Maximum number of requests in flight to a single host. The default is 8.
+    throttle : throttle.HostThrottle, optional
+        Rate limits every host, and decides how long to wait before retrying a failed request. The
+        default is the session's throttle if it has one, otherwise a new HostThrottle.
+    state_path : str, optional
+        SQLite file to keep each domain's crawl progress in, see crawl_state.CrawlFrontier. The
+        default is None, which keeps everything in memory.
+    store : image_store.ContentStore, optional
+        Store images by content digest instead of by timestamp in download_dir. The default is None.
+    session : http_cache.CachedSession, optional
+        Answer from, and revalidate against, the session's on-disk cache. Its ttl and offline
+        settings are used too. The default is None, which doesn't cache anything.
+    min_size, max_size : int, optional
+        Images smaller or larger than this many bytes are skipped, as soon as their Content-Length
+        or their body so far shows it. The defaults are None, no limit.
+
+    """
+
+    def __init__(self, download_dir: str, concurrency: int = 32, per_host_limit: int = 8,
+                 state_path: str = None, store=None, session: CachedSession = None, min_size: int = None,
+                 max_size: int = None, throttle: HostThrottle = None):
+        self.download_dir = download_dir
+        self.min_size = min_size
+        self.max_size = max_size
+        self.session = session
+        self.state_path = state_path
+        self.store = store
+        self.concurrency = concurrency
+        self.per_host_limit = per_host_limit
+        if throttle is None:
+            throttle = session.throttle if session is not None and session.throttle is not None else HostThrottle()
+        self.throttle = throttle
+        self._global_limit = asyncio.Semaphore(concurrency)
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+        # Downloads in progress by url, as the same image is often on several pages of a domain
+        self._downloads: Dict[str, asyncio.Task] = {}
+        self.client = httpx.AsyncClient(http2=HTTP2, follow_redirects=True, timeout=60,
+                                        limits=httpx.Limits(max_connections=concurrency))
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_limits[host]
+
+    async def fetch(self, url: str, out: BinaryIO = None,
+                    saved: Callable[[dict], bool] = None) -> Union[bytes, httpx.Headers, None]:
+        """
+        Return the body of url. Each request waits for its host's turn in the throttle, and 429s,
+        5xx and connection problems are retried after the throttle's backoff. Connection problems
+        keep being retried until the internet comes back, like retry_connection does for the serial
+        crawl. HTTP error statuses raise httpx.HTTPStatusError.
+
+        With out (a file open for writing, for images) the body is streamed into it chunk by chunk
+        instead, with the size limits applied as it arrives, and the response headers are returned.
+        A body shorter than its Content-Length raises ContentTooShortError.
+
+        With a session, unchanged urls are answered from its cache. For images only the validators
+        are cached, and they are stored by the caller once the image is in place. None is returned
+        when url hasn't changed and saved(meta) says its file is still there, see
+        CachedSession.check_file.
+        """
+        if out is not None:
+            return await self._fetch(url, out, saved)
+        with METRICS.time_stage('page_fetch'):
+            return await self._fetch(url, out, saved)
+
+    async def _fetch(self, url: str, out: Optional[BinaryIO],
+                     saved: Optional[Callable[[dict], bool]]) -> Union[bytes, httpx.Headers, None]:
+        keep_body = out is None
+        kind = 'page' if keep_body else 'image'
+        meta = None
+        if self.session is not None:
+            if keep_body:
+                hit, meta, body = self.session.check(url)
+            else:
+                hit, meta = self.session.check_file(url, saved or (lambda meta: False))
+                body = None
+            if hit:
+                METRICS.inc('fandom_http_cache_total', result='hit')
+                return body
+        headers = self.session.cache.conditional_headers(meta) if self.session is not None else None
+        attempt = 0
+        while True:
+            # Wait for the host's rate limit before taking a connection slot
+            await self.throttle.async_wait(url)
+            try:
+                async with self._host_limit(url), self._global_limit:
+                    sent = time.perf_counter()
+                    async with self.client.stream('GET', url, headers=headers) as response:
+                        METRICS.observe('fandom_http_request_seconds', time.perf_counter() - sent)
+                        METRICS.inc('fandom_http_responses_total', status=response.status_code)
+                        delay = self.throttle.on_response(url, response.status_code, response.headers, attempt)
+                        if delay is None:
+                            if response.status_code == 304 and meta is not None:
+                                METRICS.inc('fandom_http_cache_total', result='revalidated')
+                                self.session.cache.touch(url, meta)
+                                return self.session.cache.body(url) if keep_body else None
+                            response.raise_for_status()
+                            if keep_body:
+                                content = await response.aread()
+                                size = len(content)
+                            else:
+                                content = None
+                                size = await self._write_file(url, response, out)
+                            METRICS.inc('fandom_http_cache_total', result='miss')
+                            METRICS.inc('fandom_http_bytes_total', size, kind=kind)
+                            if self.session is not None and keep_body:
+                                self.session.cache.store(url, response.headers, content)
+                            return content if keep_body else response.headers
+            except httpx.TransportError:
+                METRICS.inc('fandom_http_responses_total', status='error')
+                delay = self.throttle.on_error(url, attempt)
+                if delay is None:
+                    print("Internet issue. Trying again until the internet issue is resolved")
+                    delay = self.throttle.max_delay
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _write_file(self, url: str, response: httpx.Response, out: BinaryIO) -> int:
+        # Start over if an earlier attempt dropped halfway
+        out.seek(0)
+        out.truncate()
+        expected = content_length(response)
+        # A compressed body's Content-Length isn't the size of the file
+        if expected is not None and 'Content-Encoding' not in response.headers:
+            check_size(url, expected, self.min_size, self.max_size)
+        size = 0
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            size += len(chunk)
+            check_size(url, size, self.min_size, self.max_size, complete=False)
+            out.write(chunk)
+        check_complete(response, expected)
+        check_size(url, size, self.min_size, self.max_size)
+        out.flush()
+        return size
+
+    # %% Domain discovery
+
+    async def _search_page(self, search_term: str, pagenum: int) -> List[str]:
+        try:
+            return parse_search_results(await self.fetch(community_search_url(search_term, pagenum)))
+        except (httpx.HTTPStatusError, CacheMiss):
+            # Treated like an empty page, the end of the results
+            return []
+
+    async def search_domains(self, search_term: str, pages_deep: int = 100, window: int = 4, max_window: int = 32,
+                             on_page: Callable[[List[str]], None] = None) -> Set[str]:
+        """
+        Async version of the search loop in retrieve_domain_names for one search term
+
+        Search pages are requested a window at a time, all pages of a window at once, instead of
+        waiting for each page before asking for the next. The window doubles (up to max_window)
+        every time it comes back full, and the search stops at the first empty page, so at most one
+        window of requests past the end of the results is wasted. on_page is called with the
+        domains of every page as soon as its window arrives.
+        """
+        search_term = search_term.replace(" ", "_")
+        domain_names: Set[str] = set()
+        pagenum = 1
+        while pagenum < pages_deep:
+            pagenums = range(pagenum, min(pagenum + window, pages_deep))
+            results = await asyncio.gather(*[self._search_page(search_term, p) for p in pagenums])
+            for p, domains in zip(pagenums, results):
+                if not domains:
+                    print("domain page for search '" + search_term + "' ended at page " + str(p))
+                    return domain_names
+                domain_names.update(domains)
+                if on_page is not None:
+                    on_page(domains)
+            pagenum = pagenums.stop
+            window = min(window * 2, max_window)
+        return domain_names
+
+    # %% Discovery
+
+    async def get_domain_categories(self, domain_base_link: str) -> List[str]:
+        """
+        Async version of get_domain_categories. Returns the character and gallery category urls
+        of a domain with duplicates removed. A topic that fails to load or parse adds no categories.
+        """
+        print("Collecting character and gallery pages for " + domain_base_link)
+        results = await asyncio.gather(*[self._topic_categories(domain_base_link, t) for t in CATEGORY_TOPICS])
+        character_categories_list = []
+        for categories in results:
+            character_categories_list.extend(categories)
+        return list(dict.fromkeys(character_categories_list))
+
+    async def _topic_categories(self, domain_base_link: str, topic: str) -> List[str]:
+        try:
+            return parse_domain_categories(await self.fetch(categories_search_url(domain_base_link, topic)), domain_base_link)
+        except (AttributeError, httpx.HTTPStatusError, CacheMiss):
+            print("Skipping the " + topic + " categories of " + domain_base_link)
+            return []
+
+    async def _category_members(self, category: str, domain_base_link: str) -> List[str]:
+        try:
+            return parse_category_members(await self.fetch(category), domain_base_link)
+        except (AttributeError, httpx.HTTPStatusError, CacheMiss):
+            return []
+
+    async def get_character_pages(self, domain_categories: Iterable[str], domain_base_link: str) -> List[str]:
+        """
+        Async version of get_character_pages. A category that fails to load or parse adds no pages.
+        """
+        results = await asyncio.gather(*[self._category_members(c, domain_base_link) for c in domain_categories])
+        full_character_pages: Set[str] = set()
+        for pages in results:
+            full_character_pages.update(pages)
+        return list(full_character_pages)
+
+    async def gather_remaining_pages(self, character_page_urls: List[str], domain_base_link: str,
+                                     frontier=None) -> List[str]:
+        """
+        Async version of gather_remaining_pages. The category graph is walked one level at a time,
+        with every category of a level fetched concurrently. frontier defaults to a MemoryFrontier.
+        """
+        if frontier is None:
+            frontier = MemoryFrontier()
+        if not frontier.is_seeded():
+            frontier.seed(character_page_urls)
+        categories_to_check = frontier.unchecked_categories()
+        while categories_to_check:
+            results = await asyncio.gather(*[self._category_members(c, domain_base_link) for c in categories_to_check])
+            for category_url, pages in zip(categories_to_check, results):
+                characters, categories = sort_category_from_character(pages, CATEGORY_PATTERN)
+                frontier.record_category(category_url, characters, categories)
+            categories_to_check = frontier.unchecked_categories()
+        return frontier.pages()
+
+    # %% Downloading
+
+    async def download_image(self, img_src: str, img_format: str, domain_name: str) -> bool:
+        """
+        Async version of download_image. The image is streamed into a temporary file as it arrives,
+        and only renamed to its path (or moved into the store) once all of it is there, so a crash
+        or a dropped connection never leaves a partial image behind.
+
+        An image that is already being downloaded is waited for instead of downloaded again.
+
+        Returns True if the image was downloaded, False if it was skipped.
+        """
+        if img_src is None:
+            return False
+        task = self._downloads.get(img_src)
+        if task is not None:
+            # Shielded so a cancelled waiter doesn't cancel the download for the others
+            await asyncio.shield(task)
+            return False
+        task = asyncio.ensure_future(self._download_image(img_src, img_format, domain_name))
+        self._downloads[img_src] = task
+        try:
+            return await task
+        finally:
+            del self._downloads[img_src]
+
+    async def _download_image(self, img_src: str, img_format: str, domain_name: str) -> bool:
+        if self.store is not None:
+            if self.store.lookup(img_src) is not None:
+                return False
+            tmp_dir = self.store.tmp_dir
+
+            def saved(meta: dict) -> bool:
+                # The store has no object for the url, or it would have been skipped above
+                return False
+        else:
+            # The folder only depends on the url, so the image can be written there before its format is known
+            tmp_dir = os.path.dirname(get_download_path(UNKNOWN_EXTENSION, domain_name, self.download_dir,
+                                                        img_src=img_src))
+
+            def saved(meta: dict) -> bool:
+                # Its name is the same in any download folder, only the folder may have changed
+                return bool(meta.get('path')) and os.path.exists(os.path.join(tmp_dir, os.path.basename(meta['path'])))
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'w+b') as tmp_file:
+                headers = await self.fetch(img_src, out=tmp_file, saved=saved)
+                # Downloaded by an earlier run and unchanged since
+                if headers is None:
+                    return False
+                tmp_file.seek(0)
+                header = tmp_file.read(16)
+            # The url doesn't say what the image is, its first bytes do
+            img_format = img_format or classify_image(header=header) or UNKNOWN_EXTENSION
+            if self.store is not None:
+                self.store.add_file(img_src, tmp_path, img_format, domain_name)
+                download_path = None
+            else:
+                # Named after the url, so this replaces an earlier download of the same url and nothing else
+                download_path = get_download_path(img_format, domain_name, self.download_dir, img_src=img_src)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, download_path)
+            if self.session is not None:
+                # Only once the image is in place, so an interrupted download isn't taken as done
+                self.session.cache.store(img_src, headers, path=download_path)
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def _try_download(self, abs_url: str, domain_name: str) -> None:
+        # May fail if there are no images in the page
+        try:
+            with METRICS.time_stage('image_download'):
+                downloaded = await self.download_image(abs_url, check_filetype(abs_url), domain_name)
+        except (httpx.HTTPStatusError, CacheMiss, ContentTooShortError):
+            METRICS.inc('fandom_images_total', result='failed')
+        except ValueError:
+            METRICS.inc('fandom_images_total', result='rejected')
+        else:
+            METRICS.inc('fandom_images_total', result='downloaded' if downloaded else 'unchanged')
+
+    async def collect_from_images_page(self, image_page: str, domain_name: str) -> None:
+        """
+        Async version of collect_from_images_page. Every image on the page is downloaded concurrently.
+        """
+        try:
+            image_urls = parse_image_urls(await self.fetch(image_page))
+        except (httpx.HTTPStatusError, CacheMiss, AttributeError):
+            return
+        await asyncio.gather(*[self._try_download(abs_url, domain_name) for abs_url in image_urls])
+        METRICS.inc('fandom_pages_total')
+
+    # %% Whole domain
+
+    async def get_one_domain(self, domain_base_link: str) -> None:
+        domain_name = get_domain_name(domain_base_link)
+        if self.state_path is None:
+            with METRICS.time_stage('category_discovery'):
+                domain_categories = await self.get_domain_categories(domain_base_link)
+                character_page_urls = await self.get_character_pages(domain_categories, domain_base_link)
+                all_character_pages = await self.gather_remaining_pages(character_page_urls, domain_base_link)
+            await asyncio.gather(*[self.collect_from_images_page(p, domain_name) for p in all_character_pages])
+            return
+
+        frontier = CrawlFrontier(domain_base_link, self.state_path)
+        try:
+            with METRICS.time_stage('category_discovery'):
+                if frontier.is_seeded():
+                    print("Resuming " + domain_base_link + " from the saved crawl state")
+                    character_page_urls = []
+                else:
+                    domain_categories = await self.get_domain_categories(domain_base_link)
+                    character_page_urls = await self.get_character_pages(domain_categories, domain_base_link)
+                await self.gather_remaining_pages(character_page_urls, domain_base_link, frontier)
+
+            async def collect_and_mark(image_page: str) -> None:
+                await self.collect_from_images_page(image_page, domain_name)
+                frontier.mark_page_done(image_page)
+
+            await asyncio.gather(*[collect_and_mark(p) for p in frontier.pending_pages()])
+            frontier.clear()
+        finally:
+            # A domain that failed keeps its state, to be resumed
+            frontier.close()
+
+
+async def crawl_domains(domains: Iterable[str], download_dir: str, concurrency: int = 32, per_host_limit: int = 8,
+                        on_domain_done: Callable[[str], None] = None, domain_workers: int = 1,
+                        state_path: str = None, store=None, session: CachedSession = None, min_size: int = None,
+                        max_size: int = None, throttle: HostThrottle = None) -> None:
+    """
+    Crawl domains with a shared AsyncDomainCrawler. domain_workers domains are crawled at the same
+    time, each worker taking the next domain once its current one is complete. on_domain_done
+    (ex. writing to collected_domains.csv) is only called once a domain is complete. A domain that
+    fails (ex. an error status, or a page without the expected category list) is skipped without
+    calling on_domain_done, so it is tried again on the next run. With a state_path, partly crawled
+    domains are resumed.
+    """
+    domains = iter(domains)
+
+    async def worker(crawler: AsyncDomainCrawler) -> None:
+        for domain_base_link in domains:
+            try:
+                await crawler.get_one_domain(domain_base_link)
+            except (AttributeError, httpx.HTTPStatusError, CacheMiss) as e:
+                print("Skipping " + domain_base_link + " after an error: " + repr(e))
+                continue
+            if on_domain_done is not None:
+                on_domain_done(domain_base_link)
+
+    async with AsyncDomainCrawler(download_dir, concurrency=concurrency, per_host_limit=per_host_limit,
+                                  state_path=state_path, store=store, session=session, min_size=min_size,
+                                  max_size=max_size, throttle=throttle) as crawler:
+        await asyncio.gather(*[worker(crawler) for _ in range(domain_workers)])
+
+
+async def discover_domains(search_terms: Iterable[str], known: Container[str] = (), pages_deep: int = 100,
+                           window: int = 4, max_window: int = 32,
+                           on_new_domains: Callable[[List[str]], None] = None, concurrency: int = 32,
+                           per_host_limit: int = 8, session: CachedSession = None,
+                           throttle: HostThrottle = None) -> Set[str]:
+    """
+    Search the fandom community search for every search term at the same time
+
+    Parameters
+    ----------
+    search_terms : Iterable[str]
+        Terms to search for. Ex. ['friends', 'jojo']
+    known : Container[str], optional
+        Domains that have already been found, ex. a domain_registry.DomainRegistry. They are never
+        passed to on_new_domains. Only membership is checked, so it is never copied.
+    pages_deep : int, optional
+        Search pages looked at per term at most. The default is 100.
+    window, max_window : int, optional
+        Search pages of a term requested at once at the start, and at most. See search_domains.
+    on_new_domains : Callable[[List[str]], None], optional
+        Called with the domains found on a search page that weren't known yet, as soon as that page
+        arrives. Ex. appending them to found_domains.csv. The default is None.
+    concurrency, per_host_limit, session, throttle
+        As for AsyncDomainCrawler.
+
+    Returns
+    -------
+    Set[str]
+        Every domain found by this search, known or not.
+
+    """
+    domain_names: Set[str] = set()
+
+    def merge(domains: List[str]) -> None:
+        new_domains = [d for d in dict.fromkeys(domains) if d not in domain_names and d not in known]
+        for d in new_domains:
+            print('Found a link to ' + d)
+        domain_names.update(new_domains)
+        if new_domains and on_new_domains is not None:
+            on_new_domains(new_domains)
+
+    # Nothing is downloaded, so the crawler needs no download folder
+    async with AsyncDomainCrawler(None, concurrency=concurrency, per_host_limit=per_host_limit, session=session,
+                                  throttle=throttle) as crawler:
+        await asyncio.gather(*[crawler.search_domains(t, pages_deep, window, max_window, on_page=merge)
+                               for t in search_terms])
+    return domain_names
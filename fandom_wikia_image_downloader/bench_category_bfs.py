@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the category search in gather_remaining_pages on a synthetic category graph.
+
+Each category links to two child categories (so every category is reachable from the top), to two
+random categories (back and cross links, like real wikis have) and to a few character pages. The
+same graph is walked by the old list based search and by walk_categories with both frontiers, and
+the time per category is printed for each size. A linear search keeps the time per category flat
+as the graph grows, the old search's grows with the graph.
+
+Run from the repo root: python -m fandom_wikia_image_downloader.bench_category_bfs
+"""
+import os
+import random
+import re
+import tempfile
+import time
+from typing import Dict, List
+
+from .crawl_state import CrawlFrontier, MemoryFrontier, walk_categories
+from .wikia_parsing import CATEGORY_PATTERN, sort_category_from_character
+
+
+DOMAIN = 'https://bench.fandom.com/'
+SIZES = [1000, 5000, 20000, 100000]
+# The old search is quadratic, so it is stopped at this size
+LEGACY_MAX_SIZE = 20000
+SQLITE_MAX_SIZE = 100000
+
+
+def make_category_graph(n_categories: int, pages_per_category: int = 3, seed: int = 0) -> Dict[str, List[str]]:
+    """Map each category url to the links on its page"""
+    rng = random.Random(seed)
+    category = [DOMAIN + 'wiki/Category:Characters_' + str(i) for i in range(n_categories)]
+    graph = {}
+    for i in range(n_categories):
+        links = [category[c] for c in (2 * i + 1, 2 * i + 2) if c < n_categories]
+        links += [category[rng.randrange(n_categories)] for _ in range(2)]
+        links += [DOMAIN + 'wiki/Character_' + str(rng.randrange(n_categories * pages_per_category))
+                  for _ in range(pages_per_category)]
+        links.append(DOMAIN + 'wiki/File:Image_' + str(i) + '.png')
+        graph[category[i]] = links
+    return graph
+
+
+def legacy_gather(character_page_urls: List[str], get_members) -> List[str]:
+    """The list based search gather_remaining_pages used before walk_categories"""
+    collected_pages = set()
+    categories_to_check = []
+    checked_categories = []
+    sorted_pages = list(sort_category_from_character(character_page_urls, CATEGORY_PATTERN))
+    for x in sorted_pages[0]:
+        collected_pages.add(x)
+    for y in sorted_pages[1]:
+        categories_to_check.append(y)
+    while len(categories_to_check) > 0:
+        category_url = categories_to_check.pop(0)
+        if category_url in checked_categories:
+            continue
+        elif re.match(CATEGORY_PATTERN, category_url) and category_url not in checked_categories:
+            characters, categories = sort_category_from_character(get_members(category_url), CATEGORY_PATTERN)
+            for char in characters:
+                collected_pages.add(char)
+            for cat in categories:
+                if cat not in checked_categories:
+                    categories_to_check.append(cat)
+        checked_categories.append(category_url)
+    return list(collected_pages)
+
+
+def time_run(name: str, n_categories: int, run) -> int:
+    start = time.perf_counter()
+    pages = run()
+    elapsed = time.perf_counter() - start
+    print('{:<8} {:>8} categories {:>9.3f} s {:>9.2f} us/category {:>8} pages'.format(
+        name, n_categories, elapsed, elapsed / n_categories * 1e6, len(pages)))
+    return len(pages)
+
+
+def main():
+    for n_categories in SIZES:
+        graph = make_category_graph(n_categories)
+        top = [DOMAIN + 'wiki/Category:Characters_0']
+        get_members = graph.__getitem__
+
+        found = {time_run('memory', n_categories, lambda: walk_categories(MemoryFrontier(), top, get_members))}
+        if n_categories <= SQLITE_MAX_SIZE:
+            with tempfile.TemporaryDirectory() as tmp:
+                frontier = CrawlFrontier(DOMAIN, os.path.join(tmp, 'crawl_state.db'))
+                found.add(time_run('sqlite', n_categories, lambda: walk_categories(frontier, top, get_members)))
+                frontier.close()
+        if n_categories <= LEGACY_MAX_SIZE:
+            found.add(time_run('legacy', n_categories, lambda: legacy_gather(top, get_members)))
+        # Every search has to find the same pages
+        assert len(found) == 1, found
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Parse throughput of each parser backend over a corpus of saved fandom pages.
+
+Every page is run through parse_category_members and parse_image_urls, the two parsers that run
+on every category and character page of a crawl. The old find_all + regex version running on
+html.parser is timed too as the baseline, and every backend has to find the same links as
+html.parser.
+
+The corpus is a folder of saved pages: either the http cache of a previous crawl (*.body files) or
+any folder of *.html files.
+
+Run from the repo root: python -m fandom_wikia_image_downloader.bench_parsers [corpus folder, default the crawl's
+http_cache] [repeats, default 3]
+"""
+import os
+import re
+import sys
+import time
+from importlib.util import find_spec
+from typing import List
+
+from bs4 import BeautifulSoup
+
+from . import wikia_parsing
+from .wikia_parsing import PARSER_BACKENDS, parse_category_members, parse_image_urls, set_parser_backend
+
+
+DOMAIN = 'https://bench.fandom.com/'
+
+
+def load_corpus(corpus_dir: str) -> List[bytes]:
+    pages = []
+    for root, _, files in os.walk(corpus_dir):
+        for name in files:
+            if name.endswith(('.body', '.html', '.htm')):
+                with open(os.path.join(root, name), 'rb') as page:
+                    pages.append(page.read())
+    return pages
+
+
+def legacy_parse(html: bytes):
+    """parse_category_members and parse_image_urls as they were before the selector rewrite"""
+    members = images = None
+    soup = BeautifulSoup(html, 'html.parser')
+    try:
+        characters_block = soup.find('div', {'class': 'category-page__members'})
+        character_page_links = characters_block.find_all('a', {'href': re.compile('/wiki/.*'), 'class': re.compile('category-page__member-.*')})
+        members = [DOMAIN + x['href'] for x in character_page_links]
+    except AttributeError:
+        pass
+    # Each page used to be parsed again by every function that looked at it
+    soup = BeautifulSoup(html, 'html.parser')
+    try:
+        soup.find('h1', {'class': 'page-header__title'}).get_text()
+        l1 = soup.find('div', {'id': 'WikiaArticle'})
+        if l1 is None:
+            l1 = soup.find('div', {'class': 'WikiaArticle'})
+        l2 = l1.find_all('img', {'src': re.compile(r'.*\.(png|jpe?g|bmp).*', re.IGNORECASE)})
+        images = [re.sub(r'latest/.*\?cb', 'latest/?cb', tag['src']) for tag in l2]
+    except AttributeError:
+        pass
+    return members, images
+
+
+def backend_parse(html: bytes):
+    members = images = None
+    try:
+        members = parse_category_members(html, DOMAIN)
+    except AttributeError:
+        pass
+    try:
+        images = parse_image_urls(html)
+    except AttributeError:
+        pass
+    return members, images
+
+
+def time_backend(name: str, parse, pages: List[bytes], repeats: int):
+    results = [parse(html) for html in pages]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for html in pages:
+            parse(html)
+    elapsed = time.perf_counter() - start
+    print('{:<12} {:>10.1f} pages/s'.format(name, len(pages) * repeats / elapsed))
+    return results
+
+
+def main():
+    corpus_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'http_cache')
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    pages = load_corpus(corpus_dir)
+    if not pages:
+        print('No saved pages found in ' + corpus_dir)
+        return
+    print(str(len(pages)) + ' pages from ' + corpus_dir + ', ' + str(repeats) + ' repeats')
+
+    default_backend = wikia_parsing.get_parser_backend()
+    time_backend('legacy', legacy_parse, pages, repeats)
+    # The image urls are canonicalized now, so the backends are checked against html.parser
+    expected = None
+    for backend in PARSER_BACKENDS:
+        if backend != 'html.parser' and not find_spec(backend):
+            print('{:<12} not installed'.format(backend))
+            continue
+        set_parser_backend(backend)
+        results = time_backend(backend, backend_parse, pages, repeats)
+        if expected is None:
+            expected = results
+            continue
+        mismatches = sum(1 for got, want in zip(results, expected) if got != want)
+        if mismatches:
+            print('{:<12} differs from html.parser on {} pages'.format(backend, mismatches))
+    set_parser_backend(default_backend)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Crawl state for a single fandom domain.
+
+CrawlFrontier keeps the category frontier, the checked categories, the character pages found so far
+and the pages whose images have been downloaded in a SQLite database, updated as the crawl runs. If
+a run dies partway through a domain, the next run picks the domain back up where it stopped instead
+of starting it over. MemoryFrontier has the same interface for crawls that don't need to resume.
+
+Both only do constant time work per category, so walk_categories stays linear in the size of the
+category graph. See bench_category_bfs.py.
+"""
+import sqlite3
+from collections import deque
+from typing import Callable, Deque, Iterable, List, Optional, Set
+
+from .wikia_parsing import CATEGORY_PATTERN, sort_category_from_character
+
+
+class CrawlFrontier:
+    """
+    Resumable crawl state of one domain
+
+    Parameters
+    ----------
+    domain_base_link : str
+        The full url of the main page for a domain. Ex. 'https://llama.fandom.com/'
+    state_path : str, optional
+        SQLite file shared by all domains. The default is 'crawl_state.db'.
+
+    """
+
+    def __init__(self, domain_base_link: str, state_path: str = 'crawl_state.db'):
+        self.domain = domain_base_link
+        self.state_path = state_path
+        # Several domain workers may share the file, so wait on locks instead of failing
+        self.con = sqlite3.connect(state_path, timeout=60)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS domains (domain TEXT PRIMARY KEY)')
+            self.con.execute('CREATE TABLE IF NOT EXISTS categories '
+                             '(domain TEXT, url TEXT, checked INTEGER DEFAULT 0, PRIMARY KEY (domain, url))')
+            # Lets next_category find the oldest unchecked category without scanning the checked ones
+            self.con.execute('CREATE INDEX IF NOT EXISTS unchecked_categories ON categories (domain, checked)')
+            self.con.execute('CREATE TABLE IF NOT EXISTS pages '
+                             '(domain TEXT, url TEXT, done INTEGER DEFAULT 0, PRIMARY KEY (domain, url))')
+
+    def close(self) -> None:
+        self.con.close()
+
+    def is_seeded(self) -> bool:
+        """True once the domain's starting pages have been stored, ie. the domain can be resumed"""
+        row = self.con.execute('SELECT 1 FROM domains WHERE domain = ?', (self.domain,)).fetchone()
+        return row is not None
+
+    def seed(self, character_page_urls: Iterable[str]) -> None:
+        """Store the first character and category links found for the domain"""
+        characters, categories = sort_category_from_character(character_page_urls, CATEGORY_PATTERN)
+        with self.con:
+            self._add(characters, categories)
+            self.con.execute('INSERT OR IGNORE INTO domains VALUES (?)', (self.domain,))
+
+    def _add(self, characters: Iterable[str], categories: Iterable[str]) -> None:
+        self.con.executemany('INSERT OR IGNORE INTO pages (domain, url) VALUES (?, ?)',
+                             ((self.domain, url) for url in characters))
+        self.con.executemany('INSERT OR IGNORE INTO categories (domain, url) VALUES (?, ?)',
+                             ((self.domain, url) for url in categories))
+
+    def next_category(self) -> Optional[str]:
+        """The oldest category that has not been checked yet, or None when the frontier is empty"""
+        row = self.con.execute('SELECT url FROM categories WHERE domain = ? AND checked = 0 ORDER BY rowid LIMIT 1',
+                               (self.domain,)).fetchone()
+        return row[0] if row else None
+
+    def unchecked_categories(self) -> List[str]:
+        return [row[0] for row in self.con.execute(
+            'SELECT url FROM categories WHERE domain = ? AND checked = 0 ORDER BY rowid', (self.domain,))]
+
+    def record_category(self, category_url: str, characters: Iterable[str], categories: Iterable[str]) -> None:
+        """
+        Save what was found on a category page and mark it checked, in one transaction so a crash
+        can't mark a category checked without keeping its links
+        """
+        with self.con:
+            self._add(characters, categories)
+            self.con.execute('UPDATE categories SET checked = 1 WHERE domain = ? AND url = ?',
+                             (self.domain, category_url))
+
+    def pages(self) -> List[str]:
+        """Every character page found for the domain so far"""
+        return [row[0] for row in self.con.execute('SELECT url FROM pages WHERE domain = ?', (self.domain,))]
+
+    def pending_pages(self) -> List[str]:
+        """Character pages whose images have not been downloaded yet"""
+        return [row[0] for row in self.con.execute('SELECT url FROM pages WHERE domain = ? AND done = 0',
+                                                   (self.domain,))]
+
+    def mark_page_done(self, page_url: str) -> None:
+        with self.con:
+            self.con.execute('UPDATE pages SET done = 1 WHERE domain = ? AND url = ?', (self.domain, page_url))
+
+    def clear(self) -> None:
+        """Forget the domain once it has been fully collected"""
+        with self.con:
+            for table in ('domains', 'categories', 'pages'):
+                self.con.execute('DELETE FROM ' + table + ' WHERE domain = ?', (self.domain,))
+
+
+class MemoryFrontier:
+    """
+    In-memory crawl state of one domain, with the same interface as CrawlFrontier.
+
+    The frontier is a deque and everything that has been queued is kept in a set, so each category is
+    queued at most once and every check is constant time.
+    """
+
+    def __init__(self):
+        self._seeded = False
+        self._to_check: Deque[str] = deque()
+        self._queued: Set[str] = set()
+        self._pages: Set[str] = set()
+        self._done: Set[str] = set()
+
+    def close(self) -> None:
+        pass
+
+    def is_seeded(self) -> bool:
+        return self._seeded
+
+    def seed(self, character_page_urls: Iterable[str]) -> None:
+        characters, categories = sort_category_from_character(character_page_urls, CATEGORY_PATTERN)
+        self._add(characters, categories)
+        self._seeded = True
+
+    def _add(self, characters: Iterable[str], categories: Iterable[str]) -> None:
+        self._pages.update(characters)
+        for url in categories:
+            if url not in self._queued:
+                self._queued.add(url)
+                self._to_check.append(url)
+
+    def next_category(self) -> Optional[str]:
+        return self._to_check[0] if self._to_check else None
+
+    def unchecked_categories(self) -> List[str]:
+        return list(self._to_check)
+
+    def record_category(self, category_url: str, characters: Iterable[str], categories: Iterable[str]) -> None:
+        # Categories are almost always recorded in the order they were handed out
+        if self._to_check and self._to_check[0] == category_url:
+            self._to_check.popleft()
+        else:
+            self._to_check.remove(category_url)
+        self._add(characters, categories)
+
+    def pages(self) -> List[str]:
+        return list(self._pages)
+
+    def pending_pages(self) -> List[str]:
+        return [url for url in self._pages if url not in self._done]
+
+    def mark_page_done(self, page_url: str) -> None:
+        self._done.add(page_url)
+
+    def clear(self) -> None:
+        self.__init__()
+
+
+def walk_categories(frontier, character_page_urls: Iterable[str],
+                    get_members: Callable[[str], Iterable[str]]) -> List[str]:
+    """
+    Breadth first search of a domain's category graph
+
+    Parameters
+    ----------
+    frontier : CrawlFrontier or MemoryFrontier
+        Where the search keeps its state. A frontier that was already seeded continues where it stopped.
+    character_page_urls : Iterable[str]
+        The character and category links found on the domain's top level categories.
+    get_members : Callable[[str], Iterable[str]]
+        Returns the links on a category page. Ex. lambda c: get_character_pages([c], domain_base_link)
+
+    Returns
+    -------
+    List[str]
+        Every character page found.
+
+    """
+    if not frontier.is_seeded():
+        frontier.seed(character_page_urls)
+    category_url = frontier.next_category()
+    while category_url is not None:
+        characters, categories = sort_category_from_character(get_members(category_url), CATEGORY_PATTERN)
+        frontier.record_category(category_url, characters, categories)
+        category_url = frontier.next_category()
+    return frontier.pages()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Spread the domains of a fandom crawl across a pool of workers.
+
+Every domain is independent, so each worker takes the next domain off the pool's shared queue and
+crawls all of it. Workers never touch collected_domains.csv themselves: finished domains are
+reported back to the process running the pool, which is the only writer of that file.
+"""
+import csv
+import io
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Callable, Iterable
+
+
+_collected_lock = threading.Lock()
+
+
+def append_domains(domain_links: Iterable[str], csv_path: str) -> None:
+    """
+    Append domains to a one-domain-per-line csv file (collected_domains.csv, found_domains.csv) as a
+    single write.
+
+    The rows are built in memory and written with one os.write on a file opened with O_APPEND, then
+    flushed to disk, so an interrupted run or a second writer can never leave half a line behind.
+    """
+    rows = io.StringIO()
+    csv.writer(rows, delimiter=',').writerows([link] for link in domain_links)
+    if not rows.getvalue():
+        return
+    with _collected_lock:
+        fd = os.open(csv_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, rows.getvalue().encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def append_collected_domain(domain_base_link: str, collected_path: str = 'collected_domains.csv') -> None:
+    """Append one finished domain to collected_domains.csv, see append_domains"""
+    append_domains([domain_base_link], collected_path)
+
+
+def run_domain_pool(domains: Iterable[str], crawl_domain: Callable[[str], None], workers: int = 4,
+                    use_processes: bool = False,
+                    on_domain_done: Callable[[str], None] = append_collected_domain, initializer: Callable = None,
+                    initargs: tuple = ()) -> None:
+    """
+    Crawl domains with a pool of workers
+
+    Parameters
+    ----------
+    domains : Iterable[str]
+        Domain base links to crawl. Ex. ['https://llama.fandom.com/']
+    crawl_domain : Callable[[str], None]
+        Crawls a single domain without recording it as collected. With use_processes it has to be
+        a module level function of a module that can be imported without starting a crawl.
+    workers : int, optional
+        Number of domains crawled at the same time. The default is 4.
+    use_processes : bool, optional
+        Use a process pool instead of a thread pool. Crawling is mostly waiting on the network, so
+        threads are usually enough. The default is False.
+    on_domain_done : Callable[[str], None], optional
+        Called in this process once a domain has finished. The default appends it to
+        collected_domains.csv.
+    initializer, initargs : optional
+        Called as initializer(*initargs) at the start of every worker, ex. to apply the same settings
+        in worker processes that the parent has.
+
+    Returns
+    -------
+    None.
+
+    """
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    domains = iter(domains)
+    with executor_class(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        # Only keep a couple of domains queued per worker, so a huge domain list isn't all submitted at once
+        running = {}
+        for domain_base_link in domains:
+            running[executor.submit(crawl_domain, domain_base_link)] = domain_base_link
+            if len(running) < workers * 2:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            _finish(done, running, on_domain_done)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            _finish(done, running, on_domain_done)
+
+
+def _finish(done, running, on_domain_done) -> None:
+    for future in done:
+        domain_base_link = running.pop(future)
+        try:
+            future.result()
+        except Exception as e:
+            # Leave the domain out of collected_domains.csv so it is crawled again next run
+            print('Failed to collect ' + domain_base_link + ': ' + repr(e))
+            continue
+        print('Finished collecting ' + domain_base_link)
+        on_domain_done(domain_base_link)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Index of every domain found and collected, kept in SQLite.
+
+found_domains.csv and collected_domains.csv stay the append-only record of the crawl, but nothing
+reads them top to bottom anymore. The registry remembers how many bytes of each csv it has already
+loaded, and only reads the lines added after that, so a restart costs as much as the lines written
+since the last run, not the size of the files. Membership tests and "found but not collected yet"
+are answered from the index.
+"""
+import csv
+import os
+import sqlite3
+import threading
+from typing import Iterable, List, Optional
+
+
+class DomainRegistry:
+    """
+    Found and collected domains
+
+    Parameters
+    ----------
+    db_path : str
+        SQLite file the index is kept in. Created if it does not exist.
+    found_csv, collected_csv : str, optional
+        found_domains.csv and collected_domains.csv. Lines added to them since the last time are
+        loaded into the index when the registry is opened, and by sync.
+
+    """
+
+    def __init__(self, db_path: str, found_csv: str = None, collected_csv: str = None):
+        self.found_csv = found_csv
+        self.collected_csv = collected_csv
+        # Domains are marked collected from the domain worker threads
+        self._lock = threading.Lock()
+        self.con = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS domains (url TEXT PRIMARY KEY, collected INTEGER NOT NULL DEFAULT 0)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS uncollected_domains ON domains (url) WHERE collected = 0')
+            self.con.execute('CREATE TABLE IF NOT EXISTS csv_offsets (path TEXT PRIMARY KEY, offset INTEGER)')
+        self.sync()
+
+    def close(self) -> None:
+        self.con.close()
+
+    def sync(self) -> None:
+        """Load the lines added to found_csv and collected_csv since they were last loaded"""
+        if self.found_csv is not None:
+            self._load_csv(self.found_csv, collected=False)
+        if self.collected_csv is not None:
+            self._load_csv(self.collected_csv, collected=True)
+
+    def _load_csv(self, path: str, collected: bool) -> None:
+        if not os.path.exists(path):
+            return
+        key = os.path.abspath(path)
+        with self._lock:
+            row = self.con.execute('SELECT offset FROM csv_offsets WHERE path = ?', (key,)).fetchone()
+            offset = row[0] if row else 0
+            if os.path.getsize(path) < offset:
+                # The file was replaced with a shorter one, load all of it again
+                offset = 0
+            with open(path, 'rb') as csv_file, self.con:
+                csv_file.seek(offset)
+                for line in csv_file:
+                    # A line still being written is left for next time
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    link = _parse_line(line)
+                    if link:
+                        self._add(link, collected)
+                self.con.execute('INSERT OR REPLACE INTO csv_offsets VALUES (?, ?)', (key, offset))
+
+    def _add(self, link: str, collected: bool) -> bool:
+        inserted = self.con.execute('INSERT OR IGNORE INTO domains VALUES (?, ?)', (link, int(collected))).rowcount
+        if collected and not inserted:
+            self.con.execute('UPDATE domains SET collected = 1 WHERE url = ?', (link,))
+        return bool(inserted)
+
+    def add_found(self, domain_links: Iterable[str]) -> List[str]:
+        """Add domains to the index and return the ones that weren't in it yet, in order"""
+        new_domains = []
+        with self._lock, self.con:
+            for link in dict.fromkeys(domain_links):
+                if self._add(link, collected=False):
+                    new_domains.append(link)
+        return new_domains
+
+    def mark_collected(self, domain_link: str) -> None:
+        with self._lock, self.con:
+            self._add(domain_link, collected=True)
+
+    def __contains__(self, domain_link: str) -> bool:
+        with self._lock:
+            return self.con.execute('SELECT 1 FROM domains WHERE url = ?', (domain_link,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.con.execute('SELECT COUNT(*) FROM domains').fetchone()[0]
+
+    def is_collected(self, domain_link: str) -> bool:
+        with self._lock:
+            row = self.con.execute('SELECT collected FROM domains WHERE url = ?', (domain_link,)).fetchone()
+        return bool(row and row[0])
+
+    def found(self) -> List[str]:
+        """Every domain found, collected or not"""
+        with self._lock:
+            return [url for url, in self.con.execute('SELECT url FROM domains')]
+
+    def uncollected(self, domain_links: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        The domains that haven't been collected yet: all of them, or only the ones in domain_links
+        (keeping their order)
+        """
+        with self._lock:
+            if domain_links is None:
+                return [url for url, in self.con.execute('SELECT url FROM domains WHERE collected = 0')]
+            # One indexed lookup per domain instead of rescanning the collected list for each one
+            lookup = 'SELECT 1 FROM domains WHERE url = ? AND collected = 1'
+            return [link for link in domain_links if self.con.execute(lookup, (link,)).fetchone() is None]
+
+
+def _parse_line(line: bytes) -> Optional[str]:
+    text = line.decode('utf-8', errors='replace').strip()
+    if not text:
+        return None
+    # The domain is the first field, quoted if the csv writer had to
+    return next(csv.reader([text]))[0] if text.startswith('"') else text.split(',')[0]
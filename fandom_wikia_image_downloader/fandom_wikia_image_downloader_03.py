@@ -2,58 +2,214 @@
 # %% Imports
 
 import os
-import csv
-from typing import List, Set
-from urllib.request import urlopen, urlretrieve
-from urllib.error import HTTPError, URLError
-import re
-from bs4 import BeautifulSoup, ResultSet
-import datetime
-import time
+import argparse
+import asyncio
+from typing import Iterable, List
+from urllib.error import HTTPError
+import functools
+import threading
 from retry import retry
-import json
 
-# These modules used for developing and testing. They can be deleted in the final version
-from pprint import pprint  # To more easily read the BeautifulSoup object
-import random  # To get random samples
+from .web_scraping_tools import check_filetype, download_image
+from .wikia_parsing import (CATEGORY_TOPICS, PARSER_BACKENDS, categories_search_url, community_search_url,
+                            get_domain_name, parse_category_members, parse_domain_categories, parse_image_urls,
+                            parse_search_results, set_parser_backend)
+from .domain_pool import append_collected_domain, append_domains, run_domain_pool
+from .domain_registry import DomainRegistry
+from .crawl_state import CrawlFrontier, MemoryFrontier, walk_categories
+from .http_cache import CacheMiss, CachedSession
+from .throttle import HostThrottle
+from .telemetry import METRICS, MetricsExporter
 
-from web_scraping_tools import download_image
 
 
-
-# %%
+# %% Settings
+"""
+Default settings. Importing this module doesn't touch the disk or the network: the settings are
+applied with configure (or the command line, see main), and the http session, throttle and content
+store are only built the first time they are needed.
+"""
 DOWNLOAD_DIR = 'C://Users//Elias//Desktop//fandom_wikia_image_downloader//images'
-if not os.path.exists(DOWNLOAD_DIR):
-    os.mkdir(DOWNLOAD_DIR)
+
+# found_domains.csv, collected_domains.csv, the crawl state and the http cache are kept here
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+# Index of found_domains.csv and collected_domains.csv, so restarts don't have to read them again
+DOMAIN_REGISTRY_PATH = 'domains.db'
 
 search_new = False
 
 search_terms = ['friends']
 
+# Crawl with the asyncio engine in async_crawler.py instead of one request at a time
+use_async = False
+# Maximum requests in flight in total, and to any one host, when use_async is True
+async_concurrency = 32
+async_per_host_limit = 8
+
+# Number of domains crawled at the same time, and whether to use processes instead of threads for them.
+domain_workers = 1
+use_processes = False
+
+# Keep each domain's crawl progress on disk so a crashed run resumes partway through the domain
+save_crawl_state = True
+CRAWL_STATE_PATH = 'crawl_state.db'
+
+# Store each image once under the hash of its content, and skip image urls that were already downloaded.
+# CONTENT_STORE_DIR defaults to a 'store' folder in DOWNLOAD_DIR.
+use_content_store = False
+CONTENT_STORE_DIR = None
+
+# Pages and image validators are cached here, and reruns send conditional GETs for anything cached.
+# http_cache_ttl (seconds) skips the request for anything cached more recently than that, and
+# offline_replay only reads from the cache, to rerun the parsing against an earlier crawl.
+HTTP_CACHE_DIR = 'http_cache'
+http_cache_ttl = None
+offline_replay = False
+
+# Images smaller or larger than these sizes in bytes are skipped, ex. 2 * 1024 to skip icons.
+# They are rejected as soon as the Content-Length (or the download so far) shows it. None is no limit.
+min_image_size = None
+max_image_size = None
+
+# Requests per second sent to each host at the start. Each host's rate then adapts to the server: it
+# creeps up while requests succeed (up to max_requests_per_second) and halves on every 429 or 503.
+requests_per_second = 2
+max_requests_per_second = 20
+
+# Html parser: 'html.parser', 'lxml' or 'selectolax'. None keeps the default, the fastest one installed
+parser_backend = None
+
+# Every metrics_interval seconds while run() is going, the crawl's timings, bytes, images per second and
+# error counts are written to these files, as JSON and in the Prometheus text format. None turns it off.
+metrics_interval = 30
+METRICS_JSON_PATH = 'metrics.json'
+METRICS_PROM_PATH = 'metrics.prom'
+
+# After the crawl, images whose perceptual hashes differ in at most near_duplicate_distance bits are
+# linked to the biggest copy in NEAR_DUPLICATES_PATH (or deleted, with drop_near_duplicates). None skips
+# it. Needs numpy and Pillow, see near_duplicates.py.
+near_duplicate_distance = None
+drop_near_duplicates = False
+NEAR_DUPLICATES_PATH = 'near_duplicates.db'
+
 #used_search_terms = ['touhou', 'jojo']
 
+SETTINGS = ('DOWNLOAD_DIR', 'DATA_DIR', 'DOMAIN_REGISTRY_PATH', 'search_new', 'search_terms', 'use_async', 'async_concurrency',
+            'async_per_host_limit', 'domain_workers', 'use_processes', 'save_crawl_state', 'CRAWL_STATE_PATH',
+            'use_content_store', 'CONTENT_STORE_DIR', 'HTTP_CACHE_DIR', 'http_cache_ttl', 'offline_replay',
+            'min_image_size', 'max_image_size', 'requests_per_second', 'max_requests_per_second',
+            'parser_backend', 'metrics_interval', 'METRICS_JSON_PATH', 'METRICS_PROM_PATH',
+            'near_duplicate_distance', 'drop_near_duplicates', 'NEAR_DUPLICATES_PATH')
+
+# Built from the settings the first time they are used, by whichever domain worker thread gets there first
+_build_lock = threading.RLock()
+_throttle = None
+_http_session = None
+_content_store = None
+_registry = None
+
+
+def configure(**settings):
+    """
+    Change any of the settings in SETTINGS, ex. configure(DOWNLOAD_DIR='images', use_async=True).
+    The http session, throttle and content store are rebuilt with the new settings when next used.
+    """
+    global _throttle, _http_session, _content_store, _registry
+    unknown = set(settings) - set(SETTINGS)
+    if unknown:
+        raise TypeError('Unknown settings: ' + ', '.join(sorted(unknown)))
+    globals().update(settings)
+    if parser_backend:
+        set_parser_backend(parser_backend)
+    if _http_session is not None:
+        _http_session.close()
+    if _content_store is not None:
+        _content_store.close()
+    if _registry is not None:
+        _registry.close()
+    _throttle = _http_session = _content_store = _registry = None
+
+
+def current_settings() -> dict:
+    """The current value of every setting, ex. to configure worker processes the same way"""
+    return {name: globals()[name] for name in SETTINGS}
+
+
+def data_path(path: str) -> str:
+    """path inside DATA_DIR, unless path is already absolute"""
+    return os.path.join(DATA_DIR, path)
+
+
+def get_throttle() -> HostThrottle:
+    global _throttle
+    with _build_lock:
+        if _throttle is None:
+            _throttle = HostThrottle(rate=requests_per_second, max_rate=max_requests_per_second)
+        return _throttle
+
+
+def get_session() -> CachedSession:
+    global _http_session
+    with _build_lock:
+        if _http_session is None:
+            _http_session = CachedSession(data_path(HTTP_CACHE_DIR), ttl=http_cache_ttl, offline=offline_replay,
+                                          min_size=min_image_size, max_size=max_image_size, throttle=get_throttle())
+        return _http_session
+
+
+def get_content_store():
+    """The ContentStore images are saved in, or None if use_content_store is off"""
+    global _content_store
+    with _build_lock:
+        if _content_store is None and use_content_store:
+            from .image_store import ContentStore
+            _content_store = ContentStore(CONTENT_STORE_DIR or os.path.join(DOWNLOAD_DIR, 'store'))
+        return _content_store
+
+
+def get_registry() -> DomainRegistry:
+    """The index of found and collected domains, brought up to date with the csv files"""
+    global _registry
+    with _build_lock:
+        if _registry is None:
+            _registry = DomainRegistry(data_path(DOMAIN_REGISTRY_PATH), found_csv=data_path('found_domains.csv'),
+                                       collected_csv=data_path('collected_domains.csv'))
+        return _registry
+
+
+def state_path():
+    """The crawl state file, or None if save_crawl_state is off"""
+    return data_path(CRAWL_STATE_PATH) if save_crawl_state else None
+
 
 # %% Safety and recovery
 
 """
 Confirm that a connection to domain wikia exists.
-If the connection goes down, wait 60 seconds and ping again. Continue until a connection works again
+If the connection goes down, keep trying again until a connection works again. The wait starts at
+RETRY_DELAY seconds and doubles each time, plus up to a second of jitter, up to RETRY_MAX_DELAY.
+Single failed requests are already retried by the throttle, so this only kicks in for longer outages.
+Pages missing from the offline cache (CacheMiss) are caught and skipped where they are fetched,
+since no retry can bring them back.
 Only change here from the 'retry' decorator is that I wanted it to say something when it needed to retry
 
 """
-    
-def retry_connection(func, *args, **kwargs):
-    try:
-        @retry(exceptions=Exception, tries=-1, delay=60)
-        def wrapped(*args, **kwargs):
-                response = func(*args, **kwargs)
-                return response
-    except Exception:
-        print("Internet issue. Trying again until the internet issue is resolved")
-        @retry(exceptions=Exception, tries=-1, delay=60)
-        def wrapped(*args, **kwargs):
-                response = func(*args, **kwargs)
-                return response
+RETRY_DELAY = 5
+RETRY_MAX_DELAY = 600
+
+
+class _RetryLogger:
+    @staticmethod
+    def warning(fmt, error, delay):
+        print("Internet issue (" + str(error) + "). Trying again in " + str(round(delay)) + " seconds")
+
+
+def retry_connection(func):
+    @functools.wraps(func)
+    @retry(exceptions=Exception, tries=-1, delay=RETRY_DELAY, max_delay=RETRY_MAX_DELAY, backoff=2, jitter=(0, 1),
+           logger=_RetryLogger)
+    def wrapped(*args, **kwargs):
+        return func(*args, **kwargs)
     return wrapped
 
 # %% Retrieve domains
@@ -71,86 +227,75 @@ def retrieve_domain_names(search_terms_list: List[str] = ['anime'], pages_deep:
         An integer representing how many pages deep to search. The default is 100, but will stop
         if no pages are found
 
+    New domains are appended to found_domains.csv as each search page comes in, so an interrupted
+    search keeps what it found. With use_async, every search term is searched at the same time
+    with discover_domains.
+
 
     Returns
     -------
-    set()
-        All wikias found under the domain domain.
+    List[str]
+        All wikias found under the domain domain, by this search or earlier ones.
 
     """
-    domain_names: set = set()
+    # Everything in previous domain page lists is already in the registry
+    registry = get_registry()
 
-    # Read everything in a previous domain page list
-    if os.path.exists('found_domains.csv'):
-        with open('found_domains.csv', mode='r') as pages:
-            reader = csv.reader(pages, delimiter='\n')
-            for line in reader:
-                if line:
-                    domain_names.add(str(line[0]))
-            pages.close()
+    def save_new_domains(domains: List[str]):
+        # Another worker may have found some of them in the meantime
+        domains = registry.add_found(domains)
+        append_domains(domains, data_path('found_domains.csv'))
 
     # Find new pages
-    if search_new == True:
+    if search_new == True and use_async:
+        from .async_crawler import discover_domains
+        asyncio.run(discover_domains(search_terms_list, known=registry, pages_deep=pages_deep,
+                                                    on_new_domains=save_new_domains,
+                                                    concurrency=async_concurrency,
+                                                    per_host_limit=async_per_host_limit, session=get_session(),
+                                                    throttle=get_throttle()))
+    elif search_new == True:
         for search_term in search_terms_list:
             search_term = search_term.replace(" ", "_")
             for pagenum in range(1, pages_deep):
                 print('Opening page ' + str(pagenum) + ' on domain wikia for search term: ' + search_term)
-                # If no domains are found, try changing the url being opened below to "https://community-search.fandom.com/wiki/Special:Search?search="
-                anime_search_page: urlopen = urlopen('https://ucp.fandom.com/wiki/Special:SearchCommunity?query=' + search_term + '&page=' + str(pagenum))
-                anime_search_soup: BeautifulSoup = BeautifulSoup(anime_search_page, 'html.parser')
-                domains: ResultSet = anime_search_soup.find_all('a', {'href': re.compile('https://((?!www|community-search|anime-database).)*\.fandom\.com/$'), 'class': 'result-link'})
+                try:
+                    domains = parse_search_results(get_session().get(community_search_url(search_term, pagenum)))
+                except CacheMiss:
+                    # Offline and never cached, so retrying can't help. Treated like the end of the results
+                    print("Search page " + str(pagenum) + " for '" + search_term + "' is not in the offline cache")
+                    domains = []
                 if len(domains) == 0:
                     print("domain page for search '" + search_term + "' ended at page " + str(pagenum))
                     break
-                for link in domains:
-                    print('Found a link to ' + str(link.getText()))
-                    domain_names.add(link['href'])
-    # Save domains to file
-    with open('found_domains.csv', mode='w') as found_pages:
-        writer = csv.writer(found_pages, delimiter="\n")
-        writer.writerow(page for page in domain_names)
+                new_domains = [d for d in dict.fromkeys(domains) if d not in registry]
+                for link in new_domains:
+                    print('Found a link to ' + link)
+                save_new_domains(new_domains)
     print("All found domain links added")
 
-    return domain_names
-
-# Get the domain addresses
-domain_list = retrieve_domain_names(search_terms, pages_deep=100, search_new=search_new)
-# sample_domain_list = random.sample(domain_list, 10)
+    return registry.found()
 
-def filter_used_domains(domains_list: List[str]):
+def filter_used_domains(domains_list: Iterable[str]) -> List[str]:
     """
-    Reads the domains in collected_domains and removes each of them from search_terms_list
+    Leave out the domains in collected_domains.csv, keeping the order of domains_list
+
+    Each domain is looked up in the registry's index once, so this is linear in the number of
+    domains instead of checking every collected domain against the whole list.
 
     Returns
     -------
-    None.
+    List[str]
+        The domains that haven't been collected yet.
 
     """
-    if not os.path.exists('collected_domains.csv'):
-        with open('collected_domains.csv', mode='w'):
-            pass
-    with open('collected_domains.csv', mode='r') as cd:
-        reader = csv.reader(cd, delimiter='\n')
-        for row in reader:
-            if row:
-                if row[0] in domains_list:
-                    domains_list.remove(row[0])
-        return domains_list
-
-# Filter to the domains that have already been searched (collected_domains.csv)
-domain_list = filter_used_domains(domain_list)
+    return get_registry().uncollected(domains_list)
 
 
 # %% Collect and download from page
 
 # To download from a character or gallery page, call the collect_from_images_page function
 
-def check_filetype(absolute_url: str):
-    formats = ['png', 'jpg', 'jpeg', 'bmp']
-    for fmt in formats:
-        if re.match('.*\.' + fmt, absolute_url, re.IGNORECASE):
-            return fmt
-
 @retry_connection
 def collect_from_images_page(image_page: str, domain_name:str):
     """
@@ -169,29 +314,27 @@ def collect_from_images_page(image_page: str, domain_name:str):
     # Will fail if the url does not exist. Not sure how it gets bad urls yet but it has happened
     # AttributeError is for if there isn't an image in the normal spot
     try:
-        html: urlopen = urlopen(image_page)
-        soup = BeautifulSoup(html, 'html.parser')
-        page_name = soup.find('h1', {'class': 'page-header__title'}).get_text()
+        html: bytes = get_session().get(image_page)
+        l3 = parse_image_urls(html)
     except (HTTPError, AttributeError):
         return
-    # Wiki article block (so not all the borders and website headers and stuff. Just the article)
-    l1 = soup.find('div', {'id':'WikiaArticle'})
-    if l1 is None:
-        l1 = soup.find('div', {'class':'WikiaArticle'})
-    # All the tags where there is an image source with a png, a jpg, a jpeg, or a bmp image
-    l2 = l1.find_all('img', {'src':re.compile('.*\.(png|jpe?g|bmp).*', re.IGNORECASE)})
-    # The absolute url where the image is
-    l3 = [tag['src'] for tag in l2]
-    for scale in l3:
-        l3[l3.index(scale)] = re.sub('latest/.*\?cb', 'latest/?cb', scale)
-    
+
     for abs_url in l3:
         fmt = check_filetype(abs_url)
         # May fail if there are no images in the page
         try:
-            download_image(img_src=abs_url, img_format=fmt, domain_name=domain_name, download_dir=DOWNLOAD_DIR)
-        except (HTTPError, ValueError):
+            with METRICS.time_stage('image_download'):
+                downloaded = download_image(img_src=abs_url, img_format=fmt, domain_name=domain_name,
+                                            download_dir=DOWNLOAD_DIR, store=get_content_store(),
+                                            session=get_session())
+        except HTTPError:
+            METRICS.inc('fandom_images_total', result='failed')
+            continue
+        except ValueError:
+            METRICS.inc('fandom_images_total', result='rejected')
             continue
+        METRICS.inc('fandom_images_total', result='downloaded' if downloaded else 'unchanged')
+    METRICS.inc('fandom_pages_total')
 
 
 # %%
@@ -220,36 +363,20 @@ def get_domain_categories(domain_base_link: str):
     print("Collecting character and gallery pages for " + domain_base_link)
     character_categories_list = []
 
-    topics = ['character', 'gallery']
-    for t in topics:
-        characters_category_search = urlopen(domain_base_link + 'index.php?title=Special%3ACategories&from=' + t)
-        characters_category_search_soup = BeautifulSoup(characters_category_search, 'html.parser')
-        category_pages = characters_category_search_soup.find('ul', {'class': ''}).find_all('a', {'href': re.compile('/wiki/Category:.*(Character|Gallery).*')})
-        for link in category_pages:
-            # link['href'][1:] is just the wiki/Chategory:Characters stuff, just without the '/' in front
-            character_categories_list.append(link['href'][1:])
-    for page in character_categories_list:
-        character_categories_list[character_categories_list.index(page)] = domain_base_link + page
-    ccl_clean = []
-    # I think this removes duplicates?
-    [ccl_clean.append(x) for x in character_categories_list if x not in ccl_clean]
+    for t in CATEGORY_TOPICS:
+        try:
+            characters_category_search = get_session().get(categories_search_url(domain_base_link, t))
+        except CacheMiss:
+            # Offline and never cached, so retrying can't help
+            print("Skipping the " + t + " categories of " + domain_base_link + ", not in the offline cache")
+            continue
+        character_categories_list.extend(parse_domain_categories(characters_category_search, domain_base_link))
+    # Remove duplicates, keeping the first of each
+    ccl_clean = list(dict.fromkeys(character_categories_list))
 
     return ccl_clean
 
 
-def get_domain_name(domain_base_link: str):
-    """
-    Parse the domain base link into the name of the domain.
-    
-    Ex. IN: 'https://godofhighschool.fandom.com/'
-        OUT: godofhighschool
-
-    """
-    domain_name = re.sub('/wiki/.*', '', domain_base_link)
-    domain_name = domain_name.replace('https://', '')
-    domain_name = domain_name.replace('.fandom.com/', '')
-    return domain_name
-
 @retry_connection
 def get_character_pages(domain_categories: list, domain_base_link: str):
     """
@@ -271,12 +398,8 @@ def get_character_pages(domain_categories: list, domain_base_link: str):
     full_character_pages = set()
     for category in domain_categories:
         try:
-            html: urlopen = urlopen(category)
-            soup: BeautifulSoup = BeautifulSoup(html, 'html.parser')
-            characters_block = soup.find('div', {'class': 'category-page__members'})
-            character_page_links = characters_block.find_all('a', {'href': re.compile('/wiki/.*'), 'class': re.compile('category-page__member-.*')})
-            character_pages = [x['href'] for x in character_page_links]
-            pages_to_add = [domain_base_link + char_link for char_link in character_pages]
+            html: bytes = get_session().get(category)
+            pages_to_add = parse_category_members(html, domain_base_link)
             for page in pages_to_add:
                 full_character_pages.add(page)
         except (AttributeError, HTTPError):
@@ -285,82 +408,183 @@ def get_character_pages(domain_categories: list, domain_base_link: str):
     return full_character_pages
 
 
-def sort_category_from_character(character_page_urls, pattern):
-    characters = []
-    categories = []
-    for url in character_page_urls:
-        if url:
-            if re.match(pattern, url):
-                categories.append(url)
-            elif re.match(re.compile('.*File:.*'), url):
-                continue
-            else:
-                characters.append(url)
-    return characters, categories
-
-
 @retry_connection
-def gather_remaining_pages(character_page_urls: List[str], domain_base_link: str):
+def gather_remaining_pages(character_page_urls: List[str], domain_base_link: str, frontier: CrawlFrontier = None):
     """
     Takes in the initial list of links from a category search and finds the remaining category and character links that it can find
-    """
 
-    # Character pages that have been collected
-    collected_pages: Set[str] = set()
-    # Categories that need to be opened and their links viewed
-    categories_to_check: List[str] = []
-    # Categories that have been checked and should not be checked again
-    checked_categories: List[str] = []
-
-    # Establish the pattern that Category urls follow
-    category_pattern = re.compile('.*Category:.*')
-
-    # Sort all the character pages from the category pages. This needs to be run once the first time
-    sorted_pages = list(sort_category_from_character(character_page_urls, category_pattern))
-    for x in sorted_pages[0]:
-        collected_pages.add(x)
-    for y in sorted_pages[1]:
-        categories_to_check.append(y)
-
-    # Iterate through the collected categories in search of new character pages
-    while len(categories_to_check) > 0:
-        # I think this should operate the same as a for loop
-        category_url = categories_to_check.pop(0)
-        # Do some checks
-        # If the category has already been checked, move to the next category
-        if category_url in checked_categories:
-            continue
-        # If it's a category page that has not been checked...
-        elif re.match(category_pattern, category_url) and category_url not in checked_categories:
-            # ...Gets that category's links and sorts them
-            pages_to_sort = get_character_pages([category_url], domain_base_link)
-            characters, categories = sort_category_from_character(pages_to_sort, category_pattern)
-            for char in characters:
-                collected_pages.add(char)
-            for cat in categories:
-                if cat not in checked_categories:
-                    categories_to_check.append(cat)
-        checked_categories.append(category_url)
-    
-    return list(collected_pages)
+    If a frontier is given, the categories still to check and the pages found are kept in it instead
+    of in memory, and a domain that was already started continues from where it stopped.
+    """
+    if frontier is None:
+        frontier = MemoryFrontier()
+    return walk_categories(frontier, character_page_urls,
+                           lambda category_url: get_character_pages([category_url], domain_base_link))
 
 
-def get_one_domain(domain_base_link: str):
+def crawl_one_domain(domain_base_link: str):
+    """
+    Download every image that can be found in one domain, without marking the domain as collected
+    """
     domain_name = get_domain_name(domain_base_link)
-    domain_categories = get_domain_categories(domain_base_link)
-    character_page_urls = get_character_pages(domain_categories, domain_base_link)
-    all_character_pages = gather_remaining_pages(character_page_urls, domain_base_link)
+    frontier = CrawlFrontier(domain_base_link, state_path()) if save_crawl_state else None
+    try:
+        with METRICS.time_stage('category_discovery'):
+            if frontier is not None and frontier.is_seeded():
+                print("Resuming " + domain_base_link + " from the saved crawl state")
+                character_page_urls = []
+            else:
+                domain_categories = get_domain_categories(domain_base_link)
+                character_page_urls = get_character_pages(domain_categories, domain_base_link)
+            all_character_pages = gather_remaining_pages(character_page_urls, domain_base_link, frontier)
 
-    for image_page in all_character_pages:
-        collect_from_images_page(image_page, domain_name)
+        if frontier is None:
+            for image_page in all_character_pages:
+                collect_from_images_page(image_page, domain_name)
+            return
 
-    with open('collected_domains.csv', mode='a', newline='') as collected_domains:
-        writer = csv.writer(collected_domains, delimiter=',')
-        writer.writerow([domain_base_link])
+        for image_page in frontier.pending_pages():
+            collect_from_images_page(image_page, domain_name)
+            frontier.mark_page_done(image_page)
+        frontier.clear()
+    finally:
+        # A domain that fails partway keeps its saved state, but not an open connection
+        if frontier is not None:
+            frontier.close()
 
 
-# %%
+def get_one_domain(domain_base_link: str):
+    crawl_one_domain(domain_base_link)
+    mark_domain_collected(domain_base_link)
+
 
+def mark_domain_collected(domain_base_link: str):
+    """
+    Record a finished domain in collected_domains.csv so it is skipped on the next run
+    """
+    append_collected_domain(domain_base_link, data_path('collected_domains.csv'))
+    get_registry().mark_collected(domain_base_link)
+    METRICS.inc('fandom_domains_total')
 
-for d in domain_list:
-    get_one_domain(d)
+
+# %% Running a crawl
+
+def run(search_terms_list: List[str] = None, pages_deep: int = 100):
+    """
+    Find the domains (searching for new ones if search_new is set), skip the ones in
+    collected_domains.csv, and download the images of the rest with the crawl mode in the settings
+    """
+    if search_terms_list is None:
+        search_terms_list = search_terms
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+    exporter = None
+    if metrics_interval:
+        exporter = MetricsExporter(METRICS, data_path(METRICS_JSON_PATH), data_path(METRICS_PROM_PATH),
+                                   interval=metrics_interval).start()
+    try:
+        _run(search_terms_list, pages_deep)
+        if near_duplicate_distance is not None:
+            from .near_duplicates import filter_near_duplicates
+            store = get_content_store()
+            with METRICS.time_stage('near_duplicates'):
+                if store is not None:
+                    # The store's objects are the only copy of each image, and dropping one has to
+                    # update its index too
+                    filter_near_duplicates(store.objects_dir, data_path(NEAR_DUPLICATES_PATH),
+                                           near_duplicate_distance, drop=drop_near_duplicates, remove=store.remove)
+                else:
+                    filter_near_duplicates(DOWNLOAD_DIR, data_path(NEAR_DUPLICATES_PATH), near_duplicate_distance,
+                                           drop=drop_near_duplicates)
+    finally:
+        if exporter is not None:
+            exporter.stop()
+
+
+def _run(search_terms_list: List[str], pages_deep: int):
+    # Get the domain addresses
+    if search_new:
+        retrieve_domain_names(search_terms_list, pages_deep=pages_deep, search_new=search_new)
+    # sample_domain_list = random.sample(domain_list, 10)
+    # The found domains that haven't been searched yet (collected_domains.csv), straight from the index
+    domain_list = get_registry().uncollected()
+
+    if use_async:
+        from .async_crawler import crawl_domains
+        asyncio.run(crawl_domains(domain_list, DOWNLOAD_DIR, concurrency=async_concurrency,
+                                  per_host_limit=async_per_host_limit, on_domain_done=mark_domain_collected,
+                                  domain_workers=domain_workers, state_path=state_path(),
+                                  store=get_content_store(), session=get_session(), min_size=min_image_size,
+                                  max_size=max_image_size, throttle=get_throttle()))
+    elif domain_workers > 1:
+        # Worker processes start with the default settings, so they are given the ones in use here
+        run_domain_pool(domain_list, crawl_one_domain, workers=domain_workers, use_processes=use_processes,
+                        on_domain_done=mark_domain_collected, initializer=_configure_worker,
+                        initargs=(current_settings(),))
+    else:
+        for d in domain_list:
+            get_one_domain(d)
+
+
+def _configure_worker(settings: dict):
+    configure(**settings)
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m fandom_wikia_image_downloader',
+                                     description='Download character images from fandom wikis.')
+    parser.add_argument('search_terms', nargs='*', default=search_terms,
+                        help='Terms to search the fandom community search for. The default is ' + str(search_terms) + '.')
+    parser.add_argument('-o', '--output-dir', default=DOWNLOAD_DIR, help='Folder the images are downloaded to.')
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help='Folder for found_domains.csv, collected_domains.csv, the crawl state and the http cache.')
+    parser.add_argument('--search-new', action='store_true', default=search_new,
+                        help='Search for new domains instead of only using found_domains.csv.')
+    parser.add_argument('--pages-deep', type=int, default=100, help='Search pages looked at per search term.')
+    parser.add_argument('--async', dest='use_async', action='store_true', default=use_async,
+                        help='Crawl with the asyncio engine.')
+    parser.add_argument('-c', '--concurrency', type=int, default=async_concurrency,
+                        help='Requests in flight at once with --async.')
+    parser.add_argument('--per-host-limit', type=int, default=async_per_host_limit,
+                        help='Requests in flight to one host at once with --async.')
+    parser.add_argument('-w', '--domain-workers', type=int, default=domain_workers,
+                        help='Domains crawled at the same time.')
+    parser.add_argument('--processes', dest='use_processes', action='store_true', default=use_processes,
+                        help='Crawl domains in worker processes instead of threads.')
+    parser.add_argument('--content-store', dest='use_content_store', action='store_true', default=use_content_store,
+                        help='Store each image once under the hash of its content.')
+    parser.add_argument('--offline', dest='offline_replay', action='store_true', default=offline_replay,
+                        help='Only read pages from the http cache.')
+    parser.add_argument('--rate', type=float, default=requests_per_second,
+                        help='Requests per second each host starts at.')
+    parser.add_argument('--max-rate', type=float, default=max_requests_per_second,
+                        help='Requests per second no host goes above.')
+    parser.add_argument('--parser', dest='parser_backend', choices=PARSER_BACKENDS, default=parser_backend,
+                        help='Html parser. The default is the fastest one installed.')
+    parser.add_argument('--metrics-interval', type=float, default=metrics_interval,
+                        help='Seconds between writes of metrics.json and metrics.prom to the data dir. 0 turns them off.')
+    parser.add_argument('--near-duplicates', dest='near_duplicate_distance', type=int, default=near_duplicate_distance,
+                        help='After the crawl, link images whose perceptual hashes differ in at most this many bits.')
+    parser.add_argument('--drop-near-duplicates', action='store_true', default=drop_near_duplicates,
+                        help='Delete near-duplicates instead of linking them.')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
+    """
+    Command line entry point: python -m fandom_wikia_image_downloader [search terms] [options]
+    """
+    args = parse_args(argv)
+    configure(DOWNLOAD_DIR=args.output_dir, DATA_DIR=args.data_dir, search_new=args.search_new,
+              use_async=args.use_async, async_concurrency=args.concurrency,
+              async_per_host_limit=args.per_host_limit, domain_workers=args.domain_workers,
+              use_processes=args.use_processes, use_content_store=args.use_content_store,
+              offline_replay=args.offline_replay, requests_per_second=args.rate,
+              max_requests_per_second=args.max_rate, parser_backend=args.parser_backend,
+              metrics_interval=args.metrics_interval, near_duplicate_distance=args.near_duplicate_distance,
+              drop_near_duplicates=args.drop_near_duplicates)
+    run(args.search_terms, pages_deep=args.pages_deep)
+
+
+if __name__ == '__main__':
+    main()
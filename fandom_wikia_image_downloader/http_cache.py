@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP layer with an on-disk cache, shared by the BeautifulSoup scrapers.
+
+Every response's ETag and Last-Modified headers are saved, and the next request for the same url is
+sent as a conditional GET. A page that hasn't changed comes back as a 304 and is read from disk
+instead of being downloaded again. Html pages keep their body in the cache; images only keep their
+validators, since the image itself is already in the download folder. So an image only counts as
+unchanged while its file is still there: once it is deleted, or the download folder changes, it is
+downloaded again.
+
+A ttl skips the request entirely for entries younger than ttl seconds, and offline mode never touches
+the network, so the parsing code can be rerun against the pages saved by an earlier crawl.
+
+Requests go through one pooled httpx client, so pages and images from the same host reuse a warm
+keep-alive (and, with h2 installed, HTTP/2) connection instead of opening a new one every time.
+With a throttle.HostThrottle, every request waits for its host's rate limit, and 429s, 5xx and
+dropped connections are retried with backoff.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from email.message import Message
+from importlib.util import find_spec
+from typing import Callable, Dict, Iterator, Optional, Tuple, Union
+from urllib.error import ContentTooShortError, HTTPError
+
+import httpx
+
+from .telemetry import METRICS
+
+
+CHUNK_SIZE = 64 * 1024
+
+# httpx only negotiates HTTP/2 when the h2 package is installed
+HTTP2 = find_spec('h2') is not None
+
+
+class CacheMiss(HTTPError):
+    """
+    Raised in offline mode for a url that isn't in the cache. It is an HTTPError with status 504,
+    like an only-if-cached request that misses, so callers that skip missing pages skip it too.
+    """
+
+    def __init__(self, url: str):
+        super().__init__(url, 504, 'Not in the offline cache', Message(), None)
+
+
+class DownloadRejected(ValueError):
+    """Raised when a file is smaller than the session's min_size or larger than its max_size"""
+
+
+def check_size(url: str, size: int, min_size: int = None, max_size: int = None, complete: bool = True) -> None:
+    """
+    Raise DownloadRejected if size is outside [min_size, max_size]. While a download is still
+    running (complete is False) only max_size is checked.
+    """
+    if max_size is not None and size > max_size:
+        raise DownloadRejected(url + ' is larger than ' + str(max_size) + ' bytes')
+    if complete and min_size is not None and size < min_size:
+        raise DownloadRejected(url + ' is smaller than ' + str(min_size) + ' bytes')
+
+
+def content_length(response) -> Optional[int]:
+    """The Content-Length of a response, or None if it isn't given"""
+    length = response.headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+def check_complete(response, expected: Optional[int]) -> None:
+    """
+    Raise ContentTooShortError (like urlretrieve) if the connection dropped before expected bytes,
+    the response's Content-Length, were read
+    """
+    if expected is not None and response.num_bytes_downloaded < expected:
+        raise ContentTooShortError('retrieval incomplete: got only ' + str(response.num_bytes_downloaded)
+                                   + ' out of ' + str(expected) + ' bytes', None)
+
+
+class HttpCache:
+    """
+    Cache entries on disk, two files per url under cache_dir/<first two hex digits of its hash>/:
+    <hash>.json with the url's validators, its Content-Type, when it was fetched and, for files, the
+    path it was saved to, and <hash>.body with the body.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url: str, suffix: str) -> str:
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + suffix)
+
+    def load(self, url: str) -> Optional[dict]:
+        """The metadata saved for url, or None if url isn't cached"""
+        try:
+            with open(self._path(url, '.json')) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def body(self, url: str) -> Optional[bytes]:
+        try:
+            with open(self._path(url, '.body'), 'rb') as body_file:
+                return body_file.read()
+        except OSError:
+            return None
+
+    def store(self, url: str, headers, body: bytes = None, path: str = None) -> None:
+        """
+        Save the validators in the response headers of url, and its body if one is given, or the path
+        of the file it was saved to
+        """
+        meta = {'url': url,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'content_type': headers.get('Content-Type'),
+                'fetched_at': time.time(),
+                'has_body': body is not None,
+                'path': path}
+        if body is not None:
+            self._write(self._path(url, '.body'), body)
+        self._write(self._path(url, '.json'), json.dumps(meta).encode())
+
+    def touch(self, url: str, meta: dict) -> None:
+        """Mark a cached url as checked just now, ex. after a 304"""
+        meta['fetched_at'] = time.time()
+        self._write(self._path(url, '.json'), json.dumps(meta).encode())
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        # Write to a temporary file and rename it, so a crash never leaves half an entry behind
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def is_fresh(meta: dict, ttl: Optional[float]) -> bool:
+        return ttl is not None and time.time() - meta['fetched_at'] < ttl
+
+    @staticmethod
+    def conditional_headers(meta: Optional[dict]) -> Dict[str, str]:
+        headers = {}
+        if meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+
+def make_client(max_connections: int = 100) -> httpx.Client:
+    """
+    A pooled HTTP client that keeps connections alive between requests, speaks HTTP/2 when the h2
+    package is installed, and decodes gzip (and br when brotli is installed) response bodies.
+    """
+    return httpx.Client(http2=HTTP2, follow_redirects=True, timeout=60,
+                        limits=httpx.Limits(max_connections=max_connections,
+                                            max_keepalive_connections=max_connections))
+
+
+class CachedSession:
+    """
+    Fetches urls through an HttpCache, over one pooled keep-alive client
+
+    HTTP error statuses raise urllib.error.HTTPError, the same as urlopen, so callers can keep
+    catching HTTPError.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Folder the cache is kept in. The default is 'http_cache'.
+    ttl : float, optional
+        Seconds a cached response is used without asking the server if it changed. The default is
+        None, which always sends a conditional GET.
+    offline : bool, optional
+        Only answer from the cache. Urls that aren't cached raise CacheMiss. The default is False.
+    client : httpx.Client, optional
+        The client requests are sent with. The default is a new client from make_client.
+    throttle : throttle.HostThrottle, optional
+        Rate limits every host and retries failed requests. Requests to a host whose circuit is open
+        wait until it lets them through. The default is None, which sends requests straight away and
+        doesn't retry them.
+    min_size, max_size : int, optional
+        Files downloaded with retrieve, download or iter_content that are smaller or larger than
+        this many bytes raise DownloadRejected. A Content-Length outside the limits is rejected
+        before any of the body is read, and a body that grows past max_size is cut off there.
+        The defaults are None, no limit.
+
+    """
+
+    def __init__(self, cache_dir: str = 'http_cache', ttl: float = None, offline: bool = False,
+                 client: httpx.Client = None, min_size: int = None, max_size: int = None, throttle=None):
+        self.cache = HttpCache(cache_dir)
+        self.ttl = ttl
+        self.offline = offline
+        self.min_size = min_size
+        self.max_size = max_size
+        self.client = client if client is not None else make_client()
+        self.throttle = throttle
+
+    def close(self) -> None:
+        self.client.close()
+
+    def check(self, url: str, keep_body: bool = True) -> Tuple[bool, Optional[dict], Optional[bytes]]:
+        """
+        Look url up in the cache before requesting it
+
+        Returns
+        -------
+        Tuple[bool, Optional[dict], Optional[bytes]]
+            Whether the cache can answer without a request, the cached metadata to build a
+            conditional request from, and the cached body if keep_body is True.
+
+        """
+        meta = self.cache.load(url)
+        if meta is not None and keep_body and not meta['has_body']:
+            meta = None
+        if meta is not None and (self.offline or self.cache.is_fresh(meta, self.ttl)):
+            body = self.cache.body(url) if keep_body else None
+            if body is not None or not keep_body:
+                return True, meta, body
+            meta = None
+        if self.offline:
+            raise CacheMiss(url)
+        return False, meta, None
+
+    def check_file(self, url: str, saved: Callable[[dict], bool]) -> Tuple[bool, Optional[dict]]:
+        """
+        check() for a file download, whose body isn't cached. The cache only answers (or sends
+        validators) while saved(meta) says the file is still where it should be, otherwise the url
+        is requested again without validators, ex. after the file was deleted or the download folder
+        changed. In offline mode that raises CacheMiss.
+
+        Returns
+        -------
+        Tuple[bool, Optional[dict]]
+            Whether the cache can answer without a request, and the cached metadata to build a
+            conditional request from.
+
+        """
+        hit, meta, _ = self.check(url, keep_body=False)
+        if meta is not None and not saved(meta):
+            if self.offline:
+                raise CacheMiss(url)
+            return False, None
+        return hit, meta
+
+    def _send(self, url: str, headers: Dict[str, str]) -> httpx.Response:
+        """
+        Send a GET for url through the throttle and return the response before its body is read,
+        retrying responses and connection errors the throttle says are worth another try
+        """
+        attempt = 0
+        while True:
+            if self.throttle is not None:
+                self.throttle.wait(url)
+            try:
+                with METRICS.timer('fandom_http_request_seconds'):
+                    response = self.client.send(self.client.build_request('GET', url, headers=headers), stream=True)
+            except httpx.TransportError:
+                METRICS.inc('fandom_http_responses_total', status='error')
+                if self.throttle is None:
+                    raise
+                delay = self.throttle.on_error(url, attempt)
+                if delay is None:
+                    raise
+            else:
+                METRICS.inc('fandom_http_responses_total', status=response.status_code)
+                if self.throttle is None:
+                    return response
+                delay = self.throttle.on_response(url, response.status_code, response.headers, attempt)
+                if delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    @contextmanager
+    def _stream(self, url: str, meta: Optional[dict] = None) -> Iterator[httpx.Response]:
+        """Send a (conditional) GET for url and yield the response before its body is read"""
+        response = self._send(url, self.cache.conditional_headers(meta))
+        try:
+            if response.status_code >= 400:
+                raise HTTPError(url, response.status_code, response.reason_phrase, response.headers, None)
+            yield response
+        finally:
+            response.close()
+
+    def _iter_checked(self, url: str, response: httpx.Response, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Yield the body of a file download in chunks, enforcing the size limits and raising
+        ContentTooShortError (like urlretrieve) if the connection drops before Content-Length bytes
+        """
+        expected = content_length(response)
+        # A compressed body's Content-Length isn't the size of the file
+        if expected is not None and 'Content-Encoding' not in response.headers:
+            check_size(url, expected, self.min_size, self.max_size)
+        size = 0
+        for chunk in response.iter_bytes(chunk_size):
+            size += len(chunk)
+            METRICS.inc('fandom_http_bytes_total', len(chunk), kind='image')
+            check_size(url, size, self.min_size, self.max_size, complete=False)
+            yield chunk
+        check_complete(response, expected)
+        check_size(url, size, self.min_size, self.max_size)
+
+    def _save(self, url: str, response: httpx.Response, path: str) -> None:
+        """
+        Stream a file download into a temporary file next to path, and only rename it to path once
+        all of it has arrived, so an interrupted download never leaves a truncated file behind
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out_file:
+                for chunk in self._iter_checked(url, response):
+                    out_file.write(chunk)
+            # mkstemp makes the file private to this user, unlike urlretrieve
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @METRICS.timed_stage('page_fetch')
+    def get(self, url: str) -> bytes:
+        """Return the body of url, from the cache if it hasn't changed"""
+        hit, meta, body = self.check(url)
+        if hit:
+            METRICS.inc('fandom_http_cache_total', result='hit')
+            return body
+
+        with self._stream(url, meta) as response:
+            if response.status_code == 304:
+                METRICS.inc('fandom_http_cache_total', result='revalidated')
+                self.cache.touch(url, meta)
+                return self.cache.body(url)
+            body = response.read()
+        METRICS.inc('fandom_http_cache_total', result='miss')
+        METRICS.inc('fandom_http_bytes_total', len(body), kind='page')
+        self.cache.store(url, response.headers, body)
+        return body
+
+    def retrieve(self, url: str, path: Union[str, Callable[[Optional[str]], str]]) -> bool:
+        """
+        Download url to path, like urlretrieve, unless it was downloaded there before and hasn't
+        changed. Only the validators are cached, not the file itself, so a file that isn't at path
+        any more is downloaded again. path can also be a function of the response's Content-Type
+        that returns it, ex. to name the file after it.
+
+        Returns
+        -------
+        bool
+            True if the file was downloaded, False if it was skipped.
+
+        """
+        def target(content_type: Optional[str]) -> str:
+            return path(content_type) if callable(path) else path
+
+        hit, meta = self.check_file(url, lambda meta: os.path.exists(target(meta.get('content_type'))))
+        if hit:
+            METRICS.inc('fandom_http_cache_total', result='hit')
+            return False
+
+        with self._stream(url, meta) as response:
+            if response.status_code == 304:
+                METRICS.inc('fandom_http_cache_total', result='revalidated')
+                self.cache.touch(url, meta)
+                return False
+            METRICS.inc('fandom_http_cache_total', result='miss')
+            saved_path = target(response.headers.get('Content-Type'))
+            self._save(url, response, saved_path)
+        self.cache.store(url, response.headers, path=saved_path)
+        return True
+
+    def download(self, url: str, path: str) -> None:
+        """Download url to path without using the cache"""
+        with self._stream(url) as response:
+            self._save(url, response, path)
+
+    def iter_content(self, url: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """Yield the body of url in chunks, without using the cache"""
+        with self._stream(url) as response:
+            yield from self._iter_checked(url, response, chunk_size)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed image storage.
+
+Each image is stored once, named by the sha256 digest of its bytes, no matter how many pages or
+urls it was found on. A SQLite index maps every url that has been downloaded to its digest, so a
+url that has been seen before is skipped without touching the network.
+
+Layout under the store's root folder:
+    objects/ab/cd/abcd...ef.png   the images, sharded by the first two bytes of the digest
+    tmp/                          downloads in progress
+    index.db                      url -> digest index
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+from urllib.request import urlopen
+
+from .web_scraping_tools import UNKNOWN_EXTENSION, classify_image, ensure_dir
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ContentStore:
+    """
+    Stores images under the digest of their content
+
+    Parameters
+    ----------
+    root : str
+        Folder the store lives in. Created if it does not exist.
+
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        # The store is shared by the domain worker threads
+        self._lock = threading.Lock()
+        self.con = sqlite3.connect(os.path.join(root, 'index.db'), timeout=60, check_same_thread=False)
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT, domain TEXT)')
+            self.con.execute('CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, path TEXT, size INTEGER)')
+
+    def close(self) -> None:
+        self.con.close()
+
+    def object_path(self, digest: str, img_format: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest[2:4], digest + '.' + (img_format or UNKNOWN_EXTENSION))
+
+    def lookup(self, url: str) -> Optional[str]:
+        """The digest of the image downloaded from url, or None if url hasn't been downloaded"""
+        with self._lock:
+            row = self.con.execute('SELECT digest FROM urls WHERE url = ?', (url,)).fetchone()
+        return row[0] if row else None
+
+    def download(self, url: str, img_format: str, domain_name: str = None, session=None) -> Tuple[str, bool]:
+        """
+        Download url into the store, unless it has been downloaded before
+
+        The response is streamed to a temporary file and hashed as it arrives, so the image is never
+        held in memory all at once. If an http_cache.CachedSession is given, its pooled connections
+        are used.
+
+        Returns
+        -------
+        Tuple[str, bool]
+            The image's digest, and whether anything was downloaded.
+
+        """
+        digest = self.lookup(url)
+        if digest is not None:
+            return digest, False
+
+        sha = hashlib.sha256()
+        header = b''
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in self._iter_content(url, session):
+                    if len(header) < 16:
+                        header += chunk[:16]
+                    sha.update(chunk)
+                    tmp_file.write(chunk)
+            digest = sha.hexdigest()
+            # The url doesn't say what the image is, its first bytes do
+            img_format = img_format or classify_image(header=header)
+            self._commit(url, digest, img_format, domain_name, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest, True
+
+    @staticmethod
+    def _iter_content(url: str, session) -> Iterator[bytes]:
+        if session is not None:
+            yield from session.iter_content(url, CHUNK_SIZE)
+            return
+        with urlopen(url) as response:
+            yield from iter(lambda: response.read(CHUNK_SIZE), b'')
+
+    def add_bytes(self, url: str, content: bytes, img_format: str, domain_name: str = None) -> str:
+        """Store an image that has already been downloaded, ex. by the async crawler, and return its digest"""
+        digest = hashlib.sha256(content).hexdigest()
+        img_format = img_format or classify_image(header=content[:16])
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(content)
+            self._commit(url, digest, img_format, domain_name, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest
+
+    def remove(self, path: str) -> None:
+        """
+        Delete an image from the store, ex. a near-duplicate. The urls it came from keep its digest, so
+        they aren't downloaded again, but the object is forgotten, so a new url with the same content
+        stores it again instead of pointing at a missing file.
+        """
+        with self._lock:
+            with self.con:
+                self.con.execute('DELETE FROM objects WHERE path = ?', (os.path.relpath(path, self.root),))
+            if os.path.exists(path):
+                os.remove(path)
+
+    def add_file(self, url: str, path: str, img_format: str, domain_name: str = None) -> str:
+        """
+        Store an image that has already been downloaded to path, ex. by the async crawler, and return
+        its digest. The file is moved into the store, or deleted if the store already has it. path
+        should be in tmp_dir, so the move is a rename.
+        """
+        sha = hashlib.sha256()
+        header = b''
+        with open(path, 'rb') as image_file:
+            for chunk in iter(lambda: image_file.read(CHUNK_SIZE), b''):
+                if len(header) < 16:
+                    header += chunk[:16]
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        try:
+            self._commit(url, digest, img_format or classify_image(header=header), domain_name, path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        return digest
+
+    def _commit(self, url: str, digest: str, img_format: str, domain_name: str, tmp_path: str) -> None:
+        path = self.object_path(digest, img_format)
+        with self._lock:
+            with self.con:
+                # Another process may be storing the same image. The insert takes the database's write
+                # lock until the commit, so only the one that adds the row moves its file in
+                added = self.con.execute('INSERT OR IGNORE INTO objects VALUES (?, ?, ?)',
+                                         (digest, os.path.relpath(path, self.root), os.path.getsize(tmp_path))).rowcount
+                if added:
+                    ensure_dir(Path(path).parent)
+                    os.chmod(tmp_path, 0o644)
+                    os.replace(tmp_path, path)
+                self.con.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)', (url, digest, domain_name))
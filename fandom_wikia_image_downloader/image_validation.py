@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Validation and normalization of downloaded images, spread over a process pool.
+
+The downloader names files by the extension in the url (see classify_image), and keeps whatever
+bytes the server sent: some are corrupt or cut short, and some are bmps or gifs whatever their name
+says. validate_folder goes over every image under a folder and, in worker processes:
+    - reads the real format from the file's first bytes (magic numbers), not its name
+    - decodes the whole image, so truncated and corrupt files are caught
+    - hashes it (sha256, the same digest image_store.py names its objects by)
+    - optionally writes a copy in one format and resolution to another folder (the original is
+      never changed)
+and writes one manifest row per file, as csv or, if pyarrow is installed, Parquet.
+
+The folder is walked lazily and the files are handed to the pool in batches, and the manifest is
+written as the results come back, so millions of files never have to be held in memory.
+
+Run from the repo root:
+    python -m fandom_wikia_image_downloader.image_validation images --manifest manifest.csv \\
+        [--format png] [--size 256 256] [--output-dir normalized] [--workers 8]
+
+Needs Pillow, and pyarrow for Parquet manifests.
+"""
+import argparse
+import csv
+import hashlib
+import io
+import itertools
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from importlib.util import find_spec
+from typing import Iterable, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from .web_scraping_tools import FORMAT_EXTENSIONS, iter_image_files, sniff_format
+
+
+# Formats files can be normalized to
+OUTPUT_FORMATS = ('png', 'jpeg', 'webp')
+
+MANIFEST_FIELDS = ('path', 'bytes', 'sha256', 'extension', 'format', 'extension_matches', 'valid', 'error',
+                   'width', 'height', 'mode', 'output_path')
+# Files handed to the worker processes at a time, and manifest rows written at once
+BATCH_SIZE = 4096
+
+
+def normalize_image(image: Image.Image, output_format: str, size: Tuple[int, int] = None) -> Image.Image:
+    """
+    The image in a mode output_format can hold, cropped around the center and scaled to exactly
+    size if it is given
+    """
+    if output_format == 'jpeg' or image.mode not in ('RGB', 'RGBA'):
+        # Jpegs have no transparency. Everything else keeps it if it had some
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha and output_format != 'jpeg' else 'RGB')
+    if size is not None:
+        image = ImageOps.fit(image, size, Image.LANCZOS)
+    return image
+
+
+def validate_file(path: str, root: str = None, output_dir: str = None, output_format: str = None,
+                  size: Tuple[int, int] = None) -> dict:
+    """
+    Validate one image and return its manifest row. With output_dir, a normalized copy is written
+    there under the same path relative to root.
+    """
+    extension = os.path.splitext(path)[1][1:].lower()
+    row = dict.fromkeys(MANIFEST_FIELDS)
+    row.update(path=path, extension=extension, valid=False)
+    try:
+        with open(path, 'rb') as image_file:
+            content = image_file.read()
+    except OSError as e:
+        row['error'] = repr(e)
+        return row
+    row['bytes'] = len(content)
+    row['sha256'] = hashlib.sha256(content).hexdigest()
+    row['format'] = sniff_format(content[:16])
+    row['extension_matches'] = row['format'] is not None and FORMAT_EXTENSIONS[row['format']] == extension.replace('jpeg', 'jpg')
+    if row['format'] is None:
+        row['error'] = 'Not an image'
+        return row
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            # Decode every pixel: a file cut short still opens, but fails here
+            image.load()
+            row.update(width=image.width, height=image.height, mode=image.mode, valid=True)
+            if output_dir is not None:
+                row['output_path'] = _write_normalized(image, path, root, output_dir,
+                                                       output_format or row['format'], size)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        # Pillow raises SyntaxError for some broken headers
+        row['error'] = repr(e)
+    return row
+
+
+def _write_normalized(image: Image.Image, path: str, root: str, output_dir: str, output_format: str,
+                      size: Optional[Tuple[int, int]]) -> str:
+    relative = os.path.relpath(path, root) if root is not None else os.path.basename(path)
+    output_path = os.path.join(output_dir, os.path.splitext(relative)[0] + '.' + FORMAT_EXTENSIONS[output_format])
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    normalized = normalize_image(image, output_format, size)
+    # Readers never see a half written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            normalized.save(tmp_file, format=output_format.upper())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return output_path
+
+
+class ManifestWriter:
+    """
+    Writes manifest rows to a csv file, or a Parquet file if the path ends in .parquet, a batch at a
+    time
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.parquet = path.endswith('.parquet')
+        if self.parquet and not find_spec('pyarrow'):
+            raise ValueError('Parquet manifests need pyarrow, write a .csv manifest instead')
+        self._writer = None
+        self._file = None
+
+    def write(self, rows: List[dict]) -> None:
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pylist(rows, schema=_parquet_schema())
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+            return
+        if self._writer is None:
+            self._file = open(self.path, 'w', newline='', encoding='utf-8')
+            self._writer = csv.DictWriter(self._file, MANIFEST_FIELDS)
+            self._writer.writeheader()
+        self._writer.writerows(rows)
+
+    def close(self) -> None:
+        if self.parquet and self._writer is not None:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _parquet_schema():
+    import pyarrow as pa
+    types = {'bytes': pa.int64(), 'width': pa.int32(), 'height': pa.int32(),
+             'extension_matches': pa.bool_(), 'valid': pa.bool_()}
+    return pa.schema([(name, types.get(name, pa.string())) for name in MANIFEST_FIELDS])
+
+
+def validate_files(paths: Iterable[str], manifest_path: str, root: str = None, output_dir: str = None,
+                   output_format: str = None, size: Tuple[int, int] = None, workers: int = None) -> Tuple[int, int]:
+    """
+    Validate every file in paths in workers processes (all cores by default) and write the manifest
+
+    Returns
+    -------
+    Tuple[int, int]
+        Files checked, and how many of them were invalid.
+
+    """
+    if output_format is not None and output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format ' + repr(output_format) + ', expected one of ' + str(OUTPUT_FORMATS))
+    check = partial(validate_file, root=root, output_dir=output_dir, output_format=output_format, size=size)
+    paths = iter(paths)
+    checked = invalid = 0
+    with ProcessPoolExecutor(workers) as executor, ManifestWriter(manifest_path) as manifest:
+        # executor.map submits everything it is given at once, so the files are fed to it in batches
+        while True:
+            batch = list(itertools.islice(paths, BATCH_SIZE))
+            if not batch:
+                break
+            rows = list(executor.map(check, batch, chunksize=64))
+            manifest.write(rows)
+            checked += len(rows)
+            invalid += sum(1 for row in rows if not row['valid'])
+            print(str(checked) + ' images checked, ' + str(invalid) + ' invalid')
+    return checked, invalid
+
+
+def validate_folder(folder: str, manifest_path: str, output_dir: str = None, output_format: str = None,
+                    size: Tuple[int, int] = None, workers: int = None) -> Tuple[int, int]:
+    """validate_files on every image under folder, see iter_image_files"""
+    return validate_files(iter_image_files(folder), manifest_path, root=folder, output_dir=output_dir,
+                          output_format=output_format, size=size, workers=workers)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(prog='python -m fandom_wikia_image_downloader.image_validation',
+                                     description='Check that downloaded images decode, and write a manifest of them.')
+    parser.add_argument('folder', help='Folder of downloaded images, searched recursively.')
+    parser.add_argument('--manifest', default='manifest.csv', help='Manifest to write, .csv or .parquet.')
+    parser.add_argument('--output-dir', default=None, help='Write a normalized copy of every valid image here.')
+    parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS, default=None,
+                        help='Format of the normalized copies. The default keeps each image\'s own format.')
+    parser.add_argument('--size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'), default=None,
+                        help='Crop and scale the normalized copies to exactly this size.')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes. The default is all cores.')
+    args = parser.parse_args(argv)
+    validate_folder(args.folder, args.manifest, args.output_dir, args.output_format,
+                    tuple(args.size) if args.size else None, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Near-duplicate filter for downloaded images.
+
+The same picture is often found many times on one wiki: re-encoded, resized, or cropped a little for
+a gallery. Byte hashes (image_store.py) only catch exact copies, so each image also gets a 64 bit
+perceptual hash: the image is shrunk to 32x32 grayscale, and the signs of the lowest frequencies of
+its discrete cosine transform (compared to their median) are kept. Small edits only flip a few bits,
+so two images whose hashes are within a few bits of each other (Hamming distance) look the same.
+
+Hashes are kept in SQLite, so each image is only decoded once across runs, and looked up in a
+BK-tree, which only visits the part of the index within max_distance of the hash instead of all of it.
+Of each group of near-duplicates the image with the most pixels is kept, and the others are linked to
+it in the index, or deleted with drop=True (through image_store.ContentStore.remove for the objects of
+a store).
+
+Run from the repo root after a crawl:
+    python -m fandom_wikia_image_downloader.near_duplicates images --distance 6 [--drop] [--workers 8]
+or set near_duplicate_distance in fandom_wikia_image_downloader_03.py to run it at the end of run().
+
+Needs numpy and Pillow.
+"""
+import argparse
+import itertools
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .web_scraping_tools import iter_image_files
+
+
+HASH_SIZE = 8
+# Side of the grayscale image the transform is taken of
+IMAGE_SIZE = 32
+# Files handed to the worker processes at a time
+BATCH_SIZE = 4096
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    # Orthonormal DCT-II, so the transform of an image is one matrix product on each side
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(IMAGE_SIZE)
+
+
+def phash(image: Image.Image) -> int:
+    """64 bit perceptual hash of an image"""
+    pixels = np.asarray(image.convert('L').resize((IMAGE_SIZE, IMAGE_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # The first coefficient is the average brightness, which says nothing about what the image shows
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hash_file(path: str) -> Tuple[str, Optional[int], int]:
+    """(path, perceptual hash, pixels) of an image file. The hash is None if it can't be decoded."""
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            # Jpegs can be decoded straight at a fraction of their size
+            image.draft('L', (IMAGE_SIZE * 2, IMAGE_SIZE * 2))
+            return path, phash(image), width * height
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return path, None, 0
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes under the Hamming distance. Every child of a node sits at a
+    different distance from it, so a search within a radius only follows the children whose distance
+    is within that radius of the query's distance to the node.
+    """
+
+    def __init__(self):
+        # Node: [hash, value, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, key: int, value) -> None:
+        self.size += 1
+        if self.root is None:
+            self.root = [key, value, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(key, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, value, {}]
+                return
+            node = child
+
+    def nearest(self, key: int, max_distance: int) -> Optional[Tuple[int, list]]:
+        """(distance, node) of the closest hash within max_distance of key, or None"""
+        best = None
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, node)
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        return best
+
+
+class NearDuplicateIndex:
+    """
+    Perceptual hashes of the images seen so far, and which of them are near-duplicates
+
+    Parameters
+    ----------
+    db_path : str
+        SQLite file the hashes are kept in. Created if it does not exist.
+    max_distance : int, optional
+        Images whose hashes differ in at most this many of their 64 bits are near-duplicates. The
+        default is 6.
+    drop : bool, optional
+        Delete near-duplicates instead of only linking them to the image that is kept.
+    remove : Callable[[str], None], optional
+        Deletes a near-duplicate with drop. The default is os.remove. Images in an
+        image_store.ContentStore have to go through its remove, or its index would still list them.
+
+    """
+
+    def __init__(self, db_path: str, max_distance: int = 6, drop: bool = False,
+                 remove: Callable[[str], None] = None):
+        self.max_distance = max_distance
+        self.drop = drop
+        self.remove = remove or os.remove
+        self.con = sqlite3.connect(db_path, timeout=60)
+        with self.con:
+            # duplicate_of is NULL for the images that are kept. hash is NULL if the file can't be decoded
+            self.con.execute('CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, hash TEXT, pixels INTEGER, '
+                             'duplicate_of TEXT, distance INTEGER)')
+        self.tree = BKTree()
+        for path, hex_hash, pixels in self.con.execute(
+                'SELECT path, hash, pixels FROM images WHERE duplicate_of IS NULL AND hash IS NOT NULL'):
+            self.tree.add(int(hex_hash, 16), [path, pixels])
+
+    def close(self) -> None:
+        self.con.close()
+
+    def is_indexed(self, path: str) -> bool:
+        return self.con.execute('SELECT 1 FROM images WHERE path = ?', (path,)).fetchone() is not None
+
+    def add(self, path: str, image_hash: Optional[int], pixels: int) -> Optional[str]:
+        """
+        Index an image and return the path of the near-duplicate that was linked (or dropped): the
+        new image, or the one it replaces if it is bigger. None if it isn't a near-duplicate.
+        """
+        hex_hash = None if image_hash is None else format(image_hash, '016x')
+        match = None if image_hash is None else self.tree.nearest(image_hash, self.max_distance)
+        with self.con:
+            if match is None:
+                self.con.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, NULL, NULL)', (path, hex_hash, pixels))
+                if image_hash is not None:
+                    self.tree.add(image_hash, [path, pixels])
+                return None
+            distance, node = match
+            kept = node[1]
+            if pixels > kept[1]:
+                # The bigger copy is kept. The node keeps its hash, which is within max_distance anyway
+                duplicate, kept[:] = kept[0], [path, pixels]
+                self.con.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, NULL, NULL)', (path, hex_hash, pixels))
+                self.con.execute('UPDATE images SET duplicate_of = ?, distance = ? WHERE path = ? OR duplicate_of = ?',
+                                 (path, distance, duplicate, duplicate))
+            else:
+                duplicate = path
+                self.con.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)',
+                                 (path, hex_hash, pixels, kept[0], distance))
+        if self.drop and os.path.exists(duplicate):
+            self.remove(duplicate)
+        return duplicate
+
+    def duplicates(self) -> Dict[str, List[str]]:
+        """Path of every kept image that has near-duplicates -> their paths"""
+        groups: Dict[str, List[str]] = {}
+        for path, kept in self.con.execute('SELECT path, duplicate_of FROM images WHERE duplicate_of IS NOT NULL'):
+            groups.setdefault(kept, []).append(path)
+        return groups
+
+
+def filter_near_duplicates(folder: str, db_path: str, max_distance: int = 6, drop: bool = False,
+                           workers: int = None, remove: Callable[[str], None] = None) -> int:
+    """
+    Hash every image under folder that hasn't been hashed yet and link (or delete, with drop and
+    remove, see NearDuplicateIndex) its near-duplicates. Decoding is spread over workers processes,
+    all cores by default.
+
+    Returns
+    -------
+    int
+        The near-duplicates found in this run.
+
+    """
+    index = NearDuplicateIndex(db_path, max_distance, drop, remove)
+    found = 0
+    try:
+        new_files = (path for path in iter_image_files(folder) if not index.is_indexed(path))
+        with ProcessPoolExecutor(workers) as executor:
+            # executor.map submits everything it is given at once, so the files are fed to it in batches
+            while True:
+                batch = list(itertools.islice(new_files, BATCH_SIZE))
+                if not batch:
+                    break
+                for path, image_hash, pixels in executor.map(hash_file, batch, chunksize=64):
+                    if index.add(path, image_hash, pixels) is not None:
+                        found += 1
+    finally:
+        index.close()
+    print(str(found) + ' near-duplicates ' + ('dropped' if drop else 'linked') + ' in ' + folder)
+    return found
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(prog='python -m fandom_wikia_image_downloader.near_duplicates',
+                                     description='Link or delete near-duplicate images in a folder.')
+    parser.add_argument('folder', help='Folder of downloaded images, searched recursively.')
+    parser.add_argument('--distance', type=int, default=6,
+                        help='Hashes differing in at most this many bits are near-duplicates.')
+    parser.add_argument('--db', default=None, help='Hash index. The default is near_duplicates.db in the folder.')
+    parser.add_argument('--drop', action='store_true', help='Delete near-duplicates instead of linking them.')
+    parser.add_argument('--workers', type=int, default=None, help='Decoding processes. The default is all cores.')
+    args = parser.parse_args(argv)
+    filter_near_duplicates(args.folder, args.db or os.path.join(args.folder, 'near_duplicates.db'),
+                           args.distance, args.drop, args.workers)
+
+
+if __name__ == '__main__':
+    main()
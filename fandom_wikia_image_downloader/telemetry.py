@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Crawl telemetry: counters and latency histograms, exported while the crawl runs.
+
+Every module records into the process-wide METRICS registry. MetricsExporter writes it to disk every
+few seconds as a JSON snapshot (with the rates since the last snapshot, ex. images per second right
+now) and as a Prometheus text file, which node_exporter's textfile collector can pick up, or which
+can just be read with cat to see where a long crawl is spending its time.
+
+Stages timed in fandom_stage_seconds:
+    category_discovery  finding every character page of a domain
+    page_fetch          getting the html of a page (from the cache or the network)
+    parse               parsing a page
+    image_download      downloading one image
+    near_duplicates     the near-duplicate filter after the crawl
+
+Worker processes each have their own registry, so with use_processes only the parent's requests
+are counted.
+"""
+import bisect
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Name -> (type, help) of the metrics the crawl records
+METRIC_HELP = {
+    'fandom_stage_seconds': ('histogram', 'Time spent in each stage of the crawl'),
+    'fandom_http_request_seconds': ('histogram', 'Time until the response headers of a request arrive'),
+    'fandom_http_responses_total': ('counter', 'Responses by HTTP status, status "error" for connection errors'),
+    'fandom_http_cache_total': ('counter', 'Page and image lookups by cache result: hit, revalidated or miss'),
+    'fandom_http_bytes_total': ('counter', 'Body bytes received, by kind: page or image'),
+    'fandom_images_total': ('counter', 'Images by result: downloaded, unchanged, rejected or failed'),
+    'fandom_pages_total': ('counter', 'Character and gallery pages whose images were collected'),
+    'fandom_domains_total': ('counter', 'Domains collected'),
+    'fandom_stage_errors_total': ('counter', 'Exceptions raised out of each stage, by exception type'),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Counts of observations at or below each bucket's upper bound, plus their sum"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, and one for everything above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """(le, count) pairs as Prometheus has them, each count including the buckets below it"""
+        pairs = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append(('+Inf' if bound == float('inf') else repr(bound), total))
+        return pairs
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Upper bound of the bucket the q quantile falls in. None if nothing was observed, or if it is
+        past the last bucket.
+        """
+        rank = q * self.count
+        for le, total in self.cumulative():
+            if self.count and total >= rank:
+                return None if le == '+Inf' else float(le)
+        return None
+
+
+class Metrics:
+    """
+    Thread safe registry of counters and histograms, each with any number of label sets
+
+    Ex. METRICS.inc('fandom_images_total', result='downloaded')
+        with METRICS.time_stage('parse'): ...
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """Observe how long the block takes, even if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def time_stage(self, stage: str) -> Iterator[None]:
+        """Time a stage of the crawl into fandom_stage_seconds, and count the exceptions it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.inc('fandom_stage_errors_total', stage=stage, error=type(e).__name__)
+            raise
+        finally:
+            self.observe('fandom_stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def timed_stage(self, stage: str):
+        """Decorator version of time_stage"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapped(*args, **kwargs):
+                with self.time_stage(stage):
+                    return func(*args, **kwargs)
+            return wrapped
+        return decorator
+
+    def snapshot(self) -> dict:
+        """Everything recorded so far as plain data"""
+        with self._lock:
+            counters = {name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                        for name, series in self.counters.items()}
+            histograms = {name: [{'labels': dict(key), 'count': h.count, 'sum': h.sum,
+                                  'p50': h.quantile(0.5), 'p95': h.quantile(0.95), 'p99': h.quantile(0.99),
+                                  'buckets': dict(h.cumulative())}
+                                 for key, h in series.items()]
+                          for name, series in self.histograms.items()}
+        return {'time': time.time(), 'uptime_seconds': time.time() - self.started,
+                'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self) -> str:
+        """Everything recorded so far in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                _header(lines, name, 'counter')
+                for key, value in sorted(series.items()):
+                    lines.append(name + _format_labels(key) + ' ' + repr(float(value)))
+            for name, series in sorted(self.histograms.items()):
+                _header(lines, name, 'histogram')
+                for key, h in sorted(series.items()):
+                    for le, total in h.cumulative():
+                        lines.append(name + '_bucket' + _format_labels(key + (('le', le),)) + ' ' + str(total))
+                    lines.append(name + '_sum' + _format_labels(key) + ' ' + repr(h.sum))
+                    lines.append(name + '_count' + _format_labels(key) + ' ' + str(h.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _header(lines: List[str], name: str, kind: str) -> None:
+    help_text = METRIC_HELP.get(name, (kind, ''))[1]
+    if help_text:
+        lines.append('# HELP ' + name + ' ' + help_text)
+    lines.append('# TYPE ' + name + ' ' + kind)
+
+
+def _format_labels(key: Labels) -> str:
+    if not key:
+        return ''
+    escaped = (k + '="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in key)
+    return '{' + ','.join(escaped) + '}'
+
+
+# The registry every module records into
+METRICS = Metrics()
+
+
+class MetricsExporter:
+    """
+    Writes a Metrics registry to disk every interval seconds from a background thread
+
+    Parameters
+    ----------
+    metrics : Metrics
+        The registry to export, usually METRICS.
+    json_path : str, optional
+        JSON snapshot, with 'rates' holding each counter's increase per second since the last
+        snapshot (ex. fandom_images_total{result=downloaded} is the images per second right now).
+    prom_path : str, optional
+        Prometheus text file.
+    interval : float, optional
+        Seconds between snapshots. The default is 30.
+
+    """
+
+    def __init__(self, metrics: Metrics, json_path: str = None, prom_path: str = None, interval: float = 30):
+        self.metrics = metrics
+        self.json_path = json_path
+        self.prom_path = prom_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._previous = None
+
+    def start(self) -> 'MetricsExporter':
+        self._thread = threading.Thread(target=self._run, name='metrics-exporter', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop the thread and write one last snapshot"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.export()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.export()
+            except OSError as e:
+                print('Could not write the metrics: ' + repr(e))
+
+    def export(self) -> None:
+        snapshot = self.metrics.snapshot()
+        snapshot['rates'] = self._rates(snapshot)
+        if self.json_path is not None:
+            _write_atomic(self.json_path, json.dumps(snapshot, indent=1))
+        if self.prom_path is not None:
+            _write_atomic(self.prom_path, self.metrics.to_prometheus())
+
+    def _rates(self, snapshot: dict) -> dict:
+        """Increase per second of every counter since the previous snapshot (or since the start)"""
+        previous = self._previous or {'time': self.metrics.started, 'counters': {}}
+        elapsed = max(snapshot['time'] - previous['time'], 1e-9)
+        before = {(name, json.dumps(s['labels'], sort_keys=True)): s['value']
+                  for name, series in previous['counters'].items() for s in series}
+        rates = {}
+        for name, series in snapshot['counters'].items():
+            rates[name] = [{'labels': s['labels'],
+                            'per_second': (s['value'] - before.get((name, json.dumps(s['labels'], sort_keys=True)), 0)) / elapsed}
+                           for s in series]
+        self._previous = snapshot
+        return rates
+
+
+def _write_atomic(path: str, text: str) -> None:
+    # Readers (ex. the textfile collector) never see a half written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as tmp_file:
+        tmp_file.write(text)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import sys
+
+import httpx
+import pytest
+
+# The package, as python -m fandom_wikia_image_downloader finds it from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 400
+
+
+class StreamedBody(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """A body that arrives in chunks, like a real server's. httpx reads a content= body up front."""
+
+    def __init__(self, data: bytes, chunk_size: int = 16 * 1024):
+        self.chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    def __iter__(self):
+        yield from self.chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+class FakeSite:
+    """
+    Answers requests for the urls in bodies, with an ETag for each body, and 404 for the rest. Every
+    request is kept in requests. headers adds response headers to a url, ex. a wrong Content-Length.
+    """
+
+    def __init__(self):
+        self.bodies = {}
+        self.headers = {}
+        self.requests = []
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        url = str(request.url)
+        if url not in self.bodies:
+            return httpx.Response(404)
+        body = self.bodies[url]
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if request.headers.get('If-None-Match') == etag:
+            return httpx.Response(304, headers={'ETag': etag})
+        headers = dict({'ETag': etag, 'Content-Length': str(len(body))}, **self.headers.get(url, {}))
+        return httpx.Response(200, headers=headers, stream=StreamedBody(body))
+
+    def requested(self, url: str) -> list:
+        return [r for r in self.requests if str(r.url) == url]
+
+    def client(self) -> httpx.Client:
+        return httpx.Client(transport=httpx.MockTransport(self.handler))
+
+    def async_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+
+
+@pytest.fixture
+def site():
+    return FakeSite()
@@ -0,0 +1,98 @@
+import asyncio
+import os
+from urllib.error import ContentTooShortError
+
+import pytest
+
+from conftest import PNG
+from fandom_wikia_image_downloader.async_crawler import AsyncDomainCrawler
+from fandom_wikia_image_downloader.http_cache import CachedSession
+from fandom_wikia_image_downloader.image_store import ContentStore
+
+IMAGE_URL = 'https://static.wikia.nocookie.net/llama/images/a/ab/Llama/revision/latest'
+DOMAIN = 'https://llama.fandom.com/'
+
+
+def files_under(folder):
+    return sorted(os.path.relpath(os.path.join(root, name), folder)
+                  for root, _, names in os.walk(folder) for name in names)
+
+
+def download(site, download_dir, url=IMAGE_URL, store=None):
+    async def run():
+        async with AsyncDomainCrawler(download_dir, store=store) as crawler:
+            crawler.client = site.async_client()
+            return await crawler.download_image(url, None, 'llama')
+    return asyncio.run(run())
+
+
+def test_image_is_streamed_to_its_path(site, tmp_path):
+    site.bodies[IMAGE_URL] = PNG
+    assert download(site, str(tmp_path))
+    [path] = files_under(str(tmp_path))
+    # Named after the url, with the format its first bytes give
+    assert path.startswith('llama' + os.sep) and path.endswith('.png')
+    assert (tmp_path / path).read_bytes() == PNG
+
+
+def test_short_body_leaves_no_file(site, tmp_path):
+    site.bodies[IMAGE_URL] = PNG
+    site.headers[IMAGE_URL] = {'Content-Length': str(len(PNG) + 10)}
+    with pytest.raises(ContentTooShortError):
+        download(site, str(tmp_path))
+    assert files_under(str(tmp_path)) == []
+
+
+def test_image_is_moved_into_the_store(site, tmp_path):
+    site.bodies[IMAGE_URL] = PNG
+    store = ContentStore(str(tmp_path / 'store'))
+    assert download(site, str(tmp_path / 'images'), store=store)
+    digest = store.lookup(IMAGE_URL)
+    assert (tmp_path / 'store' / 'objects' / digest[:2] / digest[2:4] / (digest + '.png')).read_bytes() == PNG
+    assert os.listdir(store.tmp_dir) == []
+    store.close()
+
+
+def test_deleted_image_is_downloaded_again(site, tmp_path):
+    site.bodies[IMAGE_URL] = PNG
+    session = CachedSession(str(tmp_path / 'http_cache'))
+
+    def download_cached():
+        async def run():
+            async with AsyncDomainCrawler(str(tmp_path / 'images'), session=session) as crawler:
+                crawler.client = site.async_client()
+                return await crawler.download_image(IMAGE_URL, None, 'llama')
+        return asyncio.run(run())
+
+    assert download_cached()
+    assert not download_cached()
+    [path] = files_under(str(tmp_path / 'images'))
+    os.remove(tmp_path / 'images' / path)
+    assert download_cached()
+    assert files_under(str(tmp_path / 'images')) == [path]
+    assert 'If-None-Match' not in site.requested(IMAGE_URL)[-1].headers
+
+
+def test_image_on_two_pages_is_downloaded_once(site, tmp_path):
+    site.bodies[IMAGE_URL] = PNG
+
+    async def run():
+        async with AsyncDomainCrawler(str(tmp_path)) as crawler:
+            crawler.client = site.async_client()
+            return await asyncio.gather(crawler.download_image(IMAGE_URL, None, 'llama'),
+                                        crawler.download_image(IMAGE_URL, None, 'llama'))
+    assert sorted(asyncio.run(run())) == [False, True]
+    assert len(site.requested(IMAGE_URL)) == 1
+    assert len(files_under(str(tmp_path))) == 1
+
+
+def test_failing_topic_skips_only_its_categories(site, tmp_path):
+    # The gallery topic is not in site.bodies, so it answers 404
+    site.bodies[DOMAIN + 'index.php?title=Special%3ACategories&from=character'] = (
+        b'<ul class=""><li><a href="/wiki/Category:Characters">Characters</a></li></ul>')
+
+    async def run():
+        async with AsyncDomainCrawler(str(tmp_path)) as crawler:
+            crawler.client = site.async_client()
+            return await crawler.get_domain_categories(DOMAIN)
+    assert asyncio.run(run()) == [DOMAIN + 'wiki/Category:Characters']
@@ -0,0 +1,71 @@
+import pytest
+
+from fandom_wikia_image_downloader.crawl_state import CrawlFrontier, MemoryFrontier, walk_categories
+
+DOMAIN = 'https://llama.fandom.com/'
+CHARACTERS = DOMAIN + 'wiki/Category:Characters'
+MINOR = DOMAIN + 'wiki/Category:Minor_Characters'
+# Each category's members. Minor_Characters links back to Characters
+MEMBERS = {
+    CHARACTERS: [DOMAIN + 'wiki/Llama', MINOR, DOMAIN + 'wiki/File:Llama.png'],
+    MINOR: [DOMAIN + 'wiki/Alpaca', CHARACTERS],
+}
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def frontier(request, tmp_path):
+    frontier = CrawlFrontier(DOMAIN, str(tmp_path / 'crawl_state.db')) if request.param == 'sqlite' else MemoryFrontier()
+    yield frontier
+    frontier.close()
+
+
+def test_every_category_is_checked_once(frontier):
+    checked = []
+
+    def get_members(category_url):
+        checked.append(category_url)
+        return MEMBERS[category_url]
+
+    pages = walk_categories(frontier, [CHARACTERS], get_members)
+    assert sorted(pages) == [DOMAIN + 'wiki/Alpaca', DOMAIN + 'wiki/Llama']
+    assert checked == [CHARACTERS, MINOR]
+
+
+def test_interrupted_crawl_resumes_where_it_stopped(tmp_path):
+    state_path = str(tmp_path / 'crawl_state.db')
+
+    def dropped_connection(category_url):
+        if category_url == MINOR:
+            raise ConnectionError
+        return MEMBERS[category_url]
+
+    frontier = CrawlFrontier(DOMAIN, state_path)
+    with pytest.raises(ConnectionError):
+        walk_categories(frontier, [CHARACTERS], dropped_connection)
+    frontier.close()
+
+    checked = []
+
+    def get_members(category_url):
+        checked.append(category_url)
+        return MEMBERS[category_url]
+
+    frontier = CrawlFrontier(DOMAIN, state_path)
+    assert frontier.is_seeded()
+    walk_categories(frontier, [], get_members)
+    assert checked == [MINOR]
+    frontier.close()
+
+
+def test_downloaded_pages_are_not_pending_after_a_restart(tmp_path):
+    state_path = str(tmp_path / 'crawl_state.db')
+    frontier = CrawlFrontier(DOMAIN, state_path)
+    walk_categories(frontier, [CHARACTERS], MEMBERS.get)
+    frontier.mark_page_done(DOMAIN + 'wiki/Llama')
+    frontier.close()
+
+    frontier = CrawlFrontier(DOMAIN, state_path)
+    assert frontier.pending_pages() == [DOMAIN + 'wiki/Alpaca']
+    frontier.clear()
+    assert not frontier.is_seeded() and frontier.pages() == []
+    frontier.close()
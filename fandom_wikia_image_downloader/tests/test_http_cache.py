@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from conftest import PNG
+from fandom_wikia_image_downloader.http_cache import CacheMiss, CachedSession
+
+PAGE_URL = 'https://llama.fandom.com/wiki/Category:Characters'
+IMAGE_URL = 'https://static.wikia.nocookie.net/llama/images/a/ab/Llama.png/revision/latest'
+
+
+@pytest.fixture
+def session(site, tmp_path):
+    site.bodies[PAGE_URL] = b'<html>llamas</html>'
+    site.bodies[IMAGE_URL] = PNG
+    session = CachedSession(str(tmp_path / 'http_cache'), client=site.client())
+    yield session
+    session.close()
+
+
+def test_unchanged_page_is_revalidated_and_read_from_the_cache(site, session):
+    assert session.get(PAGE_URL) == b'<html>llamas</html>'
+    assert session.get(PAGE_URL) == b'<html>llamas</html>'
+    first, second = site.requested(PAGE_URL)
+    assert 'If-None-Match' not in first.headers
+    assert 'If-None-Match' in second.headers
+
+
+def test_changed_page_is_downloaded_again(site, session):
+    session.get(PAGE_URL)
+    site.bodies[PAGE_URL] = b'<html>alpacas</html>'
+    assert session.get(PAGE_URL) == b'<html>alpacas</html>'
+
+
+def test_fresh_page_is_not_requested(site, tmp_path):
+    site.bodies[PAGE_URL] = b'<html>llamas</html>'
+    session = CachedSession(str(tmp_path / 'http_cache'), ttl=3600, client=site.client())
+    session.get(PAGE_URL)
+    assert session.get(PAGE_URL) == b'<html>llamas</html>'
+    assert len(site.requested(PAGE_URL)) == 1
+
+
+def test_offline_answers_from_the_cache_only(site, tmp_path):
+    site.bodies[PAGE_URL] = b'<html>llamas</html>'
+    CachedSession(str(tmp_path / 'http_cache'), client=site.client()).get(PAGE_URL)
+    offline = CachedSession(str(tmp_path / 'http_cache'), offline=True, client=site.client())
+    assert offline.get(PAGE_URL) == b'<html>llamas</html>'
+    with pytest.raises(CacheMiss):
+        offline.get(PAGE_URL + '_(anime)')
+    assert len(site.requests) == 1
+
+
+def test_unchanged_image_is_skipped(site, session, tmp_path):
+    path = str(tmp_path / 'Llama.png')
+    assert session.retrieve(IMAGE_URL, path)
+    assert not session.retrieve(IMAGE_URL, path)
+    assert 'If-None-Match' in site.requested(IMAGE_URL)[-1].headers
+
+
+def test_deleted_image_is_downloaded_again(site, session, tmp_path):
+    path = str(tmp_path / 'Llama.png')
+    session.retrieve(IMAGE_URL, path)
+    os.remove(path)
+    assert session.retrieve(IMAGE_URL, path)
+    assert 'If-None-Match' not in site.requested(IMAGE_URL)[-1].headers
+    with open(path, 'rb') as image_file:
+        assert image_file.read() == PNG
+
+
+def test_image_is_downloaded_again_into_a_new_folder(session, tmp_path):
+    session.retrieve(IMAGE_URL, str(tmp_path / 'Llama.png'))
+    os.mkdir(tmp_path / 'images')
+    assert session.retrieve(IMAGE_URL, str(tmp_path / 'images' / 'Llama.png'))
+    assert os.path.exists(tmp_path / 'images' / 'Llama.png')
+
+
+def test_image_named_after_its_content_type(site, session, tmp_path):
+    site.headers[IMAGE_URL] = {'Content-Type': 'image/png'}
+
+    def path(content_type):
+        return str(tmp_path / ('Llama.png' if content_type == 'image/png' else 'Llama.bin'))
+
+    assert session.retrieve(IMAGE_URL, path)
+    assert not session.retrieve(IMAGE_URL, path)
+    os.remove(tmp_path / 'Llama.png')
+    assert session.retrieve(IMAGE_URL, path)
+
+
+def test_offline_image_missing_on_disk(session, tmp_path):
+    path = str(tmp_path / 'Llama.png')
+    session.retrieve(IMAGE_URL, path)
+    offline = CachedSession(session.cache.cache_dir, offline=True)
+    assert not offline.retrieve(IMAGE_URL, path)
+    os.remove(path)
+    with pytest.raises(CacheMiss):
+        offline.retrieve(IMAGE_URL, path)
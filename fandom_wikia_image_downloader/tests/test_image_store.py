@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from conftest import PNG
+from fandom_wikia_image_downloader.http_cache import CachedSession
+from fandom_wikia_image_downloader.image_store import ContentStore
+
+IMAGE_URL = 'https://static.wikia.nocookie.net/llama/images/a/ab/Llama.png/revision/latest'
+COPY_URL = 'https://static.wikia.nocookie.net/alpaca/images/c/cd/Llama.png/revision/latest'
+
+
+def objects_in(store):
+    return [name for _, _, names in os.walk(store.objects_dir) for name in names]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ContentStore(str(tmp_path / 'store'))
+    yield store
+    store.close()
+
+
+def test_same_image_from_two_urls_is_stored_once(site, store, tmp_path):
+    site.bodies[IMAGE_URL] = PNG
+    site.bodies[COPY_URL] = PNG
+    session = CachedSession(str(tmp_path / 'http_cache'), client=site.client())
+    digest, downloaded = store.download(IMAGE_URL, None, 'llama', session=session)
+    assert downloaded
+    assert store.download(COPY_URL, None, 'alpaca', session=session) == (digest, True)
+    assert objects_in(store) == [digest + '.png']
+    assert os.listdir(store.tmp_dir) == []
+
+
+def test_url_already_stored_is_not_downloaded(site, store, tmp_path):
+    site.bodies[IMAGE_URL] = PNG
+    session = CachedSession(str(tmp_path / 'http_cache'), client=site.client())
+    digest, _ = store.download(IMAGE_URL, None, 'llama', session=session)
+    assert store.download(IMAGE_URL, None, 'llama', session=session) == (digest, False)
+    assert len(site.requested(IMAGE_URL)) == 1
+
+
+def test_stores_sharing_a_folder_keep_one_copy(store):
+    # Like two processes storing the same image, neither knowing about the other's download
+    other = ContentStore(store.root)
+    digest = store.add_bytes(IMAGE_URL, PNG, 'png')
+    assert other.add_bytes(COPY_URL, PNG, 'png') == digest
+    assert other.lookup(IMAGE_URL) == store.lookup(COPY_URL) == digest
+    assert objects_in(store) == [digest + '.png']
+    assert os.listdir(store.tmp_dir) == []
+    other.close()
+
+
+def test_removed_image_is_stored_again_for_a_new_url(store, tmp_path):
+    digest = store.add_bytes(IMAGE_URL, PNG, 'png')
+    store.remove(store.object_path(digest, 'png'))
+    assert objects_in(store) == []
+    # The old url is still known, so it isn't downloaded again
+    assert store.lookup(IMAGE_URL) == digest
+    image_path = tmp_path / 'Llama.part'
+    image_path.write_bytes(PNG)
+    store.add_file(COPY_URL, str(image_path), None)
+    assert not image_path.exists()
+    with open(store.object_path(digest, 'png'), 'rb') as image_file:
+        assert image_file.read() == PNG
@@ -0,0 +1,61 @@
+import random
+
+import numpy as np
+from PIL import Image
+
+from fandom_wikia_image_downloader.near_duplicates import BKTree, NearDuplicateIndex, hamming, hash_file, phash
+
+
+def picture(seed, size=256):
+    """A smooth random picture, like a photo at low frequencies"""
+    colours = np.random.default_rng(seed).integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    return Image.fromarray(colours).resize((size, size), Image.BICUBIC)
+
+
+def test_resized_and_reencoded_copies_hash_alike(tmp_path):
+    llama = picture(1)
+    llama.save(tmp_path / 'Llama.jpg', quality=50)
+    _, reencoded, pixels = hash_file(str(tmp_path / 'Llama.jpg'))
+    assert pixels == 256 * 256
+    assert hamming(phash(llama), phash(llama.resize((128, 128)))) <= 6
+    assert hamming(phash(llama), reencoded) <= 6
+    assert hamming(phash(llama), phash(picture(2))) > 6
+
+
+def test_file_that_is_not_an_image_has_no_hash(tmp_path):
+    (tmp_path / 'Llama.png').write_bytes(b'<html>Not found</html>')
+    assert hash_file(str(tmp_path / 'Llama.png')) == (str(tmp_path / 'Llama.png'), None, 0)
+
+
+def test_nearest_finds_the_closest_hash_within_the_distance():
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(500)]
+    tree = BKTree()
+    for key in hashes:
+        tree.add(key, key)
+    for _ in range(50):
+        key = rng.choice(hashes) ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64))
+        distance, node = tree.nearest(key, 6)
+        assert distance == min(hamming(key, h) for h in hashes) == hamming(key, node[1])
+    assert BKTree().nearest(0, 64) is None
+
+
+def test_bigger_copy_is_kept_and_the_smaller_dropped(tmp_path):
+    small, big, other = (str(tmp_path / name) for name in ('small.png', 'big.png', 'other.png'))
+    picture(1, 128).save(small)
+    picture(1, 256).save(big)
+    picture(2).save(other)
+    index = NearDuplicateIndex(str(tmp_path / 'near_duplicates.db'), drop=True)
+    assert index.add(*hash_file(small)) is None
+    assert index.add(*hash_file(other)) is None
+    assert index.add(*hash_file(big)) == small
+    assert index.duplicates() == {big: [small]}
+    assert not (tmp_path / 'small.png').exists() and (tmp_path / 'big.png').exists()
+    index.close()
+
+    # The kept images are loaded back into the tree, so a copy found on the next run is caught too
+    index = NearDuplicateIndex(str(tmp_path / 'near_duplicates.db'))
+    picture(1, 64).save(tmp_path / 'tiny.png')
+    assert index.add(*hash_file(str(tmp_path / 'tiny.png'))) == str(tmp_path / 'tiny.png')
+    assert sorted(index.duplicates()[big]) == [small, str(tmp_path / 'tiny.png')]
+    index.close()
@@ -0,0 +1,91 @@
+import pytest
+
+from fandom_wikia_image_downloader import throttle
+from fandom_wikia_image_downloader.throttle import CircuitOpen, HostThrottle, parse_retry_after
+
+PAGE_URL = 'https://llama.fandom.com/wiki/Llama'
+OTHER_HOST_URL = 'https://static.wikia.nocookie.net/llama/images/a/ab/Llama.png'
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttle.time, 'monotonic', clock)
+    return clock
+
+
+def test_requests_after_the_burst_are_spaced_out(clock):
+    limiter = HostThrottle(rate=2, burst=2)
+    assert [limiter.reserve(PAGE_URL) for _ in range(4)] == [0, 0, 0.5, 1.0]
+    # Each host has its own bucket
+    assert limiter.reserve(OTHER_HOST_URL) == 0
+    clock.now += 10
+    assert limiter.reserve(PAGE_URL) == 0
+
+
+def test_throttled_host_slows_down_and_honours_retry_after(clock):
+    limiter = HostThrottle(rate=2, burst=1)
+    limiter.reserve(PAGE_URL)
+    assert limiter.on_response(PAGE_URL, 429, {'Retry-After': '10'}) >= 10
+    assert limiter.host_rate(PAGE_URL) == 1
+    assert limiter.reserve(PAGE_URL) == 10
+    # Other hosts don't wait
+    assert limiter.reserve(OTHER_HOST_URL) == 0
+
+
+def test_successes_speed_up_to_max_rate(clock):
+    limiter = HostThrottle(rate=2, max_rate=2.1, increase=0.05)
+    limiter.on_response(PAGE_URL, 200)
+    assert limiter.host_rate(PAGE_URL) == pytest.approx(2.05)
+    limiter.on_response(PAGE_URL, 200)
+    limiter.on_response(PAGE_URL, 200)
+    assert limiter.host_rate(PAGE_URL) == 2.1
+
+
+def test_only_failures_worth_retrying_are_retried(clock):
+    limiter = HostThrottle(max_retries=2)
+    assert limiter.on_response(PAGE_URL, 404) is None
+    assert limiter.on_response(PAGE_URL, 500, attempt=1) is not None
+    assert limiter.on_response(PAGE_URL, 500, attempt=2) is None
+    assert limiter.on_error(PAGE_URL, attempt=2) is None
+
+
+def test_circuit_opens_and_lets_one_trial_through(clock):
+    limiter = HostThrottle(failure_threshold=3, cooldown=30)
+    for _ in range(3):
+        limiter.on_error(PAGE_URL)
+    with pytest.raises(CircuitOpen):
+        limiter.reserve(PAGE_URL)
+    limiter.reserve(OTHER_HOST_URL)
+
+    clock.now += 31
+    limiter.reserve(PAGE_URL)
+    with pytest.raises(CircuitOpen):
+        limiter.reserve(PAGE_URL)
+    # The trial failed, so the circuit stays open for twice as long
+    limiter.on_response(PAGE_URL, 503)
+    clock.now += 31
+    with pytest.raises(CircuitOpen) as e:
+        limiter.reserve(PAGE_URL)
+    assert e.value.retry_in == pytest.approx(29)
+
+    clock.now += 30
+    limiter.reserve(PAGE_URL)
+    limiter.on_response(PAGE_URL, 200)
+    clock.now += 10
+    assert limiter.reserve(PAGE_URL) == 0
+
+
+def test_retry_after_as_seconds_or_a_date():
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
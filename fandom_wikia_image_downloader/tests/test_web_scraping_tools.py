@@ -0,0 +1,17 @@
+from fandom_wikia_image_downloader.web_scraping_tools import get_download_path
+
+IMAGE_URL = 'https://static.wikia.nocookie.net/llama/images/a/ab/Llama.png/revision/latest'
+
+
+def test_same_url_gets_the_same_path(tmp_path):
+    path = get_download_path('png', 'llama', str(tmp_path), img_src=IMAGE_URL)
+    open(path, 'wb').close()
+    # So a download of it again replaces the file
+    assert get_download_path('png', 'llama', str(tmp_path), img_src=IMAGE_URL) == path
+    assert get_download_path('png', 'llama', str(tmp_path), img_src=IMAGE_URL + '?cb=2') != path
+
+
+def test_taken_name_without_a_url_gets_a_suffix(tmp_path):
+    path = get_download_path('png', 'llama', str(tmp_path), img_name='Llama')
+    open(path, 'wb').close()
+    assert get_download_path('png', 'llama', str(tmp_path), img_name='Llama') == path[:-len('.png')] + '_(1).png'
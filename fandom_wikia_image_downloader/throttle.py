@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Per-host request throttling for the scrapers.
+
+Every host gets a token bucket that starts at a polite rate and adapts to how the server answers:
+each successful response raises the rate a little, and each 429 or 503 halves it (additive increase,
+multiplicative decrease). A Retry-After header pauses the whole host for as long as it asks.
+Failed requests are retried after an exponential backoff with full jitter, so many requests that
+failed together don't all come back at the same moment.
+
+Each host also has a circuit breaker. After enough failures in a row (5xx, 429 or connection errors)
+the circuit opens and nothing more is sent to that host: reserve raises CircuitOpen, and wait and
+async_wait hold the request back instead. Once the cooldown has passed, one trial request is let
+through. If it succeeds the circuit closes and the waiting requests go ahead, if it fails the
+circuit opens again for twice as long.
+
+The same HostThrottle works for the threaded crawl (wait) and the asyncio crawl (async_wait), and
+can be shared by both.
+"""
+import asyncio
+import random
+import threading
+import time
+from email.message import Message
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+
+# Responses that mean the server wants fewer requests
+THROTTLE_STATUSES = {429, 503}
+# Responses that are worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# A host's rate is cut at most once in this many seconds, so a burst of requests that were all in
+# flight when the server started refusing them only counts as one slow down
+DECREASE_INTERVAL = 1.0
+
+
+class CircuitOpen(HTTPError):
+    """
+    Raised instead of sending a request to a host whose circuit breaker is open. It is an HTTPError
+    with status 503, so callers that skip pages that fail to load skip it too.
+    """
+
+    def __init__(self, url: str, retry_in: float):
+        super().__init__(url, 503, 'Circuit open, host is backing off for ' + str(round(retry_in, 1)) + ' s',
+                         Message(), None)
+        # Seconds until the circuit may let a request through again
+        self.retry_in = retry_in
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds to wait from a Retry-After header, given either as seconds or as an HTTP date.
+    None if there is no header or it can't be read.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def backoff_delay(attempt: int, base_delay: float = 1, max_delay: float = 300) -> float:
+    """Exponential backoff with full jitter: a random delay up to base_delay * 2 ** attempt, capped at max_delay"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class _HostState:
+    """Token bucket and circuit breaker of one host"""
+
+    def __init__(self, host: str, rate: float, burst: float, cooldown: float):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # Nothing is sent to the host before this time (Retry-After)
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+        self.cooldown = cooldown
+        # When the trial request of a half open circuit was sent, 0 if there isn't one
+        self.trial_started = 0.0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class HostThrottle:
+    """
+    Adaptive rate limiting, retry backoff and circuit breaking, kept separately for every host
+
+    Parameters
+    ----------
+    rate : float, optional
+        Requests per second each host starts at. The default is 2.
+    min_rate, max_rate : float, optional
+        The rate never goes below or above these. The defaults are 0.05 (one request every 20 s)
+        and 20.
+    increase : float, optional
+        Requests per second added to a host's rate after each successful response. The default is 0.05.
+    decrease : float, optional
+        Factor a host's rate is multiplied by after a 429 or 503. The default is 0.5.
+    burst : float, optional
+        Requests that can be sent at once after a host has been idle. The default is 4.
+    max_retries : int, optional
+        Times a failed request is retried before giving up. The default is 5.
+    base_delay, max_delay : float, optional
+        The first retry waits up to base_delay seconds and each retry after that up to twice as long,
+        never more than max_delay. The defaults are 1 and 300.
+    failure_threshold : int, optional
+        Failures in a row that open a host's circuit. The default is 5.
+    cooldown, max_cooldown : float, optional
+        Seconds a circuit stays open the first time, and at most after repeated failures. The
+        defaults are 30 and 600.
+
+    """
+
+    def __init__(self, rate: float = 2, min_rate: float = 0.05, max_rate: float = 20, increase: float = 0.05,
+                 decrease: float = 0.5, burst: float = 4, max_retries: int = 5, base_delay: float = 1,
+                 max_delay: float = 300, failure_threshold: int = 5, cooldown: float = 30,
+                 max_cooldown: float = 600):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # Shared by the domain worker threads
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, _HostState] = {}
+
+    def _host(self, url: str) -> _HostState:
+        host = urlsplit(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = _HostState(host, self.rate, self.burst, self.cooldown)
+        return self._hosts[host]
+
+    def host_rate(self, url: str) -> float:
+        """The current requests per second allowed to the host of url"""
+        with self._lock:
+            return self._host(url).rate
+
+    def reserve(self, url: str) -> float:
+        """
+        Take a token for a request to url and return how many seconds to wait before sending it.
+        Raises CircuitOpen if the host's circuit is open.
+        """
+        with self._lock:
+            state = self._host(url)
+            now = time.monotonic()
+            if state.open_until:
+                if now < state.open_until:
+                    raise CircuitOpen(url, state.open_until - now)
+                # A trial that never reported back (ex. it raised something else) is given up on
+                if now - state.trial_started < state.cooldown:
+                    # Check back soon for the result of the trial request
+                    raise CircuitOpen(url, self.base_delay)
+                # Half open, let one trial request through
+                state.trial_started = now
+            state.refill(now)
+            # The token is taken now even if it hasn't been refilled yet, so the requests waiting on
+            # a host are spaced out instead of all being sent when the next token arrives
+            state.tokens -= 1
+            wait = -state.tokens / state.rate if state.tokens < 0 else 0.0
+            return max(wait, state.paused_until - now)
+
+    def wait(self, url: str) -> None:
+        """Block until a request to url may be sent, including while the host's circuit is open"""
+        while True:
+            try:
+                delay = self.reserve(url)
+                break
+            except CircuitOpen as e:
+                time.sleep(e.retry_in)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def async_wait(self, url: str) -> None:
+        """wait for the asyncio crawl, sleeping without blocking the event loop"""
+        while True:
+            try:
+                delay = self.reserve(url)
+                break
+            except CircuitOpen as e:
+                await asyncio.sleep(e.retry_in)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def on_response(self, url: str, status: int, headers=None, attempt: int = 0) -> Optional[float]:
+        """
+        Adapt the host's rate to a response, and return the seconds to wait before retrying it, or
+        None if it shouldn't be retried (it succeeded, it can't be fixed by retrying, or attempt
+        has reached max_retries).
+        """
+        retry_after = parse_retry_after(headers.get('Retry-After')) if headers is not None else None
+        with self._lock:
+            state = self._host(url)
+            if status in THROTTLE_STATUSES:
+                now = time.monotonic()
+                if now - state.last_decrease >= DECREASE_INTERVAL:
+                    state.rate = max(self.min_rate, state.rate * self.decrease)
+                    state.last_decrease = now
+                # Don't let the tokens saved up while idle undo the slow down
+                state.tokens = min(state.tokens, 0)
+                if retry_after is not None:
+                    state.paused_until = max(state.paused_until, now + retry_after)
+            elif status < 500:
+                state.rate = min(self.max_rate, state.rate + self.increase)
+            if status in RETRY_STATUSES:
+                self._failed(state)
+            else:
+                self._succeeded(state)
+        if status not in RETRY_STATUSES or attempt >= self.max_retries:
+            return None
+        delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    def on_error(self, url: str, attempt: int = 0) -> Optional[float]:
+        """
+        Record a request to url that failed without a response, ex. a dropped connection, and return
+        the seconds to wait before retrying it, or None once attempt has reached max_retries.
+        """
+        with self._lock:
+            self._failed(self._host(url))
+        if attempt >= self.max_retries:
+            return None
+        return backoff_delay(attempt, self.base_delay, self.max_delay)
+
+    def _succeeded(self, state: _HostState) -> None:
+        state.failures = 0
+        state.open_until = 0.0
+        state.cooldown = self.cooldown
+        state.trial_started = 0.0
+
+    def _failed(self, state: _HostState) -> None:
+        state.failures += 1
+        if state.trial_started:
+            # The trial request failed, stay open for twice as long
+            state.cooldown = min(self.max_cooldown, state.cooldown * 2)
+            state.open_until = time.monotonic() + state.cooldown
+            state.trial_started = 0.0
+        elif state.failures >= self.failure_threshold and not state.open_until:
+            print('Too many failures from ' + state.host + ', backing off for ' + str(round(state.cooldown)) + ' s')
+            state.open_until = time.monotonic() + state.cooldown
@@ -1,19 +1,138 @@
 # -*- coding: utf-8 -*-
 import os
 import datetime
-from urllib.request import urlopen, urlretrieve
+import functools
+import hashlib
+from urllib.request import urlretrieve
 import re
+from typing import Iterator, Optional
+import shutil
+from pathlib import Path
 
 
 #download_dir = ''
 
-def check_filetype(absolute_url: str):
-    formats = ['png', 'jpg', 'jpeg', 'bmp']
-    for fmt in formats:
-        if re.match('.*\.' + fmt, absolute_url, re.IGNORECASE):
-            return fmt
+# Extensions of the image files iter_image_files finds
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp')
 
-def download_image(img_src: str, img_format: str, domain_name: str, download_dir:str, img_name:str=None):
+
+# The extension of an image url: the last one in its path, right before the end of the path, the query
+# string or the fragment. Fandom urls end the path with the revision after the file name:
+# .../images/b/bf/File.png/revision/latest/scale-to-width-down/185?cb=20200619103726
+IMAGE_URL_EXTENSION = re.compile(r'\.(png|jpe?g|bmp)(?=(?:/revision/[^?#]*)?(?:[?#]|$))', re.IGNORECASE)
+# Content-Type of a response -> the extension it is saved with
+CONTENT_TYPE_EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/pjpeg': 'jpg', 'image/bmp': 'bmp',
+                           'image/x-ms-bmp': 'bmp', 'image/gif': 'gif', 'image/webp': 'webp'}
+# Leading bytes of each format -> its name. WEBP is checked separately, its magic is split in two
+MAGIC_NUMBERS = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'\x00\x00\x01\x00', 'ico'),
+)
+# Extension a format's files are written with
+FORMAT_EXTENSIONS = {'png': 'png', 'jpeg': 'jpg', 'gif': 'gif', 'bmp': 'bmp', 'webp': 'webp', 'tiff': 'tiff', 'ico': 'ico'}
+# Extension of files whose format couldn't be told
+UNKNOWN_EXTENSION = 'bin'
+
+
+def check_filetype(absolute_url: str) -> Optional[str]:
+    """
+    The extension of an image url, lowercase: 'png', 'jpg', 'jpeg' or 'bmp'. None if its path doesn't
+    end with one.
+
+    Ex. IN: 'https://static.wikia.nocookie.net/pokemon/images/b/bf/Sammy.JPG/revision/latest?cb=20200619103726'
+        OUT: 'jpg'
+
+    """
+    match = IMAGE_URL_EXTENSION.search(absolute_url)
+    return match.group(1).lower() if match else None
+
+
+def sniff_format(header: bytes) -> Optional[str]:
+    """The format of an image from its first bytes, or None if it isn't one of MAGIC_NUMBERS"""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    for magic, name in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return name
+    return None
+
+
+def classify_image(url: str = None, content_type: str = None, header: bytes = None) -> Optional[str]:
+    """
+    The extension to save an image with: from its url, or if that doesn't say, from the
+    Content-Type of the response, or from the first bytes of the file. None if none of them tell.
+    """
+    if url:
+        extension = check_filetype(url)
+        if extension is not None:
+            return extension
+    if content_type:
+        extension = CONTENT_TYPE_EXTENSIONS.get(content_type.split(';')[0].strip().lower())
+        if extension is not None:
+            return extension
+    if header:
+        image_format = sniff_format(header)
+        if image_format is not None:
+            return FORMAT_EXTENSIONS[image_format]
+    return None
+
+def get_download_path(img_format: str, domain_name: str, download_dir: str, img_name: str = None,
+                      img_src: str = None) -> str:
+    """
+    Pick the path an image will be downloaded to, creating its folder if needed.
+
+    Images are sharded by the first four hex digits of a hash, two folder levels deep, so no folder
+    ever holds more than a few hundred files even with tens of millions of images:
+        download_dir/domain_name/ab/cd/<name>.<img_format>
+
+    The name is img_name if it is given, or else the sha1 of img_src, or else the current timestamp.
+    With an img_src the path is always the same for the same arguments, so an image downloaded again
+    replaces the file, and the http cache can tell whether it is still on disk. A path that is taken
+    is overwritten then, even when img_name is shared by several urls, so give each url its own
+    img_name. Without an img_src, a taken name gets a '_(n)' suffix until a free name is found.
+
+    Returns
+    -------
+    str
+        The full path to download the image to.
+
+    """
+    if img_name:
+        name = img_name
+    elif img_src:
+        name = hashlib.sha1(img_src.encode()).hexdigest()
+    else:
+        # Name the image the current timestamp
+        name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    key = name if img_src and not img_name else hashlib.sha1(name.encode()).hexdigest()
+    folder = Path(download_dir, domain_name, key[:2], key[2:4])
+    ensure_dir(folder)
+    download_path = folder / (name + '.' + img_format)
+    if not img_src:
+        count = 0
+        while download_path.exists():
+            count += 1
+            download_path = folder / (name + '_(' + str(count) + ').' + img_format)
+    return str(download_path)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def ensure_dir(folder: Path) -> None:
+    """
+    Create folder and its parents, at most once per folder: after the first image in a folder, the
+    next ones don't touch the filesystem. Only the most recently used folders are remembered.
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+
+
+def download_image(img_src: str, img_format: str, domain_name: str, download_dir:str, img_name:str=None,
+                   store=None, session=None):
     """
     Download the image from the absolute image source
 
@@ -26,39 +145,56 @@ def download_image(img_src: str, img_format: str, domain_name: str, download_dir
         Name of the domain under domain wikia. Ex. 'pokemon' (such as pokemon.domain.com...)
     page_name : str
         Name of the character or gallery page.
+    img_name : str, optional
+        Name to save the image under instead of the sha1 of img_src. An image already saved under
+        the name is replaced (see get_download_path), so every url needs a name of its own.
+    store : image_store.ContentStore, optional
+        Store the image once under the digest of its content instead of under a timestamp in
+        download_dir. Urls the store has already downloaded are skipped.
+    session : http_cache.CachedSession, optional
+        Download over the session's pooled connections. It also skips images that were downloaded
+        before and haven't changed since.
 
     Returns
     -------
-    None.
+    bool
+        True if the image was downloaded, False if there was no image source or it was skipped.
 
     """
     # If there is an image source
     if img_src is not None:
-        # Name the image the current timestamp
-        if img_name:
-            img_name = img_name + '.' + img_format
-        else:
-            img_name = str(datetime.datetime.now().strftime("%Y%m%d-%H%M%S")) + '.' + img_format
-        # Ensure there is a filepath to download to
-        #page_name = page_name.replace('/', '-')
-        #page_name = page_name.replace(':', ' ')
-        if not os.path.exists(download_dir + '\\' + domain_name):
-            os.mkdir(download_dir + '\\' + domain_name)
-        #if not os.path.exists(DOWNLOAD_DIR + '\\' + domain_name + '\\' + page_name):
-        #    os.mkdir(DOWNLOAD_DIR + '\\' + domain_name + '\\' + page_name)
-        # Rename the download path
-        #download_path = DOWNLOAD_DIR + '\\' + domain_name + '\\' + page_name + '\\' + img_name
-        download_path = download_dir + '\\' + domain_name + '\\' + img_name
-        if os.path.exists(download_path):
-            count = 0
-            img_name = str(datetime.datetime.now().strftime("%Y%m%d-%H%M%S")) + '_(0).' + img_format
-            while os.path.exists(download_path):
-                img_name = img_name.replace('_(' + str(count) + ').', '_(' + str(count + 1) + ').')
-                img_name = img_name.replace('_(0).', '.')
-                download_path = download_dir + '\\' + domain_name + '\\' + img_name
-                count += 1
-        
-        # Download the image to the download path specified
+        if store is not None:
+            return store.download(img_src, img_format, domain_name, session=session)[1]
+
+        if img_format is None:
+            # The url doesn't say, so the file is named once the response's Content-Type is known
+            def name_from_response(content_type: str) -> str:
+                return get_download_path(classify_image(content_type=content_type) or UNKNOWN_EXTENSION,
+                                         domain_name, download_dir, img_name, img_src)
+            if session is not None:
+                return session.retrieve(img_src, name_from_response)
+            tmp_path, headers = urlretrieve(img_src)
+            shutil.move(tmp_path, name_from_response(headers.get('Content-Type')))
+            return True
+
+        download_path = get_download_path(img_format, domain_name, download_dir, img_name, img_src)
+
+        # Download the image to the download path specified, replacing an earlier download of it
+        if session is not None:
+            return session.retrieve(img_src, download_path)
         urlretrieve(img_src, download_path)
         #time.sleep(1)
+        return True
+    return False
+
 
+def iter_image_files(folder: str) -> Iterator[str]:
+    """Every image under folder, walked lazily so huge folders are never listed all at once"""
+    stack = [folder]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield entry.path
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+Page parsing for the fandom wikia image downloader.
+
+These functions only look at html that has already been downloaded, so the same discovery logic
+can be shared by the serial crawl in fandom_wikia_image_downloader_03.py and the asyncio crawl in
+async_crawler.py.
+
+Pages are parsed with one of PARSER_BACKENDS, chosen with set_parser_backend. The default is the
+fastest one installed: selectolax, then lxml, then html.parser. Character and image links are found
+with CSS selectors that are compiled once, instead of find_all matching regexes against every
+attribute of every tag. bench_parsers.py compares the backends on a folder of saved pages.
+
+Fandom serves every file under many urls: each thumbnail size and crop, lazy loaded copies in
+data-src, and the old vignette, images.wikia.com and img.wikia.nocookie.net hosts. parse_image_urls
+collapses them with canonical_image_url to the one full size url of each file, so each image is
+only downloaded once.
+"""
+import re
+from importlib.util import find_spec
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import soupsieve
+from bs4 import BeautifulSoup
+
+from .telemetry import METRICS
+from .web_scraping_tools import check_filetype
+
+
+PARSER_BACKENDS = ('html.parser', 'lxml', 'selectolax')
+# The fastest backend that is installed
+_parser_backend = next(b for b in ('selectolax', 'lxml', 'html.parser') if b == 'html.parser' or find_spec(b))
+
+# Selectors used by parse_category_members and parse_image_urls
+SELECTORS = {
+    'members_block': 'div.category-page__members',
+    'member_links': 'a[href*="/wiki/"][class*="category-page__member-"]',
+    'page_title': 'h1.page-header__title',
+    'article_by_id': 'div#WikiaArticle',
+    'article_by_class': 'div.WikiaArticle',
+    'article_images': 'img[src], img[data-src]',
+}
+_COMPILED_SELECTORS = {name: soupsieve.compile(css) for name, css in SELECTORS.items()}
+
+# Every host fandom has served the same image files from
+_IMAGE_HOST = r'^(?:https?:)?//(?:static|vignette\d?|images?\d?|img\d?)\.wikia\.(?:nocookie\.net|com)/'
+# Variants of an image url, tried in order. Each match gives the wiki, the file path under images/
+# (hash folders and file name), and when there are some the language, revision and query string.
+# Whatever else is in the url (scale-to-width-down/185, thumbnail/width/360/height/450, top-crop,
+# format/webp, the NNNpx- name of an old thumbnail...) only picks a size, and is dropped.
+IMAGE_URL_PATTERNS = (
+    # Old thumbnails: img.wikia.nocookie.net/__cb20120101/wiki/de/images/thumb/a/ab/File.png/200px-File.png
+    re.compile(_IMAGE_HOST + r'(?:__cb(?P<cb>\d+)/)?(?P<wiki>[^/]+)/(?:(?P<lang>[a-z-]+)/)?images/thumb/'
+               r'(?P<path>\w/\w\w/[^/?#]+)/[^?#]*(?:\?(?P<query>[^#]*))?', re.IGNORECASE),
+    # static.wikia.nocookie.net/wiki/images/a/ab/File.png/revision/latest/scale-to-width-down/185?cb=2020...
+    # and the same on vignette, or without the revision on images.wikia.com
+    re.compile(_IMAGE_HOST + r'(?:__cb(?P<cb>\d+)/)?(?P<wiki>[^/]+)/(?:(?P<lang>[a-z-]+)/)?images/'
+               r'(?P<path>\w/\w\w/[^/?#]+)(?:/revision/(?P<revision>latest|\d+))?[^?#]*(?:\?(?P<query>[^#]*))?',
+               re.IGNORECASE),
+)
+# The parts of the query string that are kept: the cache buster, and the language of the wiki
+_CB_PATTERN = re.compile(r'(?:^|&)cb=(\d+)')
+_PATH_PREFIX_PATTERN = re.compile(r'(?:^|&)path-prefix=([a-z-]+)', re.IGNORECASE)
+
+# Establish the pattern that Category urls follow
+CATEGORY_PATTERN = re.compile('.*Category:.*')
+FILE_PATTERN = re.compile('.*File:.*')
+
+# Topics searched for on a domain's Special:Categories page
+CATEGORY_TOPICS = ['character', 'gallery']
+
+# Links to a wiki's main page in the community search results
+SEARCH_RESULT_PATTERN = re.compile(r'https://((?!www|community-search|anime-database).)*\.fandom\.com/$')
+
+
+def set_parser_backend(backend: str) -> None:
+    """
+    Choose the parser used for every page: 'html.parser', 'lxml' or 'selectolax'.
+    lxml and selectolax have to be installed to be used.
+    """
+    global _parser_backend
+    if backend not in PARSER_BACKENDS:
+        raise ValueError('Unknown parser backend ' + repr(backend) + ', expected one of ' + str(PARSER_BACKENDS))
+    if backend != 'html.parser' and not find_spec(backend):
+        raise ValueError(backend + ' is not installed')
+    _parser_backend = backend
+
+
+def get_parser_backend() -> str:
+    return _parser_backend
+
+
+def make_soup(html) -> BeautifulSoup:
+    """
+    Parse html into BeautifulSoup with the fastest BeautifulSoup parser allowed by the backend.
+    selectolax can't build a BeautifulSoup object, so lxml (or html.parser) is used for it.
+    """
+    if _parser_backend == 'html.parser' or not find_spec('lxml'):
+        return BeautifulSoup(html, 'html.parser')
+    return BeautifulSoup(html, 'lxml')
+
+
+def _parse(html):
+    if _parser_backend == 'selectolax':
+        try:
+            from selectolax.lexbor import LexborHTMLParser as HTMLParser
+        except ImportError:
+            # selectolax before 0.3.13 only has the modest parser
+            from selectolax.parser import HTMLParser
+        return HTMLParser(html)
+    return BeautifulSoup(html, _parser_backend)
+
+
+def _select_one(node, name: str):
+    if _parser_backend == 'selectolax':
+        return node.css_first(SELECTORS[name])
+    return _COMPILED_SELECTORS[name].select_one(node)
+
+
+def _select(node, name: str) -> list:
+    if _parser_backend == 'selectolax':
+        return node.css(SELECTORS[name])
+    return _COMPILED_SELECTORS[name].select(node)
+
+
+def _attr(node, name: str) -> str:
+    if _parser_backend == 'selectolax':
+        return node.attributes.get(name)
+    return node.get(name)
+
+
+def categories_search_url(domain_base_link: str, topic: str) -> str:
+    """
+    Build the Special:Categories url listing the categories of a domain starting at topic
+
+    Ex. IN: 'https://llama.fandom.com/', 'character'
+        OUT: 'https://llama.fandom.com/index.php?title=Special%3ACategories&from=character'
+
+    """
+    return domain_base_link + 'index.php?title=Special%3ACategories&from=' + topic
+
+
+def community_search_url(search_term: str, pagenum: int) -> str:
+    """
+    Build the url of one page of the fandom community search for search_term
+
+    Ex. IN: 'jojo', 2
+        OUT: 'https://ucp.fandom.com/wiki/Special:SearchCommunity?query=jojo&page=2'
+
+    """
+    # If no domains are found, try changing the url being opened below to "https://community-search.fandom.com/wiki/Special:Search?search="
+    return 'https://ucp.fandom.com/wiki/Special:SearchCommunity?query=' + search_term + '&page=' + str(pagenum)
+
+
+@METRICS.timed_stage('parse')
+def parse_search_results(html) -> List[str]:
+    """
+    Find the domain base links on a page of community search results. An empty list means the
+    results have run out.
+    """
+    soup = make_soup(html)
+    return [link['href'] for link in soup.find_all('a', {'href': SEARCH_RESULT_PATTERN, 'class': 'result-link'})]
+
+
+def get_domain_name(domain_base_link: str):
+    """
+    Parse the domain base link into the name of the domain.
+    
+    Ex. IN: 'https://godofhighschool.fandom.com/'
+        OUT: godofhighschool
+
+    """
+    domain_name = re.sub('/wiki/.*', '', domain_base_link)
+    domain_name = domain_name.replace('https://', '')
+    domain_name = domain_name.replace('.fandom.com/', '')
+    return domain_name
+
+
+@METRICS.timed_stage('parse')
+def parse_domain_categories(html, domain_base_link: str) -> List[str]:
+    """
+    Find the character and gallery category links on a Special:Categories page
+
+    Parameters
+    ----------
+    html
+        The page returned by categories_search_url. Anything BeautifulSoup accepts.
+    domain_base_link : str
+        The full url of the main page for a domain. Ex. 'https://llama.fandom.com/'
+
+    Returns
+    -------
+    List[str]
+        Absolute category urls, in the order they appear on the page. May contain duplicates.
+
+    """
+    soup = make_soup(html)
+    category_pages = soup.find('ul', {'class': ''}).find_all('a', {'href': re.compile('/wiki/Category:.*(Character|Gallery).*')})
+    # link['href'][1:] is just the wiki/Chategory:Characters stuff, just without the '/' in front
+    return [domain_base_link + link['href'][1:] for link in category_pages]
+
+
+@METRICS.timed_stage('parse')
+def parse_category_members(html, domain_base_link: str) -> List[str]:
+    """
+    Find the member links (characters, sub-categories and files) on a category page
+
+    Raises AttributeError if the page has no category member block.
+
+    """
+    page = _parse(html)
+    characters_block = _select_one(page, 'members_block')
+    if characters_block is None:
+        raise AttributeError('No category members block')
+    return [domain_base_link + _attr(x, 'href') for x in _select(characters_block, 'member_links')]
+
+
+def _match_image_url(url: str):
+    for pattern in IMAGE_URL_PATTERNS:
+        match = pattern.match(url)
+        if match:
+            return match
+    return None
+
+
+def _image_url_parts(url: str) -> Optional[Tuple[str, str]]:
+    """(key, cache buster) of a fandom image url, None if it isn't one"""
+    match = _match_image_url(url)
+    if match is None:
+        return None
+    groups = match.groupdict()
+    query = groups['query'] or ''
+    lang = groups['lang']
+    if lang is None:
+        prefix = _PATH_PREFIX_PATTERN.search(query)
+        lang = prefix.group(1) if prefix else None
+    cb = groups['cb']
+    if cb is None:
+        cb_match = _CB_PATTERN.search(query)
+        cb = cb_match.group(1) if cb_match else ''
+    # The hash folders are always lowercase hex, the file name is case sensitive
+    folders, _, file_name = groups['path'].rpartition('/')
+    key = ('https://static.wikia.nocookie.net/' + groups['wiki'].lower() + '/images/' + folders.lower() + '/'
+           + file_name + '/revision/' + (groups.get('revision') or 'latest').lower())
+    if lang:
+        key += '?path-prefix=' + lang.lower()
+    return key, cb
+
+
+def canonical_image_key(url: str) -> str:
+    """
+    The same string for every size, crop, host and lazy loaded copy of one image file. Urls that
+    aren't fandom images are their own key.
+
+    Ex. IN: 'https://vignette.wikia.nocookie.net/pokemon/images/b/bf/Sammy.JPG/revision/latest/scale-to-width-down/185?cb=20200619103726'
+        OUT: 'https://static.wikia.nocookie.net/pokemon/images/b/bf/Sammy.JPG/revision/latest'
+
+    """
+    parts = _image_url_parts(url)
+    return url if parts is None else parts[0]
+
+
+def canonical_image_url(url: str) -> str:
+    """
+    The full size url of an image, on the current host, keeping its cache buster and language.
+    Urls that aren't fandom images are returned as they are.
+
+    Ex. IN: 'https://vignette.wikia.nocookie.net/pokemon/images/b/bf/Sammy.JPG/revision/latest/scale-to-width-down/185?cb=20200619103726'
+        OUT: 'https://static.wikia.nocookie.net/pokemon/images/b/bf/Sammy.JPG/revision/latest?cb=20200619103726'
+
+    """
+    parts = _image_url_parts(url)
+    if parts is None:
+        return url
+    return _with_cb(*parts)
+
+
+def _with_cb(key: str, cb: str) -> str:
+    if not cb:
+        return key
+    # Fandom puts the cache buster first: ?cb=20200619103726&path-prefix=de
+    base, _, language = key.partition('?')
+    return base + '?cb=' + cb + ('&' + language if language else '')
+
+
+def canonical_image_urls(urls: Iterable[str]) -> List[str]:
+    """
+    The full size url of every distinct image in urls, in the order they first appear. When the
+    variants of one image have different cache busters the newest one is kept, so the cached copy
+    of an older revision isn't fetched.
+    """
+    newest: Dict[str, str] = {}
+    for url in urls:
+        parts = _image_url_parts(url)
+        key, cb = (url, None) if parts is None else parts
+        if key not in newest or (cb is not None and (len(cb), cb) > (len(newest[key]), newest[key])):
+            newest[key] = cb
+    return [key if cb is None else _with_cb(key, cb) for key, cb in newest.items()]
+
+
+@METRICS.timed_stage('parse')
+def parse_image_urls(html) -> List[str]:
+    """
+    Find the absolute urls of all png, jpg, jpeg and bmp images in the article of a character or
+    gallery page, including lazy loaded ones. Every size and copy of an image is collapsed to one
+    full size url (see canonical_image_urls).
+
+    Raises AttributeError if the page has no title or no article block.
+
+    """
+    page = _parse(html)
+    # Pages without a title are not real wiki pages
+    if _select_one(page, 'page_title') is None:
+        raise AttributeError('No page title')
+    # Wiki article block (so not all the borders and website headers and stuff. Just the article)
+    l1 = _select_one(page, 'article_by_id')
+    if l1 is None:
+        l1 = _select_one(page, 'article_by_class')
+    if l1 is None:
+        raise AttributeError('No article block')
+    # All the image sources with a png, a jpg, a jpeg, or a bmp image. Lazy loaded images have a
+    # placeholder in src and the real source in data-src
+    l2 = [src for src in (_attr(tag, 'data-src') or _attr(tag, 'src') for tag in _select(l1, 'article_images'))
+          if src and check_filetype(src)]
+    # The full size url of each image, once
+    return canonical_image_urls(l2)
+
+
+def sort_category_from_character(character_page_urls, pattern) -> Tuple[List[str], List[str]]:
+    characters = []
+    categories = []
+    for url in character_page_urls:
+        if url:
+            if re.match(pattern, url):
+                categories.append(url)
+            elif re.match(FILE_PATTERN, url):
+                continue
+            else:
+                characters.append(url)
+    return characters, categories
@@ -10,37 +10,84 @@ for a GAN?
 """
 # %% Imports
 import os
-import time
-from urllib.request import urlopen, urlretrieve
 import re
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+from urllib.error import ContentTooShortError, HTTPError
+import httpx
 from bs4 import BeautifulSoup
+from fandom_wikia_image_downloader.http_cache import CachedSession
+from fandom_wikia_image_downloader.throttle import HostThrottle
 
 
 # %%
+# Sprite sets on each Black/White pokedex page: the regex that finds them (the
+# group is the file name without .png), and the folder they are saved to
+# inside the sprites folder. Alternate forms are ex. 386-a.png for Deoxys'
+# attack forme.
+SPRITE_SETS = {
+    'normal': (re.compile('/blackwhite/pokemon/([0-9]+)\\.png'), ''),
+    'shiny': (re.compile('/Shiny/BW/([0-9]+)\\.png'), 'shiny'),
+    'alternate': (re.compile('/blackwhite/pokemon/([0-9]+-[a-z0-9]+)\\.png'), 'alternate'),
+    'alternate_shiny': (re.compile('/Shiny/BW/([0-9]+-[a-z0-9]+)\\.png'), 'alternate_shiny'),
+}
+
+
 class PokemonImageScrape():
     """
     This class uses a simple regular expression to locate the pokemon's image
     in the html and download it to the current folder.
     """
 
-    # Observes the current directory. This is to check if the folder and files
-    # exist already, and creates them if they do not exist.
-    curdir = os.path.dirname(__file__)
+    # Observes the current directory. The sprites folder is created there (if
+    # it does not exist yet) when the first scraper is made, not on import.
+    curdir = os.path.dirname(os.path.abspath(__file__))
     pokemon_sprites_dir = os.path.join(curdir, 'pokemon_sprites')
-    if not os.path.exists(pokemon_sprites_dir):
-        os.mkdir(pokemon_sprites_dir)
 
-    def __init__(self, page_url: str) -> None:
+    # lxml parses the pages several times faster than html.parser
+    parser = 'lxml' if find_spec('lxml') else 'html.parser'
+
+    def __init__(self, page_url: str, sprites_dir: str = None, workers: int = 8,
+                 requests_per_second: float = 5, sprite_sets=('normal',)) -> None:
         """
         :param page_url: The entire URL string after 'serebii.net'
+        :param sprites_dir: Folder the sprites are saved to. Defaults to
+            pokemon_sprites next to this script.
+        :param workers: Pages fetched and parsed at the same time. 1 visits
+            them one by one.
+        :param requests_per_second: Most requests sent to serebii.net per
+            second, by all the workers together.
+        :param sprite_sets: Which of SPRITE_SETS to download. Every set but
+            'normal' is saved in its own folder inside sprites_dir.
         """
-        self.html: urlopen = urlopen(f'https://serebii.net{page_url}')
-        self.soup: BeautifulSoup = BeautifulSoup(self.html, 'html.parser')
+        unknown = set(sprite_sets) - set(SPRITE_SETS)
+        if unknown:
+            raise ValueError('Unknown sprite sets ' + str(sorted(unknown)) + ', expected some of ' + str(list(SPRITE_SETS)))
+        if sprites_dir is not None:
+            self.pokemon_sprites_dir = sprites_dir
+        self.workers = workers
+        self.sprite_sets = sprite_sets
+        for sprite_set in sprite_sets:
+            os.makedirs(os.path.join(self.pokemon_sprites_dir, SPRITE_SETS[sprite_set][1]), exist_ok=True)
+        # Pages are cached on disk and revalidated with conditional GETs, so a
+        # rerun only downloads the pages that changed. Pages and images share
+        # the session's keep-alive connections to serebii.net.
+        # The throttle keeps the requests to serebii.net at or under
+        # requests_per_second however many workers there are (burst=1, so not
+        # even after an idle spell), and slows down (or waits, if it asks to)
+        # when it answers with a 429 or 503. Each scraper has its own session,
+        # so each keeps to its own requests_per_second.
+        self.http_session = CachedSession(
+            os.path.join(self.curdir, 'http_cache'),
+            throttle=HostThrottle(rate=requests_per_second, max_rate=requests_per_second, burst=1))
+        self.html: bytes = self.http_session.get(f'https://serebii.net{page_url}')
+        self.soup: BeautifulSoup = BeautifulSoup(self.html, self.parser)
         self.pages: set = set()
         self.get_links(self.soup)
         self.visit_page()
 
-    def get_links(self, page_url: urlopen) -> None:
+    def get_links(self, page_url: BeautifulSoup) -> None:
         """
         Accepts the BeautifulSoup object passed into it, searches for all
         instances other Pokedex pages (url substrings starting with pokedex-bw)
@@ -54,40 +101,69 @@ class PokemonImageScrape():
 
     def collect_image(self, cur_page: BeautifulSoup) -> None:
         """
-        Locates the location of the page's pokemon image and downloads it to
-        the directory that this script is working in. The file's name will be
-        the pokemon's National Dex ID with a .png filetype.
+        Locates the page's pokemon images of every set in sprite_sets and
+        downloads them to the sprites folder. The file's name will be the
+        pokemon's National Dex ID (plus the form for alternate sprites) with a
+        .png filetype.
+        """
+        for sprite_set in self.sprite_sets:
+            pattern, folder = SPRITE_SETS[sprite_set]
+            for img in cur_page.find_all('img', {'src': pattern}):
+                img_name: str = pattern.search(img['src']).group(1) + '.png'
+                img_path = os.path.join(self.pokemon_sprites_dir, folder, img_name)
+                # Creates the .png file if it does not exist already.
+                if not os.path.exists(img_path):
+                    self.http_session.download('https://serebii.net' + img['src'], img_path)
 
-        To instead download the Shiny pokemon images, simply replace
-        '/blackwhite/pokemon/' with '/Shiny/BW/' in the img declaration.
+    def collect_page(self, page: str) -> None:
+        """
+        Downloads the images on one pokedex page. A page that fails to load
+        (an error status, or a connection problem the throttle gave up
+        retrying) is skipped, so one bad page doesn't stop the other workers.
         """
-        img: BeautifulSoup = cur_page.find(
-            'img', {'src': re.compile('/blackwhite/pokemon/[0-9]*\\.png')})
-        img_name: str = img.attrs['src'][20:23]+'.png'
-        # Creates the .png file if it does not exist already.
-        if not os.path.exists(os.path.join(self.pokemon_sprites_dir,
-                                           img_name)):
-            urlretrieve('https://serebii.net'+img['src'],
-                        self.pokemon_sprites_dir + '//' + img_name)
-            # Self-imposed timer to throttle the scraper's web activity and
-            # avoid overloading the servers. Probably not necessary here, but
-            # is nice to do.
-            time.sleep(5)
+        print(page)
+        try:
+            html: bytes = self.http_session.get(f'https://serebii.net{page}')
+            self.collect_image(BeautifulSoup(html, self.parser))
+        except (HTTPError, ContentTooShortError, httpx.TransportError) as e:
+            print('Skipped ' + page + ': ' + repr(e))
 
     def visit_page(self) -> None:
         """
-        Iterates through each page in the Pages set (collected in the :meth:
-        `get_links` method). It will print whichever pokedex page it is
-        currently on and download the pokemon's regular image with the :meth:
-        `collect_image` method.
+        Visits each page in the Pages set (collected in the :meth:`get_links`
+        method) with :meth:`collect_page`, workers pages at a time. The
+        session's throttle spaces out the requests of all the workers.
         """
-        for page in self.pages:
-            print(page)
-            self.html: urlopen = urlopen(f'https://serebii.net{page}')
-            self.soup: BeautifulSoup = BeautifulSoup(self.html, 'html.parser')
-            self.collect_image(self.soup)
+        pages = sorted(self.pages)
+        if self.workers <= 1:
+            for page in pages:
+                self.collect_page(page)
+            return
+        with ThreadPoolExecutor(self.workers) as executor:
+            # list() so an unexpected error in a worker is raised here
+            list(executor.map(self.collect_page, pages))
+
+
+def main(argv=None) -> None:
+    """
+    Runs the scraper. You can change the starting point to any valid pokemon ID,
+    it will get the same result.
+    """
+    parser = argparse.ArgumentParser(description="Download every pokemon's Black/White sprite from serebii.net.")
+    parser.add_argument('--start-page', default='/pokedex-bw/001.shtml',
+                        help="Pokedex page to start from, the url after 'serebii.net'.")
+    parser.add_argument('-o', '--output-dir', default=PokemonImageScrape.pokemon_sprites_dir,
+                        help='Folder the sprites are saved to.')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='Pages fetched at the same time. 1 visits them one by one.')
+    parser.add_argument('--rate', type=float, default=5,
+                        help='Most requests per second sent to serebii.net.')
+    parser.add_argument('--sprites', nargs='+', choices=list(SPRITE_SETS), default=['normal'],
+                        help='Sprite sets to download, ex. --sprites normal shiny alternate.')
+    args = parser.parse_args(argv)
+    PokemonImageScrape(args.start_page, sprites_dir=args.output_dir, workers=args.workers,
+                       requests_per_second=args.rate, sprite_sets=args.sprites)
 
 
-# Runs the scraper. You can change the starting point to any valid pokemon ID,
-# it will get the same result.
-PokemonImageScrape('/pokedex-bw/001.shtml')
+if __name__ == '__main__':
+    main()
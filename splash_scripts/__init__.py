@@ -0,0 +1,10 @@
+"""
+Splash rendering code shared by the Scrapy projects (toyota_collector and deadmanrealty_spider).
+
+    render_fragment.lua  execute endpoint script both spiders render their pages with
+    middlewares.py       SplashRenderBudgetMiddleware and SplashPoolMiddleware
+    incremental.py       FingerprintStore and IncrementalPipeline, for incremental recrawls
+
+Each project's settings.py puts the top of the repo on sys.path, so these are imported as
+splash_scripts.middlewares and splash_scripts.incremental.
+"""
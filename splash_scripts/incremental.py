@@ -0,0 +1,147 @@
+"""
+Incremental recrawls for the Scrapy projects in this repo: the items of the last run are kept in
+SQLite, so a run only outputs what is new, changed or removed. Enable it in ITEM_PIPELINES:
+
+    'splash_scripts.incremental.IncrementalPipeline': 300,
+"""
+import hashlib
+import json
+import sqlite3
+import time
+
+# useful for handling different item types with a single interface
+from itemadapter import ItemAdapter
+from scrapy.exceptions import DropItem
+
+
+def fingerprint(value):
+    """
+    sha1 of what a page shows of an item: a dict (ex. an item, or a car in the inventory JSON), or a
+    selector, whose text is taken with its whitespace normalized
+    """
+    if hasattr(value, 'xpath'):
+        text = ' '.join(' '.join(value.xpath('.//text()').getall()).split())
+    else:
+        text = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class FingerprintStore:
+    """
+    What every item looked like the last time it was scraped, kept in SQLite between runs.
+
+    For each item (by its key, ex. its vin) it keeps the url of its page, the fingerprint of its
+    entry in the listing, the fingerprint of the item itself and the item. A spider asks unchanged()
+    before rendering an item's page, and record() tells whether a scraped item is new or changed.
+    Items seen in neither way during a run are removed().
+
+    Parameters
+    ----------
+    path : str
+        SQLite file. Created if it does not exist.
+    recheck_days : float, optional
+        Pages are rendered again after this many days even if their listing entry hasn't changed,
+        for what the listing doesn't show. The default is 7.
+
+    """
+
+    def __init__(self, path, recheck_days=7):
+        self.con = sqlite3.connect(path)
+        with self.con:
+            # checked: when the item was last scraped, seen: the last run it was in the listing
+            self.con.execute('CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, url TEXT, listing_fingerprint TEXT, '
+                             'fingerprint TEXT, item TEXT, checked REAL, seen REAL)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS items_url ON items (url)')
+        self.run = time.time()
+        self.recheck = recheck_days * 24 * 3600
+        # Items this run has found in the listing, scraped or not
+        self.seen_count = 0
+
+    def close(self):
+        self.con.close()
+
+    def unchanged(self, url, listing_fingerprint):
+        """
+        Whether the item at url has the same listing entry as when it was last scraped, and was
+        scraped recently enough. If so, it counts as seen in this run.
+        """
+        row = self.con.execute('SELECT listing_fingerprint, checked FROM items WHERE url = ?', (url,)).fetchone()
+        if row is None or row[0] != listing_fingerprint or self.run - row[1] > self.recheck:
+            return False
+        with self.con:
+            self.con.execute('UPDATE items SET seen = ? WHERE url = ?', (self.run, url))
+        self.seen_count += 1
+        return True
+
+    def record(self, key, item, url=None, listing_fingerprint=None):
+        """Save a scraped item, and return 'new', 'changed', or None if it is the same as last time"""
+        item_fingerprint = fingerprint(item)
+        row = self.con.execute('SELECT fingerprint FROM items WHERE key = ?', (key,)).fetchone()
+        with self.con:
+            self.con.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (key, url, listing_fingerprint, item_fingerprint,
+                              json.dumps(item, ensure_ascii=False, default=str), self.run, self.run))
+        self.seen_count += 1
+        if row is None:
+            return 'new'
+        return 'changed' if row[0] != item_fingerprint else None
+
+    def removed(self):
+        """The items that weren't seen in this run. None at all if nothing was seen, ex. the site was down."""
+        if not self.seen_count:
+            return []
+        return [json.loads(item) for (item,) in self.con.execute('SELECT item FROM items WHERE seen < ?', (self.run,))]
+
+    def forget(self, key):
+        with self.con:
+            self.con.execute('DELETE FROM items WHERE key = ?', (key,))
+
+
+class IncrementalPipeline:
+    """
+    Passes on only the items that are new or changed since the last run, with 'change' set to 'new'
+    or 'changed', and the items the spider reports as removed ('change' already 'removed'), which are
+    then forgotten.
+
+    Items are keyed by the first of FINGERPRINT_KEY_FIELDS they have, and kept in FINGERPRINT_DB.
+    The store is also spider.fingerprints, for the spider to skip pages that haven't changed (see
+    FingerprintStore.unchanged).
+    """
+
+    def __init__(self, path, key_fields, recheck_days):
+        self.path = path
+        self.key_fields = key_fields
+        self.recheck_days = recheck_days
+        self.store = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(settings.get('FINGERPRINT_DB', 'fingerprints.db'), settings.getlist('FINGERPRINT_KEY_FIELDS'),
+                   settings.getfloat('FINGERPRINT_RECHECK_DAYS', 7))
+
+    def open_spider(self, spider):
+        self.store = FingerprintStore(self.path, self.recheck_days)
+        spider.fingerprints = self.store
+
+    def close_spider(self, spider):
+        self.store.close()
+
+    def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        listing_fingerprint = adapter.get('listing_fingerprint')
+        if 'listing_fingerprint' in adapter:
+            del adapter['listing_fingerprint']
+        key = next((str(adapter[field]) for field in self.key_fields if adapter.get(field)), None)
+        if key is None:
+            # Nothing to tell it apart by, so it can't be compared with earlier runs
+            return item
+        if adapter.get('change') == 'removed':
+            self.store.forget(key)
+            return item
+        values = {k: v for k, v in adapter.items() if k != 'change'}
+        change = self.store.record(key, values, adapter.get('url'), listing_fingerprint)
+        if change is None:
+            raise DropItem('Unchanged since the last run: ' + key)
+        adapter['change'] = change
+        return item
@@ -0,0 +1,399 @@
+"""
+Downloader middlewares for scrapy_splash, shared by the Scrapy projects in this repo. Enable them in
+DOWNLOADER_MIDDLEWARES before scrapy_splash.SplashMiddleware (725):
+
+    'splash_scripts.middlewares.SplashPoolMiddleware': 715,
+    'splash_scripts.middlewares.SplashRenderBudgetMiddleware': 720,
+"""
+import json
+import re
+import time
+from collections import deque
+from urllib.parse import urljoin, urlsplit
+
+import scrapy
+from scrapy import signals
+from scrapy.http import TextResponse
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import defer, reactor, task
+
+
+class SplashRenderBudgetMiddleware:
+    """
+    Keeps the number of Splash renders in flight within what Splash can handle, and tunes the
+    wait and timeout of every render.
+
+    - At most SPLASH_MAX_RENDERS renders are sent at once. The limit starts at SPLASH_START_RENDERS,
+      goes up by one every time that many renders succeed, and is halved on a 503 or 504 from Splash,
+      which also holds back every render for a backoff that doubles with each one in a row (up to
+      SPLASH_MAX_BACKOFF seconds). The render is then retried with a longer timeout, up to
+      SPLASH_RENDER_RETRIES times.
+    - Renders are grouped by url pattern: the first of SPLASH_RENDER_RULES whose 'pattern' matches
+      the url, or else the url's path with its numbers taken out. Each group keeps its own wait
+      and timeout. The timeout follows how long its renders take.
+    - A request can name the nodes it needs with meta['render_xpath'] (or a rule's 'xpath'). If
+      they aren't in the render, it is retried with twice the wait (up to SPLASH_RENDER_RETRIES times
+      too, then it is logged as an error and passed on as it is). If they are, the group's wait is
+      shortened a little, so it settles near the shortest wait that works.
+
+    Goes before scrapy_splash.SplashMiddleware (725) in DOWNLOADER_MIDDLEWARES.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.max_renders = settings.getint('SPLASH_MAX_RENDERS', 16)
+        self.limit = float(min(self.max_renders, settings.getint('SPLASH_START_RENDERS', 4)))
+        self.rules = [dict(rule, pattern=re.compile(rule['pattern'])) for rule in settings.getlist('SPLASH_RENDER_RULES')]
+        self.min_wait = settings.getfloat('SPLASH_MIN_WAIT', 0.2)
+        self.max_wait = settings.getfloat('SPLASH_MAX_WAIT', 10)
+        self.min_timeout = settings.getfloat('SPLASH_MIN_TIMEOUT', 30)
+        self.max_timeout = settings.getfloat('SPLASH_MAX_TIMEOUT', 90)
+        self.retries = settings.getint('SPLASH_RENDER_RETRIES', 3)
+        self.max_backoff = settings.getfloat('SPLASH_MAX_BACKOFF', 60)
+        self.extra_timeout = settings.getfloat('SPLASH_EXTRA_TIMEOUT', 5)
+        self.in_flight = 0
+        # Deferreds of the renders waiting for a slot, in order
+        self.waiting = deque()
+        self.paused_until = 0.0
+        self.failures_in_row = 0
+        self.last_backoff = 0.0
+        self._wake_call = None
+        # Url pattern -> {'wait', 'timeout', 'latency'}
+        self.groups = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def _group(self, url):
+        for rule in self.rules:
+            if rule['pattern'].search(url):
+                return rule['pattern'].pattern, rule
+        return re.sub(r'\d+', 'N', urlsplit(url).path), None
+
+    async def process_request(self, request, spider):
+        if 'splash' not in request.meta:
+            return None
+        if not request.meta.get('_splash_processed'):
+            # Before SplashMiddleware turns the request into the call to Splash: set the render args
+            args = request.meta['splash'].setdefault('args', {})
+            key, rule = self._group(args.get('url', request.url))
+            group = self.groups.get(key)
+            if group is None:
+                wait = (rule or {}).get('wait', args.get('wait', 0.5))
+                group = self.groups[key] = {'wait': float(wait), 'timeout': self.min_timeout, 'latency': None}
+            request.meta['_render_group'] = key
+            if rule and rule.get('xpath'):
+                request.meta.setdefault('render_xpath', rule['xpath'])
+            args['wait'] = round(group['wait'], 2)
+            args['timeout'] = round(group['timeout'])
+            return None
+        # On its way to Splash: wait for a render slot
+        await maybe_deferred_to_future(self._acquire())
+        request.meta['_render_started'] = time.monotonic()
+        return None
+
+    def _acquire(self):
+        if not self.waiting and self.in_flight < int(self.limit) and time.monotonic() >= self.paused_until:
+            self.in_flight += 1
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        self._wake()
+        return d
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        now = time.monotonic()
+        if now < self.paused_until:
+            if self._wake_call is None:
+                self._wake_call = reactor.callLater(self.paused_until - now, self._resume)
+            return
+        while self.waiting and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            self.waiting.popleft().callback(None)
+
+    def _resume(self):
+        self._wake_call = None
+        self._wake()
+
+    def process_response(self, request, response, spider):
+        started = request.meta.pop('_render_started', None)
+        if started is None:
+            return response
+        self._release()
+        key = request.meta.get('_render_group')
+        group = self.groups.get(key)
+        latency = time.monotonic() - started
+        self.stats.inc_value('splash_budget/render_seconds', latency)
+
+        sent = request.meta['splash']['args']
+        if response.status in (503, 504):
+            self._back_off(group, sent, started, spider)
+            return self._retry(request, response, 'overload_retries', spider)
+
+        self.failures_in_row = 0
+        self.limit = min(self.max_renders, self.limit + 1 / self.limit)
+        self.stats.max_value('splash_budget/limit', int(self.limit))
+        if group is not None and response.status == 200:
+            # The timeout follows how long renders of this pattern take, with room to spare
+            group['latency'] = latency if group['latency'] is None else 0.8 * group['latency'] + 0.2 * latency
+            group['timeout'] = min(self.max_timeout, max(self.min_timeout, 3 * group['latency'] + group['wait']))
+            xpath = request.meta.get('render_xpath')
+            if xpath and isinstance(response, TextResponse):
+                if response.xpath(xpath):
+                    group['wait'] = max(self.min_wait, min(group['wait'], sent.get('wait', group['wait'])) * 0.95)
+                else:
+                    # Twice the wait this render had: renders sent at the same time don't all double it again
+                    group['wait'] = min(self.max_wait, max(group['wait'], sent.get('wait', 0) * 2, self.min_wait))
+                    return self._retry(request, response, 'render_retries', spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if request.meta.pop('_render_started', None) is not None:
+            self._release()
+
+    def _back_off(self, group, sent, started, spider):
+        if group is not None:
+            group['timeout'] = min(self.max_timeout, max(group['timeout'], sent.get('timeout', 0) * 1.5))
+        if started < self.last_backoff:
+            # Sent before the last back off, so it is part of the overload that was already backed off from
+            return
+        now = self.last_backoff = time.monotonic()
+        self.failures_in_row += 1
+        self.limit = max(1.0, self.limit / 2)
+        backoff = min(self.max_backoff, 2 ** (self.failures_in_row - 1))
+        self.paused_until = max(self.paused_until, now + backoff)
+        self.stats.inc_value('splash_budget/backoff')
+        spider.logger.info('Splash is overloaded, %d renders at once and pausing %.0f s' % (int(self.limit), backoff))
+
+    def _retry(self, request, response, reason, spider):
+        """
+        The same render with the group's current wait and timeout, or response if it has already been
+        retried SPLASH_RENDER_RETRIES times for reason (meta 'overload_retries' or 'render_retries').
+        A response that is given up on is marked dont_retry, so Scrapy doesn't retry it either.
+        """
+        retries = request.meta.get(reason, 0) + 1
+        if retries > self.retries:
+            # The spider still gets the render, but the run shows the page it may be missing
+            self.stats.inc_value('splash_budget/gave_up/' + reason)
+            # Keeps the spiders from taking what the page lists as removed, see IncrementalPipeline
+            self.stats.inc_value('listing/incomplete')
+            problem = ('Splash stayed overloaded' if reason == 'overload_retries'
+                       else 'the render is still missing ' + request.meta.get('render_xpath', ''))
+            url = request.meta['splash']['args'].get('url', request.url)
+            spider.logger.error('Gave up rendering %s after %d retries, %s' % (url, self.retries, problem))
+            # Or RetryMiddleware would send a 503 or 504 back to the overloaded Splash again
+            request.meta['dont_retry'] = True
+            return response
+        self.stats.inc_value('splash_budget/' + reason)
+        group = self.groups.get(request.meta.get('_render_group'), {})
+        splash = dict(request.meta['splash'])
+        args = splash['args'] = dict(splash['args'])
+        args['wait'] = round(group.get('wait', args.get('wait', 0.5)), 2)
+        args['timeout'] = round(group.get('timeout', args.get('timeout', self.min_timeout)))
+        meta = dict(request.meta, splash=splash)
+        meta[reason] = retries
+        meta['download_timeout'] = max(meta.get('download_timeout', 0), args['timeout'] + self.extra_timeout)
+        # The request already went through SplashMiddleware, so its body is the call to Splash
+        body = json.dumps(args, ensure_ascii=False, sort_keys=True, indent=4)
+        return request.replace(body=body, meta=meta, dont_filter=True)
+
+
+class SplashInstance:
+    """One Splash server of the pool, and what SplashPoolMiddleware knows about it"""
+
+    def __init__(self, url, rss_limit):
+        self.url = url if url.endswith('/') else url + '/'
+        # Renders sent to it that haven't come back yet, queued for a render slot included
+        self.outstanding = 0
+        # 5xx and connection errors in a row
+        self.failures = 0
+        self.ejected_since = None
+        self.ejected_for_memory = False
+        # Peak memory of the Splash process in bytes, from /_ping, and how high it may go
+        self.maxrss = None
+        self.rss_limit = rss_limit
+
+    @property
+    def healthy(self):
+        return self.ejected_since is None
+
+    def __repr__(self):
+        return self.url
+
+
+class SplashPoolMiddleware:
+    """
+    Spreads Splash renders over every Splash server in SPLASH_URLS (SPLASH_URL if it isn't set).
+
+    - Every render goes to the healthy server with the fewest renders outstanding.
+    - A server is taken out of the pool after SPLASH_POOL_MAX_FAILURES 5xx responses or connection
+      errors in a row. It keeps being pinged every SPLASH_POOL_CHECK_INTERVAL seconds, and is put
+      back once it answers, at least SPLASH_POOL_EJECT_TIME seconds after it was taken out.
+    - A server is also taken out when the memory it reports (the maxrss of /_ping) goes over
+      SPLASH_POOL_MAX_RSS MB, and asked to free what it can (/_gc). maxrss is the peak of the Splash
+      process, so it only goes down when Splash restarts (Splash started with --maxrss restarts
+      itself). The server is put back as soon as a restart is seen, or else after
+      SPLASH_POOL_MEMORY_COOLDOWN seconds, and then only taken out again if its peak grows by another
+      quarter of SPLASH_POOL_MAX_RSS.
+    - The pool is never empty: if every server is out, renders still go to the least busy one.
+
+    Goes before SplashRenderBudgetMiddleware (720) in DOWNLOADER_MIDDLEWARES, so renders are sent to
+    another server before they take a render slot.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_failures = settings.getint('SPLASH_POOL_MAX_FAILURES', 3)
+        self.check_interval = settings.getfloat('SPLASH_POOL_CHECK_INTERVAL', 10)
+        self.eject_time = settings.getfloat('SPLASH_POOL_EJECT_TIME', 30)
+        self.max_rss = settings.getfloat('SPLASH_POOL_MAX_RSS', 3000) * 1024 * 1024
+        self.memory_cooldown = settings.getfloat('SPLASH_POOL_MEMORY_COOLDOWN', 300)
+        urls = settings.getlist('SPLASH_URLS') or [settings.get('SPLASH_URL', 'http://127.0.0.1:8050')]
+        self.instances = [SplashInstance(url, self.max_rss) for url in urls]
+        self.spider = None
+        self._checks = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        # Sent for every response Splash gives, before any middleware can turn it into a retry
+        crawler.signals.connect(s.response_downloaded, signal=signals.response_downloaded)
+        return s
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        spider.logger.info('Splash pool: ' + ', '.join(instance.url for instance in self.instances))
+        if self.check_interval > 0:
+            self._checks = task.LoopingCall(self.check_health)
+            self._checks.start(self.check_interval, now=False)
+
+    def spider_closed(self, spider):
+        if self._checks is not None and self._checks.running:
+            self._checks.stop()
+
+    def _pick(self):
+        candidates = [instance for instance in self.instances if instance.healthy] or self.instances
+        return min(candidates, key=lambda instance: instance.outstanding)
+
+    def _instance_of(self, request):
+        for instance in self.instances:
+            if request.url.startswith(instance.url):
+                return instance
+        return None
+
+    def process_request(self, request, spider):
+        if 'splash' not in request.meta or request.meta.get('splash_pool_check'):
+            return None
+        if not request.meta.get('_splash_processed'):
+            # SplashMiddleware builds the call to Splash with this server
+            request.meta['splash']['splash_url'] = self._pick().url
+            return None
+        if '_splash_instance' in request.meta:
+            return None
+        current = self._instance_of(request)
+        instance = current if current is not None and current.healthy else self._pick()
+        request.meta['_splash_instance'] = instance.url
+        instance.outstanding += 1
+        self.stats.inc_value('splash_pool/requests/' + instance.url)
+        if instance is current:
+            return None
+        # A retry, or its server was taken out while it was queued: the same call to another server
+        splash = dict(request.meta['splash'], splash_url=instance.url)
+        return request.replace(url=urljoin(instance.url, splash['endpoint']), meta=dict(request.meta, splash=splash),
+                               dont_filter=True)
+
+    def response_downloaded(self, response, request, spider):
+        instance = self._finish(request)
+        if instance is None:
+            return
+        if response.status >= 500:
+            self._failed(instance, 'HTTP ' + str(response.status))
+        else:
+            instance.failures = 0
+
+    def process_exception(self, request, exception, spider):
+        instance = self._finish(request)
+        if instance is not None:
+            self._failed(instance, repr(exception))
+
+    def _finish(self, request):
+        url = request.meta.pop('_splash_instance', None)
+        for instance in self.instances:
+            if instance.url == url:
+                instance.outstanding -= 1
+                return instance
+        return None
+
+    def _failed(self, instance, reason):
+        instance.failures += 1
+        if instance.healthy and instance.failures >= self.max_failures:
+            self._eject(instance, str(instance.failures) + ' failures in a row, the last one ' + reason)
+
+    def _eject(self, instance, reason, memory=False):
+        instance.ejected_since = time.monotonic()
+        instance.ejected_for_memory = memory
+        self.stats.inc_value('splash_pool/ejected')
+        self.spider.logger.warning('Taking ' + instance.url + ' out of the Splash pool: ' + reason)
+
+    def _reinsert(self, instance):
+        instance.ejected_since = None
+        instance.failures = 0
+        self.stats.inc_value('splash_pool/reinserted')
+        self.spider.logger.info('Putting ' + instance.url + ' back in the Splash pool')
+
+    def check_health(self):
+        return defer.DeferredList([self._check(instance) for instance in self.instances])
+
+    def _ping_request(self, instance, endpoint, method='GET'):
+        # A download slot of their own, so checks don't queue behind the renders
+        return scrapy.Request(urljoin(instance.url, endpoint), method=method, dont_filter=True, priority=100,
+                              meta={'splash_pool_check': True, 'dont_retry': True, 'download_timeout': 10,
+                                    'download_slot': 'splash_pool_checks'})
+
+    @defer.inlineCallbacks
+    def _check(self, instance):
+        try:
+            response = yield self.crawler.engine.download(self._ping_request(instance, '_ping'))
+            ping = json.loads(response.text) if response.status == 200 else {}
+        except Exception as e:
+            ping = {}
+            reason = repr(e)
+        else:
+            reason = 'ping returned HTTP ' + str(response.status)
+        if ping.get('status') != 'ok':
+            if instance.healthy:
+                self._eject(instance, reason)
+            return
+        maxrss = ping.get('maxrss')
+        # The peak only goes down in a new process
+        restarted = bool(maxrss and instance.maxrss and maxrss < instance.maxrss)
+        instance.maxrss = maxrss
+        if restarted:
+            instance.rss_limit = self.max_rss
+        if instance.healthy:
+            if self.max_rss and maxrss and maxrss > instance.rss_limit:
+                self._eject(instance, 'using %.0f MB' % (maxrss / 1024 / 1024), memory=True)
+                try:
+                    yield self.crawler.engine.download(self._ping_request(instance, '_gc', method='POST'))
+                except Exception:
+                    pass
+            return
+        out_for = time.monotonic() - instance.ejected_since
+        if instance.ejected_for_memory:
+            if restarted or out_for >= self.memory_cooldown:
+                if not restarted and maxrss:
+                    # Still the same process, whose peak can't go down any more
+                    instance.rss_limit = max(instance.rss_limit, maxrss + self.max_rss / 4)
+                self._reinsert(instance)
+        elif out_for >= self.eject_time:
+            self._reinsert(instance)
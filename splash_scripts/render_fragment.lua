@@ -0,0 +1,116 @@
+-- Splash execute endpoint script shared by toyota_collector and deadmanrealty_spider.
+--
+-- Renders args.url without downloading what the html doesn't need (images, fonts, media and
+-- trackers), waits until args.selector is on the page instead of for a fixed time, and returns
+-- only the elements matching args.fragment instead of the whole page.
+--
+-- Arguments (besides url, and the cookies SplashCookiesMiddleware sends):
+--   selector          CSS selector to wait for. Without it the page is returned once loaded.
+--   fragment          CSS selector of the elements to return. The default returns the whole page.
+--   selector_timeout  Seconds to wait for selector at most, 15 by default.
+--   wait              Seconds to let the page settle once selector is there, 0 by default.
+--   block_hosts       More hosts to block, on top of TRACKER_HOSTS.
+--
+-- Returns html (the fragments wrapped in a body, or the whole page), url, http_status, cookies, and
+-- found (whether selector showed up), which scrapy_splash turns into the response of the request.
+
+local BLOCKED_EXTENSIONS = {
+  'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'svg', 'ico', 'avif',
+  'woff', 'woff2', 'ttf', 'otf', 'eot',
+  'mp4', 'webm', 'ogg', 'mp3', 'wav', 'm3u8', 'ts',
+}
+
+-- Analytics, ads and chat widgets. Matched against the end of the host
+local TRACKER_HOSTS = {
+  'google-analytics.com', 'googletagmanager.com', 'googleadservices.com', 'googlesyndication.com',
+  'doubleclick.net', 'adservice.google.com', 'facebook.net', 'facebook.com',
+  'hotjar.com', 'clarity.ms', 'bat.bing.com', 'adnxs.com', 'criteo.com', 'criteo.net',
+  'taboola.com', 'outbrain.com', 'quantserve.com', 'scorecardresearch.com', 'newrelic.com',
+  'nr-data.net', 'segment.io', 'segment.com', 'optimizely.com', 'crazyegg.com', 'mouseflow.com',
+  'fullstory.com', 'livechatinc.com', 'contactatonce.com', 'carnow.com', 'gubagoo.com',
+  'omtrdc.net', 'demdex.net', 'everesttech.net', 'tiktok.com',
+  'snapchat.com', 'pinterest.com', 'linkedin.com', 'twitter.com', 'youtube.com', 'ytimg.com',
+}
+
+local function ends_with(host, domain)
+  return host == domain or host:sub(-(#domain + 1)) == '.' .. domain
+end
+
+local function is_blocked(url, block_hosts)
+  local host = (url:match('^%a[%w+.-]*://([^/:?#]+)') or ''):lower()
+  for _, hosts in ipairs({TRACKER_HOSTS, block_hosts}) do
+    for _, domain in ipairs(hosts) do
+      if ends_with(host, domain) then
+        return true
+      end
+    end
+  end
+  local extension = (url:match('^[^?#]*') or url):match('%.(%w+)$')
+  if extension then
+    extension = extension:lower()
+    for _, blocked in ipairs(BLOCKED_EXTENSIONS) do
+      if extension == blocked then
+        return true
+      end
+    end
+  end
+  return false
+end
+
+function main(splash, args)
+  splash.images_enabled = false
+  splash.media_source_enabled = false
+  splash.plugins_enabled = false
+  splash.resource_timeout = 10
+
+  local block_hosts = args.block_hosts or {}
+  splash:on_request(function(request)
+    if is_blocked(request.url, block_hosts) then
+      request:abort()
+    end
+  end)
+
+  splash:init_cookies(args.cookies or {})
+  local ok, reason = splash:go{args.url, headers = args.headers}
+  if not ok and not reason:find('^http') then
+    -- Network errors. HTTP errors still return the page, with its status
+    error(reason)
+  end
+
+  local found = true
+  if args.selector then
+    local selector_timeout = tonumber(args.selector_timeout) or 15
+    local waited = 0
+    found = splash:select(args.selector) ~= nil
+    while not found and waited < selector_timeout do
+      splash:wait(0.1)
+      waited = waited + 0.1
+      found = splash:select(args.selector) ~= nil
+    end
+  end
+  local wait = tonumber(args.wait) or 0
+  if wait > 0 then
+    splash:wait(wait)
+  end
+
+  local html
+  if args.fragment then
+    local parts = {}
+    for _, element in ipairs(splash:select_all(args.fragment)) do
+      parts[#parts + 1] = element.node.outerHTML
+    end
+    html = '<html><body>' .. table.concat(parts, '\n') .. '</body></html>'
+  else
+    html = splash:html()
+  end
+
+  local entries = splash:history()
+  local last = entries[#entries]
+  return {
+    html = html,
+    url = splash:url(),
+    http_status = last and last.response.status or nil,
+    cookies = splash:get_cookies(),
+    found = found,
+  }
+end
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+from unittest import mock
+
+import pytest
+import scrapy
+from scrapy.exceptions import DontCloseSpider
+from scrapy.http import TextResponse
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.test import get_crawler
+from twisted.python.failure import Failure
+
+# The project and splash_scripts, as scrapy crawl finds them
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [project_dir, os.path.dirname(project_dir)]
+
+from splash_scripts.incremental import IncrementalPipeline  # noqa: E402
+from toyota_collector.spiders.toyota import ToyotaSpider  # noqa: E402
+
+API_URL = 'https://www.larryhmillertoyota.com/apis/widget/INVENTORY_LISTING_DEFAULT_AUTO_NEW:inventory-data-bus1/getInventory'
+LISTING_URL = 'https://www.larryhmillertoyota.com/new-inventory/index.htm'
+CARS = [{'vin': 'VIN%d' % i, 'model': 'Camry', 'trim': 'LE', 'year': 2024, 'condition': 'new',
+         'stockNumber': 'S%d' % i, 'link': '/new/Toyota/2024-Toyota-Camry-VIN%d.htm' % i} for i in range(2)]
+
+
+def inventory_response(start, cars):
+    """The page of the inventory JSON at start, a car per page"""
+    url = API_URL + '?start=%d&pageSize=1' % start
+    body = json.dumps({'inventory': cars[start:start + 1], 'pageInfo': {'totalCount': len(cars)}})
+    return TextResponse(url, body=body, encoding='utf-8', request=scrapy.Request(url))
+
+
+def crawl(db, cars, failed_start=None):
+    """One run over an inventory of cars, the page at failed_start failing"""
+    crawler = get_crawler(ToyotaSpider)
+    crawler.engine = mock.Mock()
+    spider = ToyotaSpider.from_crawler(crawler)
+    pipeline = IncrementalPipeline(db, ['vin', 'stock_num'], 7)
+    pipeline.open_spider(spider)
+    responses = [(spider.parse_inventory, inventory_response(0, cars), {'api_url': API_URL, 'listing_url': LISTING_URL, 'start': 0})]
+    while responses:
+        callback, response, cb_kwargs = responses.pop()
+        for output in callback(response, **cb_kwargs):
+            if not isinstance(output, scrapy.Request):
+                pipeline.process_item(output, spider)
+            elif output.cb_kwargs['start'] == failed_start:
+                failure = Failure(HttpError(inventory_response(failed_start, [])))
+                failure.request = output
+                list(spider.listing_fallback(failure))
+            else:
+                responses.append((output.callback, inventory_response(output.cb_kwargs['start'], cars), output.cb_kwargs))
+    return crawler, spider, pipeline
+
+
+def test_failed_inventory_page_reports_nothing_removed(tmp_path):
+    db = str(tmp_path / 'fingerprints.db')
+    crawler, spider, pipeline = crawl(db, CARS)
+    pipeline.close_spider(spider)
+
+    crawler, spider, pipeline = crawl(db, CARS, failed_start=1)
+    assert crawler.stats.get_value('listing/incomplete') == 1
+    # The car on the failed page would be reported as removed otherwise
+    assert [car['vin'] for car in pipeline.store.removed()] == ['VIN1']
+    spider.spider_idle()
+    crawler.engine.crawl.assert_not_called()
+    pipeline.close_spider(spider)
+
+
+def test_removed_car_is_reported(tmp_path):
+    db = str(tmp_path / 'fingerprints.db')
+    crawler, spider, pipeline = crawl(db, CARS)
+    pipeline.close_spider(spider)
+
+    crawler, spider, pipeline = crawl(db, CARS[:1])
+    with pytest.raises(DontCloseSpider):
+        spider.spider_idle()
+    report = crawler.engine.crawl.call_args[0][0]
+    assert [car['vin'] for car in report.callback(None)] == ['VIN1']
+    pipeline.close_spider(spider)
@@ -0,0 +1,49 @@
+import json
+import os
+import sys
+
+import scrapy
+from scrapy.http import TextResponse
+from scrapy.utils.test import get_crawler
+
+# The project and splash_scripts, as scrapy crawl finds them
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [project_dir, os.path.dirname(project_dir)]
+
+from toyota_collector.spiders.toyota import ToyotaSpider, item_from_json  # noqa: E402
+
+API_URL = 'https://www.larryhmillertoyota.com/apis/widget/INVENTORY_LISTING_DEFAULT_AUTO_USED:inventory-data-bus1/getInventory'
+LISTING_URL = 'https://www.larryhmillertoyota.com/used-inventory/index.htm'
+USED_CAR = {'vin': 'VIN1', 'model': 'Camry', 'trim': 'LE', 'year': 2019, 'condition': 'used',
+            'stockNumber': 'S1', 'link': '/used/Toyota/2019-Toyota-Camry-VIN1.htm',
+            'attributes': [{'name': 'odometer', 'value': '41,250 miles'}, {'name': 'exteriorColor', 'value': 'Red'},
+                           {'name': 'driveLine', 'value': 'FWD'}],
+            'cityFuelEconomy': 29, 'highwayFuelEconomy': 41}
+
+
+def parse(body):
+    spider = ToyotaSpider.from_crawler(get_crawler(ToyotaSpider))
+    url = API_URL + '?start=0&pageSize=100'
+    response = TextResponse(url, body=body, encoding='utf-8', request=scrapy.Request(url))
+    return list(spider.parse_inventory(response, api_url=API_URL, listing_url=LISTING_URL, start=0))
+
+
+def test_car_is_read_from_the_json():
+    car = item_from_json(USED_CAR, 'https://www.larryhmillertoyota.com' + USED_CAR['link'])
+    assert car['model'] == 'Camry LE' and car['year'] == '2019' and car['new_or_used'] == 'Used'
+    assert car['odometer'] == 41250
+    assert car['exterior_color'] == 'Red' and car['drivetrain'] == 'FWD'
+    assert car['fuel_economy'] == '29/41'
+    assert car['dealer_notes'] == ''
+
+
+def test_car_missing_its_vin_is_rendered():
+    [output] = parse(json.dumps({'inventory': [dict(USED_CAR, vin='')], 'pageInfo': {'totalCount': 1}}))
+    assert isinstance(output, scrapy.Request)
+    assert output.meta['splash']['args']['url'] == 'https://www.larryhmillertoyota.com' + USED_CAR['link']
+
+
+def test_listing_without_json_is_rendered():
+    [output] = parse('<html>Access denied</html>')
+    assert isinstance(output, scrapy.Request)
+    assert output.meta['splash']['args']['url'] == LISTING_URL
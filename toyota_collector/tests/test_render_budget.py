@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+
+import scrapy
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+
+# The project and splash_scripts, as scrapy crawl finds them
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [project_dir, os.path.dirname(project_dir)]
+
+from splash_scripts.middlewares import SplashRenderBudgetMiddleware  # noqa: E402
+
+LISTING_URL = 'https://www.larryhmillertoyota.com/new-inventory/index.htm'
+
+
+def render(retries):
+    """A render that Splash answered with a 503, after it had been retried retries times"""
+    request = scrapy.Request('http://localhost:8050/execute', meta={
+        'splash': {'args': {'url': LISTING_URL, 'wait': 0.5, 'timeout': 30}},
+        '_splash_processed': True, '_render_started': time.monotonic(), 'overload_retries': retries})
+    return request, Response(request.url, status=503, request=request)
+
+
+def test_overloaded_render_is_retried_by_the_budget():
+    crawler = get_crawler(settings_dict={'SPLASH_RENDER_RETRIES': 3})
+    budget = SplashRenderBudgetMiddleware.from_crawler(crawler)
+    budget.in_flight = 1
+    request, response = render(0)
+    retry = budget.process_response(request, response, scrapy.Spider('toyota'))
+    assert isinstance(retry, scrapy.Request) and retry.meta['overload_retries'] == 1
+    assert not retry.meta.get('dont_retry')
+
+
+def test_render_given_up_on_is_not_retried_by_scrapy():
+    crawler = get_crawler(settings_dict={'SPLASH_RENDER_RETRIES': 3})
+    budget = SplashRenderBudgetMiddleware.from_crawler(crawler)
+    budget.in_flight = 1
+    spider = scrapy.Spider('toyota')
+    request, response = render(3)
+    assert budget.process_response(request, response, spider) is response
+    # The next downloader middleware on the way back to the engine
+    assert RetryMiddleware.from_crawler(crawler).process_response(request, response, spider) is response
+    assert crawler.stats.get_value('listing/incomplete') == 1
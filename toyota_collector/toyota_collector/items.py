@@ -21,3 +21,8 @@ class ToyotaCollectorItem(scrapy.Item):
     drivetrain = scrapy.Field()
     engine = scrapy.Field()
     dealer_notes = scrapy.Field()
+    url = scrapy.Field()
+    # 'new', 'changed' or 'removed' since the last run, see IncrementalPipeline
+    change = scrapy.Field()
+    # Set by the spider for IncrementalPipeline, which takes it out of the item
+    listing_fingerprint = scrapy.Field()
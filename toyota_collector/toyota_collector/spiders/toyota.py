@@ -1,33 +1,250 @@
+import json
+import os
+import re
+from urllib.parse import urlencode
+
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy_splash import SplashRequest
+from splash_scripts.incremental import fingerprint
 from ..items import ToyotaCollectorItem
 
 
+# The inventory pages are Dealer.com sites. Their listing widgets get the cars from a JSON endpoint
+# (the XHR the browser makes after the page loads), which can be called directly:
+#   /apis/widget/<widget>:inventory-data-bus1/getInventory?start=0&pageSize=100
+INVENTORY_API = '/apis/widget/{widget}/getInventory'
+# The listing widget named in the page's html, ex. INVENTORY_LISTING_DEFAULT_AUTO_NEW:inventory-data-bus1
+INVENTORY_WIDGET_PATTERN = re.compile(r'INVENTORY_LISTING_[A-Z_]+:inventory-data-bus\d+')
+# Used when the page doesn't name its widget
+DEFAULT_WIDGETS = {'new': 'INVENTORY_LISTING_DEFAULT_AUTO_NEW:inventory-data-bus1',
+                   'used': 'INVENTORY_LISTING_DEFAULT_AUTO_USED:inventory-data-bus1'}
+API_PAGE_SIZE = 100
+
+# Nodes a render of each page is missing if it came back before the page's scripts had finished,
+# see SplashRenderBudgetMiddleware
+LISTING_XPATH = '//ul[@class="inventoryList data full list-unstyled"]'
+VEHICLE_XPATH = '//*[@id="vehicle-title1-app-root"]/div'
+
+# Renders a page without its images, fonts and trackers, waits for a selector and returns only the
+# elements that are parsed. Shared with deadmanrealty_spider
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'splash_scripts',
+                       'render_fragment.lua')) as script_file:
+    RENDER_SCRIPT = script_file.read()
+
+# ToyotaCollectorItem field -> the names of the vehicle attributes it can come from, in the JSON
+ATTRIBUTE_FIELDS = {
+    'exterior_color': ('exteriorColor',),
+    'interior_color': ('interiorColor',),
+    'body': ('bodyStyle',),
+    'transmission': ('transmission',),
+    'drivetrain': ('driveLine', 'drivetrain'),
+    'engine': ('engine',),
+    'fuel_economy': ('fuelEconomy',),
+    'odometer': ('odometer',),
+    'dealer_notes': ('dealerNotes', 'comments'),
+}
+
+
+def vehicle_attributes(vehicle: dict) -> dict:
+    """The vehicle's top level values, and its attributes list as name -> value"""
+    values = {k: v for k, v in vehicle.items() if not isinstance(v, (dict, list))}
+    for attribute in vehicle.get('attributes') or []:
+        if attribute.get('name') and attribute.get('value') not in (None, ''):
+            values.setdefault(attribute['name'], attribute['value'])
+    return values
+
+
+def parse_odometer(value):
+    """12,345 miles -> 12345"""
+    if value in (None, ''):
+        return None
+    digits = re.sub(r'[^0-9]', '', str(value))
+    return int(digits) if digits else None
+
+
+def item_from_json(vehicle: dict, url: str = None):
+    """
+    A ToyotaCollectorItem from one vehicle of the getInventory JSON, with the same values the
+    rendered detail page gives. None if the JSON is missing what's needed to identify the car, so
+    the detail page is rendered instead.
+    """
+    values = vehicle_attributes(vehicle)
+    if not values.get('vin') or not values.get('model'):
+        return None
+    vehicle_details = ToyotaCollectorItem()
+    vehicle_details['model'] = ' '.join(str(values[k]) for k in ('model', 'trim') if values.get(k))
+    vehicle_details['year'] = str(values['year']) if values.get('year') else None
+    vehicle_details['new_or_used'] = str(values.get('condition') or values.get('type') or '').capitalize() or None
+    vehicle_details['vin'] = values['vin']
+    vehicle_details['stock_num'] = values.get('stockNumber')
+    for field, names in ATTRIBUTE_FIELDS.items():
+        vehicle_details[field] = next((values[n] for n in names if values.get(n) not in (None, '')), None)
+    if vehicle_details['fuel_economy'] is None and values.get('cityFuelEconomy'):
+        vehicle_details['fuel_economy'] = str(values['cityFuelEconomy']) + '/' + str(values.get('highwayFuelEconomy', ''))
+    vehicle_details['odometer'] = None if vehicle_details['new_or_used'] == 'New' else parse_odometer(vehicle_details['odometer'])
+    vehicle_details['dealer_notes'] = vehicle_details['dealer_notes'] or ''
+    vehicle_details['url'] = url
+    return vehicle_details
+
+
 class ToyotaSpider(scrapy.Spider):
+    """
+    Collects every new and used car in the inventory.
+
+    By default (-a mode=api) the inventory comes straight from the site's JSON endpoint with plain
+    requests, and Splash only renders the pages the JSON can't fill: a listing whose endpoint can't be
+    found or doesn't answer with JSON, and cars the JSON is missing the vin or model of. With
+    -a mode=splash every listing and car page is rendered, as before.
+
+    With IncrementalPipeline, cars whose entry in the listing (or the JSON) is the same as in the
+    last run are skipped without rendering their page, and the cars that are gone are output with
+    change 'removed' at the end of the run.
+    """
     name = 'toyota'
     allowed_domains = ['larryhmillertoyota.com']
     start_urls = ['https://www.larryhmillertoyota.com/new-inventory/index.htm',
                   'https://www.larryhmillertoyota.com/used-inventory/index.htm'
                   ]
+    mode = 'api'
+    removed_reported = False
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
+    def unchanged(self, url, listing_fingerprint):
+        """Whether the car at url is listed the same as when it was last scraped, see FingerprintStore"""
+        store = getattr(self, 'fingerprints', None)
+        if store is None or not url or not store.unchanged(url, listing_fingerprint):
+            return False
+        self.crawler.stats.inc_value('fingerprints/unchanged')
+        return True
+
+    def listing_incomplete(self, message):
+        """Part of the inventory couldn't be read, so cars that weren't seen aren't reported as removed"""
+        self.crawler.stats.inc_value('listing/incomplete')
+        self.logger.warning(message)
+
+    def spider_idle(self):
+        store = getattr(self, 'fingerprints', None)
+        if store is None or self.removed_reported:
+            return
+        self.removed_reported = True
+        stats = self.crawler.stats
+        if stats.get_value('log_count/ERROR') or stats.get_value('listing/incomplete'):
+            # Pages that failed may hold cars that are still there
+            self.logger.warning('Not reporting removed cars, this run had errors or missed part of the inventory')
+            return
+        self.crawler.engine.crawl(scrapy.Request('data:,', callback=self.report_removed, dont_filter=True))
+        raise DontCloseSpider
+
+    def report_removed(self, response):
+        for values in self.fingerprints.removed():
+            vehicle_details = ToyotaCollectorItem({k: v for k, v in values.items() if k in ToyotaCollectorItem.fields})
+            vehicle_details['change'] = 'removed'
+            yield vehicle_details
 
     def start_requests(self):
         for url in self.start_urls:
-            yield SplashRequest(url=url, callback=self.parse, endpoint='render.html')
+            if self.mode == 'splash':
+                yield self.render_listing(url)
+            else:
+                # The plain html names the listing widget, no need to run its scripts
+                yield scrapy.Request(url=url, callback=self.find_inventory_api, errback=self.listing_fallback,
+                                     cb_kwargs={'listing_url': url})
+
+    def render_listing(self, url):
+        return self.render_request(url, self.parse, 'ul.inventoryList', 'ul.inventoryList, a[rel="next"]',
+                                   LISTING_XPATH)
+
+    def listing_fallback(self, failure):
+        listing_url = failure.request.cb_kwargs['listing_url']
+        if failure.request.cb_kwargs.get('start', 0):
+            # Only a later page failed, rendering the listing would collect the first pages again
+            self.listing_incomplete('Inventory JSON failed at ' + failure.request.url + ': ' + repr(failure.value))
+            return
+        self.logger.info('No inventory JSON for ' + listing_url + ', rendering it with Splash')
+        yield self.render_listing(listing_url)
+
+    def find_inventory_api(self, response, listing_url):
+        widget = INVENTORY_WIDGET_PATTERN.search(response.text)
+        if widget is not None:
+            widget = widget.group(0)
+        else:
+            widget = DEFAULT_WIDGETS['used' if 'used' in listing_url else 'new']
+        yield self.inventory_request(response.urljoin(INVENTORY_API.format(widget=widget)), listing_url, start=0)
+
+    def inventory_request(self, api_url, listing_url, start):
+        return scrapy.Request(url=api_url + '?' + urlencode({'start': start, 'pageSize': API_PAGE_SIZE}),
+                              callback=self.parse_inventory, errback=self.listing_fallback,
+                              headers={'Accept': 'application/json'},
+                              cb_kwargs={'api_url': api_url, 'listing_url': listing_url, 'start': start})
+
+    def parse_inventory(self, response, api_url, listing_url, start):
+        try:
+            data = json.loads(response.text)
+            inventory = data['inventory']
+        except (ValueError, KeyError, TypeError):
+            if start == 0:
+                yield self.render_listing(listing_url)
+            else:
+                self.listing_incomplete('Bad inventory JSON at ' + response.url)
+            return
+        if start and not inventory:
+            self.listing_incomplete('No cars in the inventory JSON at ' + response.url)
+
+        for vehicle in inventory:
+            url = response.urljoin(vehicle['link']) if vehicle.get('link') else None
+            listing_fingerprint = fingerprint(vehicle)
+            if self.unchanged(url, listing_fingerprint):
+                continue
+            vehicle_details = item_from_json(vehicle, url)
+            if vehicle_details is not None:
+                vehicle_details['listing_fingerprint'] = listing_fingerprint
+                yield vehicle_details
+            elif url:
+                yield self.render_car_page(url, listing_fingerprint)
+
+        total = (data.get('pageInfo') or {}).get('totalCount')
+        if start == 0 and inventory and total:
+            # Every other page at once, the total is known from the first one
+            for next_start in range(len(inventory), int(total), len(inventory)):
+                yield self.inventory_request(api_url, listing_url, next_start)
+        elif start == 0 and len(inventory) >= API_PAGE_SIZE:
+            self.listing_incomplete('No total count in the inventory JSON at ' + response.url + ', only its first page is read')
+
+    def render_car_page(self, url, listing_fingerprint=None):
+        return self.render_request(url, self.process_car_page, '#vehicle-title1-app-root > div',
+                                   '#vehicle-title1-app-root, #quick-specs1-app-root, #dealernotes1-app-root',
+                                   VEHICLE_XPATH, meta={'listing_url': url, 'listing_fingerprint': listing_fingerprint})
+
+    def render_request(self, url, callback, selector, fragment, render_xpath, wait=0.5, meta=None):
+        """SplashRequest through RENDER_SCRIPT, returning the elements matching fragment once selector is on the page"""
+        return SplashRequest(url=url, callback=callback, endpoint='execute',
+                             args={'lua_source': RENDER_SCRIPT, 'selector': selector, 'fragment': fragment, 'wait': wait},
+                             meta=dict(meta or {}, render_xpath=render_xpath))
 
     def parse(self, response):
-        data_location = response.xpath('//ul[@class="inventoryList data full list-unstyled"]')
+        data_location = response.xpath(LISTING_XPATH)
         for car in data_location:
-            car_page_url = car.xpath('.//*/a[@class="url"]/@href').extract_first()
-            yield SplashRequest(url=response.urljoin(car_page_url), callback=self.process_car_page)
+            car_page_url = response.urljoin(car.xpath('.//*/a[@class="url"]/@href').extract_first())
+            listing_fingerprint = fingerprint(car)
+            if not self.unchanged(car_page_url, listing_fingerprint):
+                yield self.render_car_page(car_page_url, listing_fingerprint)
 
         next_page = response.xpath('//a[@rel="next"]/@href').extract_first()
         # absolute_next_page_url = response.urljoin(next_page)
-        yield SplashRequest(url=response.urljoin(next_page), callback=self.parse)
+        if next_page:
+            yield self.render_listing(response.urljoin(next_page))
 
     def process_car_page(self, response):
         vehicle_details = ToyotaCollectorItem()
 
-        data_field_1 = response.xpath('//*[@id="vehicle-title1-app-root"]/div')
+        data_field_1 = response.xpath(VEHICLE_XPATH)
         vehicle_details['model'] = ''.join(data_field_1.xpath('.//h1/span[2]/text()').extract())
         vehicle_details['year'] = data_field_1.xpath('.//h1/span[1]/span[2]/text()').extract_first()
         vehicle_details['new_or_used'] = data_field_1.xpath('.//h1/span[1]/span[1]/text()').extract_first()
@@ -55,5 +272,7 @@ class ToyotaSpider(scrapy.Spider):
             vehicle_details['engine'] = data_field_2.xpath('.//dd[8]/span/text()').extract_first()
 
         vehicle_details['dealer_notes'] = ''.join(response.xpath('//*[@id="dealernotes1-app-root"]/div/text()').extract())
+        vehicle_details['url'] = response.meta.get('listing_url', response.url)
+        vehicle_details['listing_fingerprint'] = response.meta.get('listing_fingerprint')
 
         yield vehicle_details